@@ -0,0 +1,286 @@
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from metrics import inc, observe_stage
+
+# Admission control in front of the analyses. Every client (an API key from ADMISSION_API_KEYS, otherwise
+# the client IP) draws from a token bucket, and at most ADMISSION_MAX_ACTIVE page analyses run at once on
+# the host. Further analyses wait in a bounded FIFO queue for at most ADMISSION_MAX_WAIT seconds. Anything
+# that cannot be admitted gets a 429 with Retry-After straight away, long before nginx's 120 s proxy
+# timeout would fire. Buckets, running analyses and the queue live in a SQLite file that every worker on
+# the host shares, so the limits hold for the host, not per worker.
+
+ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'true').lower() in ('true', '1')
+ADMISSION_DB = os.getenv('ADMISSION_DB', os.path.join('cache', 'admission.sqlite3'))
+ADMISSION_MAX_ACTIVE = int(os.getenv('ADMISSION_MAX_ACTIVE', 8))  # Page analyses running at once, host-wide
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', 16))  # Analyses waiting for a slot; beyond this 429 at once
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', 15))  # Longest an analysis waits for a slot
+ADMISSION_SLOT_TTL = float(os.getenv('ADMISSION_SLOT_TTL', 180))  # Held slots are renewed; a dead worker's expire after this
+ADMISSION_POLL_INTERVAL = 0.1
+ADMISSION_BATCH_SLOTS = int(os.getenv('ADMISSION_BATCH_SLOTS', max(1, ADMISSION_MAX_ACTIVE // 2)))  # Slots one batch or crawl may hold at once
+ADMISSION_API_KEYS = {key.strip() for key in os.getenv('ADMISSION_API_KEYS', '').split(',') if key.strip()}
+
+# Token buckets: sustained requests per minute and burst size, for anonymous clients (by IP) and API keys
+RATE_LIMIT_PER_MINUTE = float(os.getenv('RATE_LIMIT_PER_MINUTE', 20))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', 10))
+RATE_LIMIT_KEY_PER_MINUTE = float(os.getenv('RATE_LIMIT_KEY_PER_MINUTE', 120))
+RATE_LIMIT_KEY_BURST = float(os.getenv('RATE_LIMIT_KEY_BURST', 60))
+RATE_LIMIT_IDLE_PRUNE = 3600  # Buckets untouched this long are full again and are dropped
+
+
+class Rejected(Exception):
+    """Raised when a request is not admitted. reason is 'rate_limited', 'over_burst', 'queue_full' or 'wait_timeout'."""
+
+    def __init__(self, message, reason, retry_after):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+def client_id(headers, remote_addr):
+    """
+    ('key', digest) for a request carrying a known X-API-Key, else ('ip', address). Behind nginx the
+    address comes from X-Real-IP; the backend socket is not reachable otherwise.
+    """
+    api_key = headers.get('X-API-Key')
+    if api_key and api_key in ADMISSION_API_KEYS:
+        return 'key', hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+    return 'ip', headers.get('X-Real-IP') or remote_addr or 'unknown'
+
+
+class Admission:
+    def __init__(self, db_path=ADMISSION_DB, max_active=ADMISSION_MAX_ACTIVE, max_queue=ADMISSION_MAX_QUEUE,
+                 max_wait=ADMISSION_MAX_WAIT):
+        self.db_path = db_path
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hold_seconds = 5.0  # Moving average of how long an analysis holds its slot, for Retry-After
+        self._last_prune = 0.0
+        self._tickets = set()  # Slots this process holds, renewed by the heartbeat thread until they are left
+        self._heartbeat_pid = None
+        self._init_db()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _init_db(self):
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS buckets (client TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)'
+        )
+        # One row per running (active) or queued (waiting) analysis; the id orders the queue
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS tickets (id INTEGER PRIMARY KEY AUTOINCREMENT, state TEXT NOT NULL, '
+            'expires_at REAL NOT NULL)'
+        )
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    # Token buckets
+
+    def take_token(self, client, count=1):
+        """Spends `count` tokens of the client's bucket at once; raises Rejected (spending none) when it holds fewer."""
+        if not ADMISSION_ENABLED:
+            return
+        kind, name = client
+        rate, burst = ((RATE_LIMIT_KEY_PER_MINUTE, RATE_LIMIT_KEY_BURST) if kind == 'key'
+                       else (RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST))
+        rate /= 60
+        if count > burst:
+            # No amount of waiting refills the bucket past its burst; the client has to ask for less
+            inc('admission_rejected_total', reason='over_burst')
+            raise Rejected(f"This request costs {count} requests of the rate limit, more than the {burst:.0f} a client "
+                           f"can spend at once; split it up", 'over_burst', burst / rate)
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute('SELECT tokens, updated_at FROM buckets WHERE client = ?', (f"{kind}:{name}",)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+            admitted = tokens >= count
+            if admitted:
+                tokens -= count
+            connection.execute('INSERT OR REPLACE INTO buckets (client, tokens, updated_at) VALUES (?, ?, ?)',
+                               (f"{kind}:{name}", tokens, now))
+            if now - self._last_prune > 60:
+                self._last_prune = now
+                connection.execute('DELETE FROM buckets WHERE updated_at < ?', (now - RATE_LIMIT_IDLE_PRUNE,))
+        if not admitted:
+            inc('admission_rejected_total', reason='rate_limited')
+            raise Rejected("Too many requests, please slow down", 'rate_limited', (count - tokens) / rate)
+
+    # Analysis slots
+
+    def _enter(self):
+        """Takes a slot, or a place in the queue. Returns (ticket id, admitted)."""
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM tickets WHERE expires_at < ?', (now,))
+            active, waiting = self._counts(connection)
+            if active + waiting < self.max_active:
+                cursor = connection.execute('INSERT INTO tickets (state, expires_at) VALUES (?, ?)',
+                                            ('active', now + ADMISSION_SLOT_TTL))
+                return cursor.lastrowid, True
+            if waiting >= self.max_queue:
+                inc('admission_rejected_total', reason='queue_full')
+                raise Rejected("The server is busy, please retry shortly", 'queue_full', self._retry_after(waiting))
+            cursor = connection.execute('INSERT INTO tickets (state, expires_at) VALUES (?, ?)',
+                                        ('waiting', now + self.max_wait + 5))
+            return cursor.lastrowid, False
+
+    def _promote(self, ticket):
+        """Moves a queued ticket to a slot once the analyses ahead of it have left; returns whether it did."""
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM tickets WHERE expires_at < ? AND id != ?', (now, ticket))
+            active = connection.execute("SELECT COUNT(*) FROM tickets WHERE state = 'active'").fetchone()[0]
+            ahead = connection.execute("SELECT COUNT(*) FROM tickets WHERE state = 'waiting' AND id < ?", (ticket,)).fetchone()[0]
+            if active + ahead >= self.max_active:
+                return False
+            connection.execute("UPDATE tickets SET state = 'active', expires_at = ? WHERE id = ?",
+                               (now + ADMISSION_SLOT_TTL, ticket))
+            return True
+
+    def _leave(self, ticket):
+        with self._lock:
+            self._tickets.discard(ticket)
+        self._connection().execute('DELETE FROM tickets WHERE id = ?', (ticket,))
+
+    def _hold(self, ticket):
+        """Keeps an active ticket's slot for as long as the analysis (or batch item) runs, however long that is."""
+        with self._lock:
+            self._tickets.add(ticket)
+            if self._heartbeat_pid != os.getpid():  # Threads don't survive a fork
+                self._heartbeat_pid = os.getpid()
+                threading.Thread(target=self._renew_slots, name='admission-heartbeat', daemon=True).start()
+
+    def _renew_slots(self):
+        while True:
+            time.sleep(ADMISSION_SLOT_TTL / 3)
+            with self._lock:
+                tickets = list(self._tickets)
+            if not tickets:
+                continue
+            try:
+                self._connection().execute(
+                    f"UPDATE tickets SET expires_at = ? WHERE id IN ({', '.join('?' * len(tickets))})",
+                    (time.time() + ADMISSION_SLOT_TTL, *tickets),
+                )
+            except sqlite3.Error as e:
+                logging.error(f"Could not renew {len(tickets)} admission slots: {e}")
+
+    def _timed_out(self):
+        inc('admission_rejected_total', reason='wait_timeout')
+        return Rejected("The server is busy, please retry shortly", 'wait_timeout', self._retry_after(self.queue_depth()))
+
+    def _held(self, seconds):
+        with self._lock:
+            self._hold_seconds = 0.8 * self._hold_seconds + 0.2 * seconds
+
+    def _retry_after(self, waiting):
+        """Roughly when a slot should be free for a newcomer: the queue ahead, drained max_active at a time."""
+        return self._hold_seconds * (waiting + 1) / self.max_active
+
+    @staticmethod
+    def _counts(connection):
+        counts = dict(connection.execute('SELECT state, COUNT(*) FROM tickets GROUP BY state').fetchall())
+        return counts.get('active', 0), counts.get('waiting', 0)
+
+    @contextmanager
+    def slot(self):
+        """Holds one of the host's analysis slots for the block, queuing for it first when all are taken."""
+        if not ADMISSION_ENABLED:
+            yield
+            return
+        requested = time.monotonic()
+        ticket, admitted = self._enter()
+        try:
+            while not admitted:
+                if time.monotonic() - requested > self.max_wait:
+                    raise self._timed_out()
+                time.sleep(ADMISSION_POLL_INTERVAL)
+                admitted = self._promote(ticket)
+        except BaseException:
+            self._leave(ticket)
+            raise
+        self._hold(ticket)
+        started = time.monotonic()
+        observe_stage('admission_wait', started - requested)
+        try:
+            yield
+        finally:
+            self._held(time.monotonic() - started)
+            self._leave(ticket)
+
+    @asynccontextmanager
+    async def slot_async(self):
+        """Event-loop version of slot(); the store is used from worker threads and waiting never blocks the loop."""
+        if not ADMISSION_ENABLED:
+            yield
+            return
+        requested = time.monotonic()
+        ticket, admitted = await asyncio.to_thread(self._enter)
+        try:
+            while not admitted:
+                if time.monotonic() - requested > self.max_wait:
+                    raise await asyncio.to_thread(self._timed_out)
+                await asyncio.sleep(ADMISSION_POLL_INTERVAL)
+                admitted = await asyncio.to_thread(self._promote, ticket)
+        except BaseException:
+            await asyncio.to_thread(self._leave, ticket)
+            raise
+        self._hold(ticket)
+        started = time.monotonic()
+        observe_stage('admission_wait', started - requested)
+        try:
+            yield
+        finally:
+            self._held(time.monotonic() - started)
+            await asyncio.to_thread(self._leave, ticket)
+
+    # Introspection
+
+    def queue_depth(self):
+        return self.stats()['waiting']
+
+    def stats(self):
+        """Host-wide running and queued analyses, with the limits they are held to."""
+        connection = self._connection()
+        connection.execute('DELETE FROM tickets WHERE expires_at < ?', (time.time(),))
+        active, waiting = self._counts(connection)
+        return {'active': active, 'waiting': waiting, 'max_active': self.max_active, 'max_queue': self.max_queue,
+                'enabled': ADMISSION_ENABLED}
+
+    def gauges(self):
+        """The queue gauges for /metrics; read from the shared store when scraped, so never summed across workers."""
+        stats = self.stats()
+        return {('admission_active', ()): stats['active'], ('admission_queue_depth', ()): stats['waiting']}
+
+
+admission = Admission()
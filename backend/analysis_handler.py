@@ -0,0 +1,324 @@
+import asyncio
+import contextvars
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import log_request
+from html_inventory import delayed_js_ids, delayed_css_ids
+from page_fetcher import fetch_page, fetch_page_async, iter_page, DEFAULT_HEADERS, PERFORMANCE_TOOLS
+from exclusion_rules import exclusion_rules
+from metrics import timed, inc, observe_stage
+
+log = logging.getLogger(__name__)
+
+# Threads that run the CPU-bound parsing and matching for the async pipeline, off the event loop
+PARSE_THREADS = int(os.getenv('PARSE_THREADS', 4))
+parse_executor = ThreadPoolExecutor(max_workers=PARSE_THREADS, thread_name_prefix='parse')
+
+
+# Report fields per stage, in the order the streaming endpoint sends them
+REPORT_STAGES = (
+    ('cache', ('cache_status', 'bigscoots_cache_status', 'cache_plan')),
+    ('tools', ('performance_tools', 'performance_plugins')),
+    ('assets', ('plugins', 'themes', 'plugin_versions', 'theme_versions')),
+    ('ids', ('js_ids', 'css_ids', 'inline_scripts')),
+    ('recommendations', ('recommendations', 'rules_version', 'parse_time_ms', 'bytes_read', 'truncated', 'timing')),
+)
+
+
+class AnalysisError(Exception):
+    """Raised when a stage of the analysis fails; the message is returned to the client as-is."""
+
+
+def categorize_script(script_matches, plugin_or_theme, exclusion_key):
+    """Categorizes the script based on the patterns it matched for the specific plugin or theme."""
+    # script_matches maps each exclusion_list key to the first of its patterns found in the script
+    js_item = script_matches.get(exclusion_key)
+    if js_item is not None:
+        return plugin_or_theme.lower(), js_item  # Return the matching plugin/theme and JS item
+
+    # If no match is found, return None to indicate no match
+    return None, None
+
+
+def process_plugin_or_theme(inventory, all_script_matches, plugin_or_theme, exclusion_key, exclusion_list):
+    """
+    Process all scripts in the page inventory for a specific plugin or theme, checking against the exclusion list.
+    Returns a list of recommendations (either 'Exclude from delay' or 'No changes needed').
+    """
+    recommendations = []
+    processed_scripts = set()  # Keep track of processed scripts to avoid duplication
+
+    plugin_or_theme = plugin_or_theme.lower()  # Normalize the plugin/theme name for consistent matching
+    log.debug("Processing plugin_or_theme: %s", plugin_or_theme)
+
+    # Iterate over all <script> tags collected from the page source, alongside their precomputed matches
+    for script, script_matches in zip(inventory.scripts, all_script_matches):
+        if not script_matches:
+            continue
+
+        # Check if the script matches the exclusion list for this plugin or theme
+        match_found, matched_script = categorize_script(script_matches, plugin_or_theme, exclusion_key)
+
+        # If a match is found and hasn't been processed yet, determine the recommendation
+        if match_found and matched_script not in processed_scripts:
+            script_id = script.id.lower()  # Normalize script ID
+            recommendation_identifier = script_id if script_id else matched_script  # Prioritize ID over matched_script
+            # Any case of the type counts here: recommendations have always been checked on the lowercased page
+            if script.delayed_any_case:
+                recommendations.append(f"{plugin_or_theme}: {recommendation_identifier} - Exclude from delay")
+            else:
+                recommendations.append(f"{plugin_or_theme}: {recommendation_identifier} - No changes needed")
+            processed_scripts.add(matched_script)
+
+    # For items in the exclusion list but not found in the page source
+    for js_item in exclusion_list:
+        if js_item not in processed_scripts:
+            recommendations.append(f"{plugin_or_theme}: {js_item} - Be aware of this: Not found in page source")
+
+    log.debug("Recommendations for %s: %s", plugin_or_theme, recommendations)
+    return recommendations
+
+
+
+def check_exclusions(inventory, loaded_plugins, loaded_themes, rules=None):
+    """
+    Checks the page inventory for all loaded plugins and themes, processing exclusions for each.
+    rules is the exclusion_rules snapshot to check against; the current one by default.
+    """
+    all_recommendations = []
+    rules = rules or exclusion_rules.snapshot()
+    exclusion_list = rules.exclusion_list
+
+    # Print out loaded plugins and themes for debugging
+    log.info("Loaded plugins: %s", loaded_plugins)
+    log.info("Loaded themes: %s", loaded_themes)
+    debug = log.isEnabledFor(logging.DEBUG)  # Checked once, so the per-key tracing costs nothing when off
+
+    # Resolve which exclusion_list keys apply to this page, plugins first, then themes
+    targets = []
+    for plugin in loaded_plugins:
+        plugin_key = f"plugins/{plugin.lower()}"  # Ensure case-insensitive comparison
+        if plugin_key in exclusion_list:
+            targets.append((plugin, plugin_key))
+    for theme in loaded_themes:
+        theme_key = f"themes/{theme.lower()}"  # Ensure case-insensitive comparison
+        if theme_key in exclusion_list:
+            targets.append((theme, theme_key))
+
+    if not targets:
+        return all_recommendations
+
+    # Scan every script once against the compiled automaton, keeping only hits for the keys in play
+    target_keys = {key for _, key in targets}
+    all_script_matches = [
+        rules.matcher.first_matches(script.src.lower(), script.id.lower(), target_keys)
+        for script in inventory.scripts
+    ]
+
+    for plugin_or_theme, exclusion_key in targets:
+        if debug:
+            log.debug("Processing %s: %s", exclusion_key.split('/')[0][:-1], plugin_or_theme)
+        recommendations = process_plugin_or_theme(inventory, all_script_matches, plugin_or_theme, exclusion_key, exclusion_list[exclusion_key])
+        all_recommendations.extend(recommendations)
+
+    return all_recommendations
+
+def flatten_recommendations(recommendations):
+    """Flattens the recommendation list for easy display."""
+    flattened = []
+    for rec in recommendations:
+        flattened.append(rec)
+    return flattened
+
+
+def apply_option(url, option):
+    """Appends the query flag for the selected analysis option."""
+    if option == 'perfmattersoff':
+        url += '?perfmattersoff'
+    elif option == 'nocache':
+        url += '?nocache'
+    return url
+
+
+def conditional_headers(validators):
+    """Request headers for a fetch, made conditional when validators from an earlier run are known."""
+    headers = dict(DEFAULT_HEADERS)
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def analyze_url(url, validators=None):
+    """
+    Fetches url and builds the /api/analyze report for it.
+    validators holds the ETag/Last-Modified of a previous run; when the origin answers 304 Not Modified,
+    (None, validators) is returned so the caller can keep serving the earlier report.
+    Returns (response_data, validators).
+    """
+    # Fetch the page, streaming it through the inventory parser
+    logging.info(f"Sending request to {url}")
+    with timed('fetch'):
+        page = fetch_page(url, headers=conditional_headers(validators))
+    return build_report(url, page, validators)
+
+
+async def analyze_url_async(url, validators=None):
+    """Same as analyze_url, without holding a thread while the origin responds."""
+    logging.info(f"Sending async request to {url}")
+    with timed('fetch'):
+        page = await fetch_page_async(url, headers=conditional_headers(validators), executor=parse_executor)
+    loop = asyncio.get_running_loop()
+    # Run in a copy of this context so the report's stage timings reach the request's Server-Timing
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(parse_executor, context.run, build_report, url, page, validators)
+
+
+def analyze_url_stages(url):
+    """
+    Generator form of analyze_url for the streaming endpoint: yields (stage, fields) for each REPORT_STAGES
+    entry as soon as it is ready (the cache stage right after the response headers), then
+    ('report', (response_data, validators)) with the assembled report for the result cache.
+    """
+    logging.info(f"Sending streaming request to {url}")
+    # Timed in two parts around the yield, so the client's time with the cache event isn't counted
+    with timed('fetch_headers'):
+        stages = iter_page(url, headers=DEFAULT_HEADERS)
+        _, headers = next(stages)
+    cache = cache_fields(headers)
+    yield 'cache', cache
+
+    with timed('fetch_body'):
+        page = next(stages)
+    record_page(url, page)
+    response_data = dict(cache)
+    for stage, fields in report_stages(url, page, cache):
+        response_data.update(fields)
+        yield stage, fields
+    yield 'report', (response_data, page_validators(page.headers))
+
+
+def build_report(url, page, validators=None):
+    """Turns a FetchedPage into the report returned by /api/analyze. Returns (response_data, validators)."""
+    record_page(url, page)
+
+    if page.status_code == 304:
+        logging.info(f"{url} not modified since the cached analysis")
+        return None, validators
+
+    # Prepare response
+    response_data = cache_fields(page.headers)
+    for _, fields in report_stages(url, page, response_data):
+        response_data.update(fields)
+    return response_data, page_validators(page.headers)
+
+
+def record_page(url, page):
+    """Logs and counts what was read; parsing ran while the body streamed in, so its time is recorded here."""
+    logging.info(f"Read {page.bytes_read} bytes from {url} (truncated: {page.truncated})")
+    inc('fetch_bytes_total', page.bytes_read)
+    if page.truncated:
+        inc('pages_truncated_total')
+    if page.status_code != 304:
+        observe_stage('parse', page.parse_ms / 1000)
+
+
+def page_validators(headers):
+    """The ETag/Last-Modified that make the next analysis of the page a conditional request."""
+    return {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+    }
+
+
+def cache_fields(headers):
+    """The cache part of the report; it only needs the response headers."""
+    cache_plan = ''
+
+    # Check cache statuses
+    cf_cache_status = headers.get('cf-cache-status', 'Not Found')
+    bigscoots_cache_status = headers.get('X-Bigscoots-Cache-Status', 'Not Found')
+    bigscoots_cache_plan = headers.get('x-bigscoots-cache-plan', '')
+    logging.info(f"Cache headers - CF: {cf_cache_status}, BigScoots: {bigscoots_cache_status}, Plan: {bigscoots_cache_plan}")
+
+    cache_status = f"CF-CACHE: {cf_cache_status}" if cf_cache_status else "CF-CACHE: Not Found"
+    bigscoots_cache_status = f"X-Bigscoots-Cache-Status: {bigscoots_cache_status}"
+
+    if bigscoots_cache_plan == 'Performance+':
+        cache_plan = "Performance Plus"
+
+    return {
+        "cache_status": cache_status,
+        "bigscoots_cache_status": bigscoots_cache_status,
+        "cache_plan": cache_plan
+    }
+
+
+def report_stages(url, page, cache):
+    """
+    Yields the rest of the report as (stage, fields) in the order the pieces become available, so the
+    streaming endpoint can send each one as soon as it is ready. cache is the cache_fields() of the page.
+    """
+    plugins = set()
+    themes = set()
+
+    # Process page content
+    found_perfmatters = '/plugins/perfmatters' in page.markers
+    found_wp_rocket = '/plugins/wp-rocket' in page.markers
+    performance_tools = "Perfmatters + WP Rocket" if found_perfmatters and found_wp_rocket else "Perfmatters" if found_perfmatters else "WP Rocket" if found_wp_rocket else "No Perfmatters"
+    performance_plugins = sorted(PERFORMANCE_TOOLS[marker] for marker in page.markers)
+    logging.info(f"Performance tools detected: {performance_tools}")
+    yield 'tools', {"performance_tools": performance_tools, "performance_plugins": performance_plugins}
+
+    plugins.update(page.plugins)
+    themes.update(page.themes)
+    yield 'assets', {
+        "plugins": sorted(plugins),
+        "themes": sorted(themes),
+        "plugin_versions": page.versions['plugins'],
+        "theme_versions": page.versions['themes']
+    }
+
+    # The script/stylesheet inventory was built while the page streamed in
+    inventory = page.inventory
+    parse_time_ms = page.parse_ms
+    logging.info(f"Inventory built in {parse_time_ms} ms: {len(inventory.scripts)} scripts, {len(inventory.stylesheets)} stylesheets")
+
+    inline_scripts = list(inventory.delayed_inline)
+    js_ids = delayed_js_ids(inventory)
+    css_ids = delayed_css_ids(inventory)
+    yield 'ids', {"js_ids": sorted(js_ids), "css_ids": sorted(css_ids), "inline_scripts": inline_scripts}
+
+    # Check exclusions
+    logging.info("Checking for exclusions")
+    loaded_plugins = sorted(plugins)
+    loaded_themes = sorted(themes)
+    rules = exclusion_rules.snapshot()
+    try:
+        with timed('exclusions'):
+            recommendations = check_exclusions(inventory, loaded_plugins, loaded_themes, rules)
+        flattened_recommendations = flatten_recommendations(recommendations)
+        logging.info(f"Generated {len(flattened_recommendations)} recommendations")
+    except Exception as exclusion_error:
+        logging.error(f"Error in exclusion checks: {exclusion_error}")
+        raise AnalysisError(f"Exclusion check failed: {exclusion_error}") from exclusion_error
+
+    # Log the request; this only queues the record for the background writer
+    with timed('log_request'):
+        log_request(url, cache_status=cache['cache_status'], bigscoots_cache_status=cache['bigscoots_cache_status'],
+                    cache_plan=cache['cache_plan'], performance_tools=performance_tools, plugins=loaded_plugins,
+                    themes=loaded_themes, recommendations=len(flattened_recommendations), rules_version=rules.version,
+                    bytes_read=page.bytes_read, truncated=page.truncated, parse_time_ms=parse_time_ms)
+
+    yield 'recommendations', {
+        "recommendations": flattened_recommendations,
+        "rules_version": rules.version,
+        "parse_time_ms": parse_time_ms,
+        "bytes_read": page.bytes_read,
+        "truncated": page.truncated,
+        "timing": page.timing
+    }
@@ -1,16 +1,33 @@
-from flask import Flask, request, session, jsonify, render_template
+from flask import Flask, request, session, jsonify, render_template, Response, stream_with_context, g
 import requests
-import py_compile
 import re
 import uuid
-from bs4 import BeautifulSoup
+import itertools
 import logging
 from dotenv import load_dotenv
 from flask_cors import CORS
 import os
-from utils import log_request, is_valid_url
-from concurrent.futures import ThreadPoolExecutor
-from urllib.parse import urlparse
+from utils import is_valid_url
+from time import monotonic
+from http_client import pool_stats, http_counters
+from analysis_handler import analyze_url, analyze_url_stages, apply_option, AnalysisError, REPORT_STAGES
+from result_cache import result_cache, result_key
+from crux_handler import get_field_data, get_field_data_async, get_field_data_batch, collect_field_data, origin_of
+from background_loop import submit
+from exclusion_rules import exclusion_rules, save_rules, parse_rules, RulesError, RULES_FILE
+from psi_handler import start_cwv_scores, collect_cwv_scores, psi_cache_stats, PSI_BUDGET
+from batch_runner import run_batch, BATCH_CONCURRENCY, BATCH_PER_HOST, BATCH_MAX_URLS, BATCH_TIME_BUDGET
+from site_crawler import crawl_site, CRAWL_SAMPLES_PER_TYPE, CRAWL_MAX_PAGES
+from history_store import history_store, diff_runs, HISTORY_PAGE_MAX
+from admission import admission, client_id, Rejected, ADMISSION_BATCH_SLOTS
+from job_queue import job_queue, start_local_workers, clamp_priority, JOB_BACKEND, JOB_DEFAULT_PRIORITY
+from job_worker import run_analysis_job
+from variant_compare import compare_variants, VARIANT_OPTIONS
+from cache_probe import start_probe, probe_settings, probe_tokens, PROBE_TIME_BUDGET
+from response_shaping import (UJSONProvider, shape_report, parse_fields, parse_flag, report_etag, etag_matches,
+                              compress_body, inline_script)
+from page_fetcher import FETCH_READ_TIMEOUT
+import metrics
 
 from logging_config import configure_logging
 
@@ -20,129 +37,71 @@ load_dotenv()  # Load environment variables from .env
 configure_logging()
 
 app = Flask(__name__)
+app.json = UJSONProvider(app)
 CORS(app)  # Enable CORS for cross-origin requests (required for frontend-backend communication)
 
-executor = ThreadPoolExecutor(max_workers=10)  # ThreadPoolExecutor for async PSI score fetching
-
 app.secret_key = os.getenv('SECRET_KEY', 'supersecretkey')
 API_KEY = os.getenv('API_KEY')
+FIELD_DATA_BATCH_MAX = int(os.getenv('FIELD_DATA_BATCH_MAX', 500))
 
 # Disable Werkzeug logging (optional)
 log = logging.getLogger('werkzeug')
 log.disabled = False
 
-# Helper functions and exclusion_list remain the same
-from exclusion_list import exclusion_list
-
-def strip_query_params(url):
-    """Helper function to remove query parameters from a URL."""
-    parsed_url = urlparse(url)
-    return parsed_url.path  # Return only the path without query parameters
-
-def categorize_script(script_src, script_id, plugin_or_theme, js_list):
-    """Categorizes the script based on the provided list for the specific plugin or theme."""
-    # Normalize to lowercase for consistency
-    plugin_or_theme = plugin_or_theme.lower()
-    script_src = script_src.lower()
-    script_id = script_id.lower()
-
-    log.debug(f"Processing script_src: {script_src}, script_id: {script_id}, plugin_or_theme: {plugin_or_theme}")
-
-    # Check if the script matches any of the JS files/IDs in the provided list for the specific plugin/theme
-    for js_item in js_list:
-        js_item = js_item.lower()  # Normalize JS item to lowercase
-        log.debug(f"Checking if {js_item} is in {script_src} or {script_id}")
-        if js_item in script_src or js_item in script_id:
-            log.debug(f"Match found: {js_item} for {plugin_or_theme}")
-            return plugin_or_theme, js_item  # Return the matching plugin/theme and JS item
-
-    # If no match is found, return None to indicate no match
-    return None, None
-
-
-def process_plugin_or_theme(soup, plugin_or_theme, exclusion_list):
-    """
-    Process all scripts for a specific plugin or theme, checking against the exclusion list.
-    Returns a list of recommendations (either 'Exclude from delay' or 'No changes needed').
-    """
-    recommendations = []
-    processed_scripts = set()  # Keep track of processed scripts to avoid duplication
-
-    plugin_or_theme = plugin_or_theme.lower()  # Normalize the plugin/theme name for consistent matching
-    log.debug(f"Processing plugin_or_theme: {plugin_or_theme}")
-
-    # Iterate over all <script> tags in the page source
-    for script in soup.find_all('script'):
-        script_src = strip_query_params(script.get('src', '')).lower()  # Normalize script src
-        script_id = script.get('id', '').lower()  # Normalize script ID
-        is_delayed = script.get('type') == 'pmdelayedscript'
-
-        log.debug(f"Script detected: src={script_src}, id={script_id}, delayed={is_delayed}")
-
-        # Check if the script matches the exclusion list for this plugin or theme
-        match_found, matched_script = categorize_script(script_src, script_id, plugin_or_theme, exclusion_list)
-
-        # If a match is found and hasn't been processed yet, determine the recommendation
-        if match_found and matched_script not in processed_scripts:
-            recommendation_identifier = script_id if script_id else matched_script  # Prioritize ID over matched_script
-            if is_delayed:
-                recommendations.append(f"{plugin_or_theme}: {recommendation_identifier} - Exclude from delay")
-            else:
-                recommendations.append(f"{plugin_or_theme}: {recommendation_identifier} - No changes needed")
-            processed_scripts.add(matched_script)
-
-    # For items in the exclusion list but not found in the page source
-    for js_item in exclusion_list:
-        if js_item not in processed_scripts:
-            recommendations.append(f"{plugin_or_theme}: {js_item} - Be aware of this: Not found in page source")
-
-    log.debug(f"Recommendations for {plugin_or_theme}: {recommendations}")
-    return recommendations
-
-
-
-def check_exclusions(page_source, loaded_plugins, loaded_themes):
+metrics.register_collector(http_counters)
+metrics.register_gauge(admission.gauges)
+metrics.register_gauge(lambda: {('jobs', (('status', status),)): count for status, count in job_queue.stats().items()})
+
+# Collect the stage timings of each request for its Server-Timing header
+@app.before_request
+def start_timing():
+    g.timings = metrics.start_request()
+    g.started = monotonic()
+
+@app.after_request
+def add_server_timing(response):
+    timings = getattr(g, 'timings', None)
+    if timings is not None and not response.is_streamed:
+        response.headers['Server-Timing'] = metrics.server_timing(timings + [('total', monotonic() - g.started)])
+    return response
+
+# gzip/brotli for JSON bodies, as the client's Accept-Encoding allows. Registered after add_server_timing so
+# it runs first and the compression time makes it into Server-Timing
+@app.after_request
+def compress_json(response):
+    if response.mimetype != 'application/json' or response.is_streamed or response.direct_passthrough \
+            or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    body, encoding = compress_body(response.get_data(), request.headers.get('Accept-Encoding'))
+    if encoding:
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+def report_options(data):
+    """(fields, include_inline) from a request's JSON body, falling back to the query string."""
+    data = data or {}
+    fields = parse_fields(data.get('fields', request.args.get('fields')))
+    return fields, parse_flag(data.get('include_inline', request.args.get('include_inline')))
+
+def report_response(report, fields=None, include_inline=True):
     """
-    Checks the page source for all loaded plugins and themes, processing exclusions for each.
+    A report shaped as the client asked, with a weak ETag over it; 304 without a body when the client's
+    If-None-Match already has that report.
     """
-    soup = BeautifulSoup(page_source, 'html.parser')
-    all_recommendations = []
-
-    # Print out loaded plugins and themes for debugging
-    log.info(f"Loaded plugins: {loaded_plugins}")
-    log.info(f"Loaded themes: {loaded_themes}")
-
-    # Process all plugins
-    for plugin in loaded_plugins:
-        plugin_key = f"plugins/{plugin.lower()}"  # Ensure case-insensitive comparison
-        if plugin_key in exclusion_list:
-            js_exclusion_list = exclusion_list[plugin_key]  # Get the JS list for the plugin
-            log.debug(f"Processing plugin: {plugin}")
-            recommendations = process_plugin_or_theme(soup, plugin, js_exclusion_list)
-            all_recommendations.extend(recommendations)
-
-    # Process all themes
-    for theme in loaded_themes:
-        theme_key = f"themes/{theme.lower()}"  # Ensure case-insensitive comparison
-        if theme_key in exclusion_list:
-            js_exclusion_list = exclusion_list[theme_key]  # Get the JS list for the theme
-            log.debug(f"Processing theme: {theme}")
-            recommendations = process_plugin_or_theme(soup, theme, js_exclusion_list)
-            all_recommendations.extend(recommendations)
-
-    return all_recommendations
-
-def flatten_recommendations(recommendations):
-    """Flattens the recommendation list for easy display."""
-    flattened = []
-    for rec in recommendations:
-        flattened.append(rec)
-    return flattened
+    report = shape_report(report, fields, include_inline)
+    etag = report_etag(report)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return app.response_class(status=304, headers={'ETag': etag})
+    response = jsonify(report)
+    response.headers['ETag'] = etag
+    return response
 
 @app.route('/pm_exclusions/')
 def pm_exclusions():
     try:
-        with open('pm_exclusions.py', 'r') as f:
+        with open(RULES_FILE, 'r') as f:
             content = f.read()
     except FileNotFoundError:
         content = ""  # If the file doesn't exist, start with an empty string
@@ -152,18 +111,11 @@ def pm_exclusions():
 def validate_syntax():
     content = request.form['editor_content']
     
-    # Save to temporary file for validation
-    temp_file = 'temp_validation.py'
-    with open(temp_file, 'w') as f:
-        f.write(content)
-    
-    # Use py_compile to check Python syntax
+    # Compile and check the rules in memory; nothing is written to disk
     try:
-        py_compile.compile(temp_file, doraise=True)
-        os.remove(temp_file)  # Remove the temp file if no error
+        parse_rules(content)
         return jsonify({"valid": True}), 200
-    except py_compile.PyCompileError as e:
-        os.remove(temp_file)  # Clean up temp file
+    except RulesError as e:
         # Return the error message in JSON format
         return jsonify({"valid": False, "error": str(e)}), 400
 
@@ -171,21 +123,55 @@ def validate_syntax():
 def save_pm_exclusions():
     content = request.form['editor_content']
     
-    # Save the Python file after validation
+    # Validate, then atomically replace the rules file; every worker picks the new version up on its next request
     try:
-        with open('pm_exclusions.py', 'w') as f:
-            f.write(content)
-        return jsonify({"message": "File saved successfully!"}), 200
+        version = save_rules(content)
+        exclusion_rules.wait_for_reload()
+        return jsonify({"message": "File saved successfully!", "version": version}), 200
+    except RulesError as e:
+        return jsonify({"error": f"Invalid rules: {e}"}), 400
     except Exception as e:
         return jsonify({"error": f"Failed to save file: {str(e)}"}), 500
 
+def cached_analysis(url, option, force_refresh=False):
+    """Serves the analysis of an option-modified URL from the result cache, or runs it (at most once across workers for a key)."""
+    response_data, cache_info = result_cache.get_or_compute(
+        result_key(url, option, exclusion_rules.snapshot().version), lambda validators: analyze_in_slot(url, validators), force_refresh=force_refresh
+    )
+    metrics.inc('result_cache_total', outcome=cache_info['outcome'])
+    return dict(response_data, result_cache=cache_info)
+
+def analyze_in_slot(url, validators=None):
+    """Runs the page analysis in one of the host's admission slots; cache hits never take one."""
+    with admission.slot():
+        return analyze_url(url, validators)
+
+def too_many_requests(e):
+    """The 429 for a request admission control turned away, with the Retry-After it suggests."""
+    app.logger.warning(f"Request not admitted ({e.reason}), retry after {e.retry_after}s")
+    return jsonify({"error": str(e), "retry_after": e.retry_after}), 429, {'Retry-After': str(e.retry_after)}
+
+def error_message(e):
+    """The client-facing message for a failed analysis, as /api/analyze reports it."""
+    if isinstance(e, (AnalysisError, Rejected)):
+        return str(e)
+    if isinstance(e, requests.exceptions.RequestException):
+        return f"Request failed: {e}"
+    return f"An unexpected error occurred: {e}"
+
 # API endpoint to analyze the URL and return JSON data
 @app.route('/api/analyze', methods=['POST'])
 def analyze():
     # Add logging at the beginning of the function
     app.logger.info("API request received for /api/analyze")
+    started = monotonic()
+    psi_futures = None
+    probe_future = None
     
     try:
+        # Turn the client away before any work when its request budget is spent
+        client = client_id(request.headers, request.remote_addr)
+        admission.take_token(client)
         data = request.json  # Get JSON data from the request
         app.logger.info(f"Request data: {data}")
         
@@ -198,124 +184,451 @@ def analyze():
             app.logger.warning(f"Invalid URL provided: {url}")
             return jsonify({"error": "Please enter a valid URL starting with https://"}), 400
 
+        # Response shaping: "fields" selects report fields, "include_inline": false sends inline scripts as hashes
+        try:
+            fields, include_inline = report_options(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
         # Modify URL based on options (if any)
         option = data.get('option', 'default')
-        if option == 'perfmattersoff':
-            url += '?perfmattersoff'
-        elif option == 'nocache':
-            url += '?nocache'
+        url = apply_option(url, option)
         app.logger.info(f"Modified URL with option '{option}': {url}")
 
-        # Initialize variables
-        js_ids = set()
-        css_ids = set()
-        inline_scripts = []
-        cache_status = ''
-        bigscoots_cache_status = ''
-        cache_plan = ''
-        performance_tools = ''
-        plugins = set()
-        themes = set()
-        recommendations = {}
-
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-        }
-
-        # Fetch the page and check cache statuses
-        app.logger.info(f"Sending request to {url}")
-        response = requests.get(url, headers=headers)
-        app.logger.info(f"Response status code: {response.status_code}")
-        response.raise_for_status()
-
-        cf_cache_status = response.headers.get('cf-cache-status', 'Not Found')
-        bigscoots_cache_status = response.headers.get('X-Bigscoots-Cache-Status', 'Not Found')
-        bigscoots_cache_plan = response.headers.get('x-bigscoots-cache-plan', '')
-        app.logger.info(f"Cache headers - CF: {cf_cache_status}, BigScoots: {bigscoots_cache_status}, Plan: {bigscoots_cache_plan}")
-
-        cache_status = f"CF-CACHE: {cf_cache_status}" if cf_cache_status else "CF-CACHE: Not Found"
-        bigscoots_cache_status = f"X-Bigscoots-Cache-Status: {bigscoots_cache_status}"
-
-        if bigscoots_cache_plan == 'Performance+':
-            cache_plan = "Performance Plus"
-
-        # Process page content
-        app.logger.info("Processing page content")
-        page_source = response.text.lower()
-        found_perfmatters = '/plugins/perfmatters' in page_source
-        found_wp_rocket = '/plugins/wp-rocket' in page_source
-        performance_tools = "Perfmatters + WP Rocket" if found_perfmatters and found_wp_rocket else "Perfmatters" if found_perfmatters else "WP Rocket" if found_wp_rocket else "No Perfmatters"
-        app.logger.info(f"Performance tools detected: {performance_tools}")
-
-        # Parse scripts and CSS IDs
-        app.logger.info("Parsing HTML with BeautifulSoup")
-        try:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            app.logger.info("Processing delayed scripts")
-            for script in soup.find_all('script', {'type': 'pmdelayedscript'}):
-                if not script.has_attr('src'):
-                    inline_scripts.append(str(script))
-
-            app.logger.info("Processing script IDs")
-            for script in soup.find_all('script', id=True):
-                if script['id'] and "perfmatters" not in script['id'] and not script['id'].endswith('-extra'):
-                    if script.get('type') == 'pmdelayedscript':
-                        js_ids.add(f"{script['id']} --- pmdelayed")
-                    else:
-                        js_ids.add(script['id'])
-
-            app.logger.info("Processing CSS IDs")
-            for link in soup.find_all('link', rel='stylesheet', attrs={'data-pmdelayedstyle': True}):
-                if link.has_attr('id'):
-                    css_ids.add(f"{link['id']} --- pmdelayedstyle")
-
-            app.logger.info("Extracting plugins and themes")
-            plugins.update(re.findall(r'/wp-content/plugins/([^/]+)', response.text))
-            themes.update(re.findall(r'/wp-content/themes/([^/]+)', response.text))
-        except Exception as bs_error:
-            app.logger.error(f"BeautifulSoup parsing error: {bs_error}")
-            return jsonify({"error": f"HTML parsing failed: {bs_error}"}), 500
-
-        # Check exclusions
-        app.logger.info("Checking for exclusions")
-        loaded_plugins = sorted(plugins)
-        loaded_themes = sorted(themes)
-        try:
-            recommendations = check_exclusions(page_source, loaded_plugins, loaded_themes)
-            flattened_recommendations = flatten_recommendations(recommendations)
-            app.logger.info(f"Generated {len(flattened_recommendations)} recommendations")
-        except Exception as exclusion_error:
-            app.logger.error(f"Error in exclusion checks: {exclusion_error}")
-            return jsonify({"error": f"Exclusion check failed: {exclusion_error}"}), 500
-
-        # Log the request (optional)
-        log_message = f"Cache Status: {cache_status}\n{bigscoots_cache_status}\nCache Plan: {cache_plan}"
-        app.logger.info(f"Logging request details for URL: {url}\n{log_message}")
-        log_request(url, log_message)
-
-        # Prepare response
-        response_data = {
-            "js_ids": sorted(js_ids),
-            "css_ids": sorted(css_ids),
-            "inline_scripts": inline_scripts,
-            "cache_status": cache_status,
-            "bigscoots_cache_status": bigscoots_cache_status,
-            "cache_plan": cache_plan,
-            "performance_tools": performance_tools,
-            "plugins": sorted(plugins),
-            "themes": sorted(themes),
-            "recommendations": flattened_recommendations
-        }
-        app.logger.info("Successfully processed request, returning response")
-        return jsonify(response_data)
-
+        # Optional cache-warmth probe: {"samples", "interval_ms", "concurrency"}
+        probe = data.get('probe')
+        if probe:
+            try:
+                probe = probe_settings(probe)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            # Every sample is a request to the site; the probe pays for them on top of the analysis's token
+            admission.take_token(client, probe_tokens(probe))
+
+        # Kick off the PSI runs and the probe first so they overlap the page fetch and parse
+        if run_psi:
+            psi_futures = start_cwv_scores(url, API_KEY)
+        if probe:
+            probe_future = start_probe(url, probe)
+
+        force_refresh = bool(data.get('force_refresh', False))
+        response_data = cached_analysis(url, option, force_refresh)
+        cache_info = response_data['result_cache']
+        if psi_futures:
+            with metrics.timed('psi_wait'):
+                response_data.update(collect_cwv_scores(psi_futures, PSI_BUDGET - (monotonic() - started)))
+            psi_futures = None
+        if probe_future:
+            # Never cached: the probe is about the cache state right now. The budget bounds when the last
+            # sample starts; allow one read timeout more for it to answer
+            try:
+                probe = probe_future.result(PROBE_TIME_BUDGET + FETCH_READ_TIMEOUT)
+            except Exception as e:
+                app.logger.error(f"Cache probe of {url} failed: {e}")
+                probe = {"error": f"Cache probe failed: {e}"}
+            response_data = dict(response_data, probe=probe)
+            probe_future = None
+        history_store.record_analysis(url, option, response_data)
+        app.logger.info(f"Successfully processed request ({cache_info['outcome']}), returning response")
+        return report_response(response_data, fields, include_inline)
+
+    except Rejected as e:
+        return too_many_requests(e)
+    except AnalysisError as e:
+        app.logger.error(str(e))
+        return jsonify({"error": str(e)}), 500
     except requests.exceptions.RequestException as e:
         app.logger.error(f"Request failed: {e}")
         return jsonify({"error": f"Request failed: {e}"}), 500
     except Exception as e:
         app.logger.error(f"Unexpected error in analyze endpoint: {e}", exc_info=True)
         return jsonify({"error": f"An unexpected error occurred: {e}"}), 500
+    finally:
+        # The analysis failed; stop waiting on PSI (shared runs still finish into the PSI cache)
+        for future in (psi_futures or {}).values():
+            future.cancel()
+        if probe_future:
+            probe_future.cancel()
+
+def sse(event, data):
+    """One Server-Sent Events message."""
+    return f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+
+# Progressive /api/analyze: a Server-Sent Events stream with one event per report stage as soon as it is
+# ready (cache, tools, assets, ids, recommendations, then psi/crux when requested), ending with 'done'
+# or 'error'. GET takes the same fields as query parameters so the browser's EventSource can use it.
+@app.route('/api/analyze/stream', methods=['GET', 'POST'])
+def analyze_stream():
+    try:
+        admission.take_token(client_id(request.headers, request.remote_addr))
+    except Rejected as e:
+        return too_many_requests(e)
+    data = (request.json or {}) if request.method == 'POST' else request.args
+    url = data.get('url')
+    if not isinstance(url, str) or not is_valid_url(url):
+        return jsonify({"error": "Please enter a valid URL starting with https://"}), 400
+
+    def flag(name):
+        return str(data.get(name, False)).lower() in ('true', '1')
+
+    option = data.get('option', 'default')
+    url = apply_option(url, option)
+    run_psi, run_crux, force_refresh = flag('run_psi'), flag('run_crux'), flag('force_refresh')
+    app.logger.info(f"Streaming analysis of {url}, Run PSI: {run_psi}, Run CrUX: {run_crux}")
+
+    def generate():
+        started = monotonic()
+        # Lab and field data run alongside the page analysis
+        psi_futures = start_cwv_scores(url, API_KEY) if run_psi else None
+        crux_future = submit(get_field_data_async(url, API_KEY)) if run_crux else None
+        try:
+            key = result_key(url, option, exclusion_rules.snapshot().version)
+            cached, age = (None, None) if force_refresh else result_cache.peek(key)
+            if cached is not None and age < result_cache.ttl:
+                for stage, fields in REPORT_STAGES:
+                    yield sse(stage, {field: cached[field] for field in fields})
+                cache_info = {'outcome': 'hit', 'age_seconds': round(age, 1)}
+                report = cached
+            else:
+                with admission.slot():
+                    for stage, fields in analyze_url_stages(url):
+                        if stage == 'report':
+                            result_cache.put(key, *fields)
+                            report = fields[0]
+                        else:
+                            yield sse(stage, fields)
+                cache_info = {'outcome': 'refresh' if force_refresh else 'miss', 'age_seconds': 0.0}
+            metrics.inc('result_cache_total', outcome=cache_info['outcome'])
+            report = dict(report, result_cache=cache_info)
+
+            if psi_futures:
+                psi = collect_cwv_scores(psi_futures, PSI_BUDGET - (monotonic() - started))
+                psi_futures = None
+                report.update(psi)
+                yield sse('psi', psi)
+            if crux_future:
+                report['field_data'] = collect_field_data(crux_future)
+                yield sse('crux', {"field_data": report['field_data']})
+            history_store.record_analysis(url, option, report)
+            yield sse('done', {"result_cache": cache_info, "elapsed_ms": round((monotonic() - started) * 1000)})
+        except Exception as e:
+            app.logger.error(f"Streaming analysis of {url} failed: {e}", exc_info=not isinstance(e, (AnalysisError, Rejected)))
+            error = {"error": error_message(e)}
+            if isinstance(e, Rejected):
+                error["retry_after"] = e.retry_after
+            yield sse('error', error)
+        finally:
+            for future in (psi_futures or {}).values():
+                future.cancel()
+
+    # X-Accel-Buffering: nginx forwards each event immediately instead of buffering the response
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'})
+
+# Bulk analysis: streams one NDJSON line per URL as soon as its report is ready, then a summary line.
+# Body: {"urls": ["https://...", {"url": "https://...", "option": "nocache"}, ...], "option": "default",
+#        "force_refresh": false, "concurrency": 8}
+@app.route('/api/analyze/batch', methods=['POST'])
+def analyze_batch():
+    # One token per URL; the first is taken now so a client with none left is turned away before streaming
+    client = client_id(request.headers, request.remote_addr)
+    try:
+        admission.take_token(client)
+    except Rejected as e:
+        return too_many_requests(e)
+    data = request.json or {}
+    default_option = data.get('option', 'default')
+    force_refresh = bool(data.get('force_refresh', False))
+    items = [entry if isinstance(entry, dict) else {'url': entry} for entry in data.get('urls') or []]
+    if not items:
+        return jsonify({"error": "Please provide a list of URLs"}), 400
+    if len(items) > BATCH_MAX_URLS:
+        return jsonify({"error": f"At most {BATCH_MAX_URLS} URLs per batch"}), 400
+    for item in items:
+        item['option'] = item.get('option', default_option)
+    try:
+        concurrency = int(data.get('concurrency', BATCH_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({"error": "concurrency must be an integer"}), 400
+    # However many the client asks for, a batch never holds more than its share of the host's slots
+    concurrency = min(concurrency, ADMISSION_BATCH_SLOTS)
+    app.logger.info(f"Batch of {len(items)} URLs, concurrency {concurrency}")
+    charged = itertools.count()
+
+    def analyze_item(item):
+        if next(charged):  # The first URL's token was taken with the request
+            admission.take_token(client)
+        url = apply_option(item['url'], item['option'])
+        result = cached_analysis(url, item['option'], force_refresh)
+        history_store.record_analysis(url, item['option'], result)
+        return result
+
+    def generate():
+        started = monotonic()
+        # Invalid URLs are reported straight away and never take a slot
+        valid = []
+        for index, item in enumerate(items):
+            if is_valid_url(item.get('url') or ''):
+                valid.append(dict(item, index=index))
+            else:
+                yield app.json.dumps({"index": index, "url": item.get('url'), "option": item['option'],
+                                      "error": "Please enter a valid URL starting with https://"}) + '\n'
+        failed = len(items) - len(valid)
+        # A sync worker is killed at gunicorn's --timeout, so the batch stops in time to say what it skipped
+        finished = set()
+        deadline = started + BATCH_TIME_BUDGET
+        for position, item, result, error in run_batch(valid, analyze_item, concurrency, BATCH_PER_HOST, deadline):
+            finished.add(position)
+            line = {"index": item['index'], "url": item['url'], "option": item['option']}
+            if error is None:
+                line["result"] = result
+            else:
+                failed += 1
+                app.logger.error(f"Batch item {item['url']} failed: {error}")
+                line["error"] = error_message(error)
+                if isinstance(error, Rejected):
+                    line["retry_after"] = error.retry_after
+            yield app.json.dumps(line) + '\n'
+        for position, item in enumerate(valid):
+            if position not in finished:
+                failed += 1
+                yield app.json.dumps({"index": item['index'], "url": item['url'], "option": item['option'],
+                                      "skipped": True, "error": "Not analyzed within the batch's time budget; "
+                                                                "queue long lists with /api/analyze/jobs"}) + '\n'
+        yield app.json.dumps({"done": True, "total": len(items), "ok": len(items) - failed, "errors": failed,
+                              "elapsed_ms": round((monotonic() - started) * 1000)}) + '\n'
+
+    # X-Accel-Buffering: nginx passes each line through instead of buffering the whole batch
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'})
+
+# Compare mode: analyzes several options of one URL at once and diffs each against the first (the baseline):
+# scripts whose Perfmatters delay differs, report fields, cache headers, fetch timing and sizes.
+# Body: {"url": "https://...", "options": ["default", "nocache", "perfmattersoff"], "force_refresh": false}
+@app.route('/api/analyze/compare', methods=['POST'])
+def analyze_compare():
+    data = request.json or {}
+    url = data.get('url')
+    if not isinstance(url, str) or not is_valid_url(url):
+        return jsonify({"error": "Please enter a valid URL starting with https://"}), 400
+    options = data.get('options') or list(VARIANT_OPTIONS)
+    # Element types first: set() needs hashable items and VARIANT_OPTIONS only holds strings
+    if not isinstance(options, list) or not all(isinstance(option, str) for option in options) \
+            or len(set(options)) != len(options) or len(options) < 2 \
+            or any(option not in VARIANT_OPTIONS for option in options):
+        return jsonify({"error": f"options must be two or more of {', '.join(VARIANT_OPTIONS)}"}), 400
+    try:
+        # Each variant is an analysis of its own; all the tokens are taken at once, so a refusal spends none
+        admission.take_token(client_id(request.headers, request.remote_addr), len(options))
+    except Rejected as e:
+        return too_many_requests(e)
+    force_refresh = bool(data.get('force_refresh', False))
+    app.logger.info(f"Comparing {', '.join(options)} for {url}")
+
+    def analyze_variant(option):
+        variant_url = apply_option(url, option)
+        result = cached_analysis(variant_url, option, force_refresh)
+        history_store.record_analysis(variant_url, option, result)
+        return result
+
+    comparison = compare_variants(options, analyze_variant)
+    errors = comparison.pop('errors')
+    for option, error in errors.items():
+        app.logger.error(f"Compare variant {option} of {url} failed: {error}")
+    if not comparison['variants']:
+        rejected = next((error for error in errors.values() if isinstance(error, Rejected)), None)
+        if rejected is not None:
+            return too_many_requests(rejected)
+        return jsonify({"error": error_message(next(iter(errors.values()))),
+                        "errors": {option: error_message(error) for option, error in errors.items()}}), 500
+    comparison["errors"] = {option: error_message(error) for option, error in errors.items()}
+    return jsonify(dict(url=url, **comparison))
+
+# Job-based analysis: queues the analysis and answers at once with the job id; the job_worker.py processes
+# run it. Body: the /api/analyze fields plus "run_crux" and "priority" (0-9, higher runs first). An identical
+# job that is still waiting or running is returned instead of queuing a second one.
+@app.route('/api/analyze/jobs', methods=['POST'])
+def create_analysis_job():
+    try:
+        admission.take_token(client_id(request.headers, request.remote_addr))
+    except Rejected as e:
+        return too_many_requests(e)
+    data = request.json or {}
+    url = data.get('url')
+    # Everything the worker will need is checked here: a bad job would only fail after waiting in the queue
+    if not isinstance(url, str) or not is_valid_url(url):
+        return jsonify({"error": "Please enter a valid URL starting with https://"}), 400
+    try:
+        priority = clamp_priority(data.get('priority', JOB_DEFAULT_PRIORITY))
+    except (TypeError, ValueError):
+        return jsonify({"error": "priority must be an integer"}), 400
+    option = data.get('option', 'default')
+    if not isinstance(option, str):
+        return jsonify({"error": "option must be a string"}), 400
+
+    url = apply_option(url, option)
+    payload = {"url": url, "option": option, "run_psi": bool(data.get('run_psi', False)),
+               "run_crux": bool(data.get('run_crux', False)), "force_refresh": bool(data.get('force_refresh', False))}
+    dedup_key = '|'.join([result_key(url, option, exclusion_rules.snapshot().version)] +
+                         [flag for flag in ('run_psi', 'run_crux', 'force_refresh') if payload[flag]])
+    try:
+        job_id, created = job_queue.enqueue(payload, priority, dedup_key)
+    except Rejected as e:
+        return too_many_requests(e)
+    if JOB_BACKEND == 'memory':
+        start_local_workers(job_queue, run_analysis_job)
+    app.logger.info(f"Analysis job {job_id} for {url} ({'queued' if created else 'already pending'}, priority {priority})")
+    return jsonify({"message": "Analysis job queued successfully" if created else "An identical analysis job is already pending",
+                    "job_id": job_id, "status_url": f"/api/analyze/jobs/{job_id}", "deduplicated": not created}), 202
+
+# Job state (waiting, active, completed, failed), progress by report stage, and the report once completed.
+# Finished jobs expire after JOB_RESULT_TTL.
+@app.route('/api/analyze/jobs/<job_id>', methods=['GET'])
+def analysis_job(job_id):
+    try:
+        fields, include_inline = report_options(None)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"status": "not found"}), 404
+    if job.get('result'):
+        job = dict(job, result=shape_report(job['result'], fields, include_inline))
+    return report_response(job)
+
+# The body of an inline script that a report with "include_inline": false listed by hash. Bodies never
+# change for a hash, so clients and proxies may keep them.
+@app.route('/api/inline-scripts/<digest>', methods=['GET'])
+def inline_script_body(digest):
+    if not re.fullmatch(r'[0-9a-fA-F]{32}', digest):
+        return jsonify({"error": "Not a script hash"}), 400
+    body = inline_script(digest)
+    if body is None:
+        return jsonify({"error": "Script not found or expired; analyze the page again"}), 404
+    response = jsonify({"hash": digest.lower(), "bytes": len(body.encode('utf-8')), "script": body})
+    response.set_etag(digest.lower())
+    response.headers['Cache-Control'] = 'public, max-age=86400, immutable'
+    return response.make_conditional(request)
+
+# Site crawl: samples pages per post type from the sitemaps and merges their findings into one report
+# Body: {"url": "https://...", "samples_per_type": 3, "max_pages": 500, "concurrency": 8}
+@app.route('/api/crawl', methods=['POST'])
+def crawl():
+    data = request.json or {}
+    url = data.get('url')
+    if not isinstance(url, str) or not is_valid_url(url):
+        return jsonify({"error": "Please enter a valid URL starting with https://"}), 400
+    try:
+        samples_per_type = int(data.get('samples_per_type', CRAWL_SAMPLES_PER_TYPE))
+        max_pages = int(data.get('max_pages', CRAWL_MAX_PAGES))
+        concurrency = int(data.get('concurrency', BATCH_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({"error": "samples_per_type, max_pages and concurrency must be integers"}), 400
+    # The request's token covers the sitemap reads; crawl_site takes one more per page
+    client = client_id(request.headers, request.remote_addr)
+    try:
+        admission.take_token(client)
+    except Rejected as e:
+        return too_many_requests(e)
+    app.logger.info(f"Crawling {url}: {samples_per_type} pages per type, at most {max_pages}")
+    try:
+        return jsonify(crawl_site(url, samples_per_type, max_pages, concurrency, client=client))
+    except Exception as e:
+        app.logger.error(f"Crawl of {url} failed: {e}", exc_info=True)
+        return jsonify({"error": error_message(e)}), 500
+
+# CrUX field data (origin level, optionally URL level) for one site
+@app.route('/api/field-data', methods=['POST'])
+def field_data():
+    data = request.json or {}
+    url = data.get('url')
+    if not isinstance(url, str) or not is_valid_url(url):
+        return jsonify({"error": "Please enter a valid URL starting with https://"}), 400
+    # Every lookup spends the shared CrUX quota, so it costs the client a token like an analysis
+    try:
+        admission.take_token(client_id(request.headers, request.remote_addr))
+    except Rejected as e:
+        return too_many_requests(e)
+    return jsonify(get_field_data(url, API_KEY, include_url=bool(data.get('include_url', False))))
+
+# CrUX field data for a list of sites (dashboards); queried concurrently and cached until the next daily update
+@app.route('/api/field-data/batch', methods=['POST'])
+def field_data_batch():
+    origins = (request.json or {}).get('origins') or []
+    if not isinstance(origins, list):
+        origins = [origins]
+    invalid = [origin for origin in origins if not isinstance(origin, str) or not is_valid_url(origin)]
+    if not origins or invalid:
+        return jsonify({"error": "Please provide a list of valid URLs starting with https://", "invalid": invalid}), 400
+    if len(origins) > FIELD_DATA_BATCH_MAX:
+        return jsonify({"error": f"At most {FIELD_DATA_BATCH_MAX} origins per batch"}), 400
+    # One token per distinct origin, all taken at once: a refused batch spends none
+    try:
+        admission.take_token(client_id(request.headers, request.remote_addr), len({origin_of(origin) for origin in origins}))
+    except Rejected as e:
+        return too_many_requests(e)
+    return jsonify(get_field_data_batch(origins, API_KEY))
+
+# A site's analysis history, newest first: GET /api/history?domain=example.com&limit=50&option=default.
+# Older pages: pass the next_before and next_before_id of the previous page as before= and before_id=.
+@app.route('/api/history', methods=['GET'])
+def history():
+    domain = request.args.get('domain', '').strip()
+    if not domain:
+        return jsonify({"error": "Please provide a domain"}), 400
+    try:
+        limit = int(request.args.get('limit', 50))
+        before = float(request.args['before']) if 'before' in request.args else None
+        before_id = int(request.args['before_id']) if 'before_id' in request.args else None
+    except ValueError:
+        return jsonify({"error": "limit and before_id must be integers and before a timestamp"}), 400
+    runs = history_store.timeline(domain, limit, before, request.args.get('option'), before_id)
+    last = runs[-1] if len(runs) == min(max(limit, 1), HISTORY_PAGE_MAX) else None
+    return jsonify({"domain": domain, "runs": runs, "next_before": last and last['analyzed_at'],
+                    "next_before_id": last and last['id']})
+
+# One stored run with its full report
+@app.route('/api/history/<int:run_id>', methods=['GET'])
+def history_run(run_id):
+    run = history_store.run(run_id)
+    if run is None:
+        return jsonify({"error": "Run not found"}), 404
+    return jsonify(run)
+
+# What changed between two runs: GET /api/history/diff?from=<id>&to=<id>, or ?domain=example.com for the
+# latest two runs of a site
+@app.route('/api/history/diff', methods=['GET'])
+def history_diff():
+    try:
+        if 'domain' in request.args:
+            ids = history_store.latest_ids(request.args['domain'], 2, request.args.get('option'))
+            if len(ids) < 2:
+                return jsonify({"error": "Fewer than two runs recorded for this domain"}), 404
+            to_id, from_id = ids
+        else:
+            from_id, to_id = int(request.args['from']), int(request.args['to'])
+    except (KeyError, ValueError):
+        return jsonify({"error": "Please provide from and to run ids, or a domain"}), 400
+    before, after = history_store.run(from_id), history_store.run(to_id)
+    if before is None or after is None:
+        return jsonify({"error": "Run not found"}), 404
+    return jsonify({
+        "from": {field: before[field] for field in ('id', 'url', 'option', 'analyzed_at')},
+        "to": {field: after[field] for field in ('id', 'url', 'option', 'analyzed_at')},
+        "changes": diff_runs(before['report'], after['report']),
+    })
+
+# Worker-local runtime statistics (outbound connection pools, result and PSI caches) and the host's admission queue
+@app.route('/api/stats', methods=['GET'])
+def stats():
+    return jsonify({"http": pool_stats(), "result_cache": result_cache.stats(), "psi_cache": psi_cache_stats(),
+                    "admission": admission.stats(), "jobs": job_queue.stats(), "rules_version": exclusion_rules.version})
+
+# Prometheus metrics, merged across every worker on the host: stage latency histograms (with p50/p95/p99),
+# errors, cache outcomes and bytes fetched. Scraped on the backend directly, not through the public site.
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import logging
+from time import monotonic
+from urllib.parse import parse_qs
+
+import aiohttp
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.datastructures import Headers
+
+from admission import admission, client_id, Rejected
+from cache_probe import start_probe, probe_settings, probe_tokens, PROBE_TIME_BUDGET
+from app import app as flask_app, API_KEY
+from analysis_handler import analyze_url_async, apply_option, AnalysisError
+from exclusion_rules import exclusion_rules
+from history_store import history_store
+from http_client import close_async_session
+from page_fetcher import FETCH_READ_TIMEOUT
+from psi_handler import start_cwv_scores, collect_cwv_scores_async, PSI_BUDGET
+from response_shaping import shape_report, parse_fields, parse_flag, report_etag, etag_matches, encode_json, compress_body
+from result_cache import result_cache, result_key
+from utils import is_valid_url
+import metrics
+
+# ASGI entry point. /api/analyze is served natively on the event loop so that waiting on a slow
+# origin does not pin a worker; every other route is handed to the Flask app unchanged.
+#
+#   gunicorn --workers 5 -k uvicorn.workers.UvicornWorker asgi:application
+
+wsgi_application = WsgiToAsgi(flask_app)
+
+
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def send_json(send, payload, status=200, timings=None, extra_headers=(), accept_encoding=None):
+    body, encoding = compress_body(encode_json(payload), accept_encoding)
+    headers = [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(body)).encode('ascii')),
+        (b'access-control-allow-origin', b'*'),
+        (b'vary', b'Accept-Encoding'),
+        *extra_headers,
+    ]
+    if encoding:
+        headers.append((b'content-encoding', encoding.encode('ascii')))
+    if timings:
+        headers.append((b'server-timing', metrics.server_timing(timings).encode('ascii')))
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers,
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_not_modified(send, etag):
+    await send({
+        'type': 'http.response.start',
+        'status': 304,
+        'headers': [(b'etag', etag.encode('ascii')), (b'access-control-allow-origin', b'*'), (b'vary', b'Accept-Encoding')],
+    })
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def analyze_in_slot(url, validators=None):
+    async with admission.slot_async():
+        return await analyze_url_async(url, validators)
+
+
+async def analyze(scope, receive, send):
+    """Async twin of app.analyze(); same request body, same response shape and error messages."""
+    logging.info("API request received for /api/analyze (async)")
+    started = monotonic()
+    timings = metrics.start_request()
+    psi_futures = None
+    probe_future = None
+    try:
+        headers = Headers([(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']])
+        client = client_id(headers, (scope.get('client') or (None,))[0])
+        await asyncio.to_thread(admission.take_token, client)
+        data = json.loads(await read_body(receive) or b'null')
+        logging.info(f"Request data: {data}")
+
+        url = data.get('url')
+        run_psi = data.get('run_psi', False)
+        logging.info(f"Processing URL: {url}, Run PSI: {run_psi}")
+
+        # Validate URL
+        if not is_valid_url(url):
+            logging.warning(f"Invalid URL provided: {url}")
+            return await send_json(send, {"error": "Please enter a valid URL starting with https://"}, 400)
+
+        query = {name: values[-1] for name, values in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+        try:
+            fields = parse_fields(data.get('fields', query.get('fields')))
+        except ValueError as e:
+            return await send_json(send, {"error": str(e)}, 400)
+        include_inline = parse_flag(data.get('include_inline', query.get('include_inline')))
+
+        probe = data.get('probe')
+        if probe:
+            try:
+                probe = probe_settings(probe)
+            except ValueError as e:
+                return await send_json(send, {"error": str(e)}, 400)
+            await asyncio.to_thread(admission.take_token, client, probe_tokens(probe))
+
+        option = data.get('option', 'default')
+        url = apply_option(url, option)
+        if run_psi:
+            psi_futures = start_cwv_scores(url, API_KEY)
+        if probe:
+            probe_future = start_probe(url, probe)
+        force_refresh = bool(data.get('force_refresh', False))
+
+        response_data, cache_info = await result_cache.get_or_compute_async(
+            result_key(url, option, exclusion_rules.snapshot().version), lambda validators: analyze_in_slot(url, validators), force_refresh=force_refresh
+        )
+        metrics.inc('result_cache_total', outcome=cache_info['outcome'])
+        response_data = dict(response_data, result_cache=cache_info)
+        if psi_futures:
+            with metrics.timed('psi_wait'):
+                response_data.update(await collect_cwv_scores_async(psi_futures, PSI_BUDGET - (monotonic() - started)))
+            psi_futures = None
+        if probe_future:
+            try:
+                probe = await asyncio.wait_for(asyncio.wrap_future(probe_future), PROBE_TIME_BUDGET + FETCH_READ_TIMEOUT)
+            except Exception as e:
+                logging.error(f"Cache probe of {url} failed: {e}")
+                probe = {"error": f"Cache probe failed: {e}"}
+            response_data = dict(response_data, probe=probe)
+            probe_future = None
+        history_store.record_analysis(url, option, response_data)
+        # Storing inline script bodies for include_inline=false touches SQLite; keep it off the loop
+        response_data = await asyncio.to_thread(shape_report, response_data, fields, include_inline)
+        etag = report_etag(response_data)
+        if etag_matches(headers.get('If-None-Match'), etag):
+            return await send_not_modified(send, etag)
+        await send_json(send, response_data, timings=timings + [('total', monotonic() - started)],
+                        extra_headers=[(b'etag', etag.encode('ascii'))], accept_encoding=headers.get('Accept-Encoding'))
+
+    except Rejected as e:
+        logging.warning(f"Request not admitted ({e.reason}), retry after {e.retry_after}s")
+        await send_json(send, {"error": str(e), "retry_after": e.retry_after}, 429,
+                        extra_headers=[(b'retry-after', str(e.retry_after).encode('ascii'))])
+    except AnalysisError as e:
+        logging.error(str(e))
+        await send_json(send, {"error": str(e)}, 500)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Request failed: {e}")
+        await send_json(send, {"error": f"Request failed: {e}"}, 500)
+    except Exception as e:
+        logging.error(f"Unexpected error in analyze endpoint: {e}", exc_info=True)
+        await send_json(send, {"error": f"An unexpected error occurred: {e}"}, 500)
+    finally:
+        for future in (psi_futures or {}).values():
+            future.cancel()
+        if probe_future:
+            probe_future.cancel()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_async_session()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and scope['path'] == '/api/analyze' and scope['method'] == 'POST':
+        return await analyze(scope, receive, send)
+    return await wsgi_application(scope, receive, send)
@@ -0,0 +1,51 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+
+from http_client import close_async_session
+
+# One long-lived event loop per worker process, running on a daemon thread. Sync Flask views hand it
+# coroutines (PSI runs) instead of spinning up a loop per call, so the aiohttp session bound to it
+# (http_client.get_async_session) and its keep-alive connections live as long as the worker.
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+
+def _run(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def get_loop():
+    """Returns the worker's background loop, starting it on first use (and again after a fork)."""
+    global _loop, _loop_pid
+    if _loop is None or _loop_pid != os.getpid():
+        with _loop_lock:
+            if _loop is None or _loop_pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=_run, args=(loop,), name='background-loop', daemon=True).start()
+                _loop, _loop_pid = loop, os.getpid()
+    return _loop
+
+
+def submit(coro):
+    """Schedules coro on the background loop and returns a concurrent.futures.Future for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def shutdown(timeout=5):
+    """Closes the loop's aiohttp session and stops the loop; registered to run at interpreter exit."""
+    if _loop is None or _loop_pid != os.getpid() or not _loop.is_running():
+        return
+    try:
+        submit(close_async_session()).result(timeout)
+    except Exception as e:
+        logging.warning(f"Failed to close the background loop's HTTP session: {e}")
+    _loop.call_soon_threadsafe(_loop.stop)
+
+
+atexit.register(shutdown)
@@ -0,0 +1,65 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import monotonic
+from urllib.parse import urlsplit
+
+# Runs many analyses with a per-batch concurrency limit and a per-host limit, yielding each outcome as soon
+# as it is ready. Every batch gets its own pool, so one batch never waits on another's threads; the limit
+# across batches is admission control's slots. Scheduling happens in the consuming thread, so a URL is only
+# handed to a pool thread once its host has a free slot and no pool thread ever sits blocked on a busy host.
+
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 8))  # Analyses in flight per batch (and the upper bound clients may ask for)
+BATCH_PER_HOST = int(os.getenv('BATCH_PER_HOST', 2))  # Analyses in flight against one host
+BATCH_MAX_URLS = int(os.getenv('BATCH_MAX_URLS', 1000))
+BATCH_TIME_BUDGET = float(os.getenv('BATCH_TIME_BUDGET', 100))  # Seconds a streamed batch runs; under gunicorn's --timeout (120)
+
+
+def host_of(url):
+    return (urlsplit(url).hostname or '').lower()
+
+
+def run_batch(items, task, concurrency=BATCH_CONCURRENCY, per_host=BATCH_PER_HOST, deadline=None):
+    """
+    Calls task(item) for every item, where item['url'] decides the host. Yields (index, item, result, error)
+    in completion order; exactly one of result/error is set, so one failing item never stops the batch.
+    At most `concurrency` tasks run at once, on threads of this batch's own pool. With a deadline (a
+    monotonic() time) nothing new starts after it, and the generator ends at the deadline even while
+    tasks are still running; their outcomes are never yielded.
+    """
+    concurrency = max(1, min(concurrency, BATCH_CONCURRENCY))
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch')
+    waiting = list(enumerate(items))
+    running = {}  # Future -> (index, item, host)
+    host_load = {}
+
+    def schedule():
+        position = 0
+        while len(running) < concurrency and position < len(waiting):
+            index, item = waiting[position]
+            host = host_of(item['url'])
+            if host_load.get(host, 0) >= per_host:
+                position += 1
+                continue
+            del waiting[position]
+            host_load[host] = host_load.get(host, 0) + 1
+            running[executor.submit(task, item)] = (index, item, host)
+
+    try:
+        schedule()
+        while running:
+            timeout = None if deadline is None else max(0.0, deadline - monotonic())
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                return  # Out of time
+            for future in done:
+                index, item, host = running.pop(future)
+                host_load[host] -= 1
+                try:
+                    yield index, item, future.result(), None
+                except Exception as e:
+                    yield index, item, None, e
+            if deadline is None or monotonic() < deadline:
+                schedule()
+    finally:
+        # The client went away (or the consumer stopped early); drop work that hasn't started
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,188 @@
+"""
+Concurrency benchmark: how many /api/analyze requests one gunicorn worker keeps in flight against a slow origin.
+
+Starts a local HTTPS origin that answers every request after --delay seconds, then runs the backend under
+gunicorn with a single worker, once with the default sync worker (app:app) and once with the uvicorn worker
+(asgi:application), and fires --requests concurrent analyses at each. The origin counts how many requests
+it is serving at the same time, which is exactly the number of analyses the worker has in flight.
+
+    cd backend
+    python benchmarks/concurrency.py --requests 40 --delay 2
+
+Requires gunicorn, uvicorn and the openssl CLI (for a throwaway certificate).
+"""
+import argparse
+import http.server
+import json
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PAGE = (
+    '<html><head><link rel="stylesheet" id="astra-theme-css-css" href="/wp-content/themes/astra/style.css?ver=4.1">'
+    '</head><body><script src="/wp-includes/js/jquery/jquery.min.js?ver=3.7.1" id="jquery-core-js"></script>'
+    '<script type="pmdelayedscript" src="/wp-content/plugins/elementor/assets/js/frontend.min.js" id="elementor-frontend-js"></script>'
+    '</body></html>'
+).encode('utf-8')
+
+
+class Origin(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, delay):
+        super().__init__(address, OriginHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def reset(self):
+        with self.lock:
+            self.in_flight = 0
+            self.max_in_flight = 0
+
+
+class OriginHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(PAGE)))
+            self.end_headers()
+            self.wfile.write(PAGE)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_certificate(directory):
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert, '-days', '1',
+         '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost'],
+        check=True, capture_output=True,
+    )
+    return cert, key
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"backend did not start on port {port}")
+
+
+def post_analyze(port, url):
+    request = urllib.request.Request(
+        f'http://127.0.0.1:{port}/api/analyze',
+        data=json.dumps({'url': url, 'force_refresh': True}).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+    )
+    started = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=600) as response:
+        response.read()
+        status = response.status
+    return status, time.perf_counter() - started
+
+
+def run_mode(name, target, worker_class, args, origin, origin_port, env):
+    port = free_port()
+    command = [sys.executable, '-m', 'gunicorn', '--workers', '1', '--bind', f'127.0.0.1:{port}',
+               '--timeout', '600', '--log-level', 'warning']
+    if worker_class:
+        command += ['-k', worker_class]
+    backend = subprocess.Popen(command + [target], cwd=BACKEND_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        origin.reset()
+        urls = [f'https://localhost:{origin_port}/{name}/page-{i}' for i in range(args.requests)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.requests) as pool:
+            results = list(pool.map(lambda url: post_analyze(port, url), urls))
+        wall = time.perf_counter() - started
+    finally:
+        backend.terminate()
+        backend.wait(timeout=30)
+
+    latencies = sorted(latency for _, latency in results)
+    return {
+        'mode': name,
+        'requests': args.requests,
+        'ok': sum(1 for status, _ in results if status == 200),
+        'wall_seconds': round(wall, 2),
+        'max_in_flight_per_process': origin.max_in_flight,
+        'p50_latency_seconds': round(latencies[len(latencies) // 2], 2),
+        'max_latency_seconds': round(latencies[-1], 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=40, help='concurrent /api/analyze calls per mode')
+    parser.add_argument('--delay', type=float, default=2.0, help='seconds the origin waits before answering')
+    parser.add_argument('--modes', default='sync,async', help='comma-separated subset of sync,async')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        cert, key = make_certificate(directory)
+        origin_port = free_port()
+        origin = Origin(('127.0.0.1', origin_port), args.delay)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        origin.socket = context.wrap_socket(origin.socket, server_side=True)
+        threading.Thread(target=origin.serve_forever, daemon=True).start()
+
+        # Every request goes to the same origin here, so lift the per-host connection cap that would
+        # otherwise (deliberately) limit concurrent fetches to one customer site
+        env = dict(os.environ, SSL_CERT_FILE=cert, REQUESTS_CA_BUNDLE=cert, FLASK_ENV='production',
+                   LOG_LEVEL='WARNING', RESULT_CACHE_DB=os.path.join(directory, 'results.sqlite3'),
+                   HTTP_POOL_PER_HOST=str(args.requests))
+        modes = {'sync': ('app:app', None), 'async': ('asgi:application', 'uvicorn.workers.UvicornWorker')}
+        results = []
+        for name in args.modes.split(','):
+            target, worker_class = modes[name]
+            results.append(run_mode(name, target, worker_class, args, origin, origin_port, env))
+        origin.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.requests} concurrent requests, origin delay {args.delay}s, 1 gunicorn worker")
+    print(f"{'mode':<8}{'ok':>5}{'wall s':>9}{'in flight':>11}{'p50 s':>8}{'max s':>8}")
+    for row in results:
+        print(f"{row['mode']:<8}{row['ok']:>5}{row['wall_seconds']:>9}{row['max_in_flight_per_process']:>11}"
+              f"{row['p50_latency_seconds']:>8}{row['max_latency_seconds']:>8}")
+
+
+if __name__ == '__main__':
+    main()
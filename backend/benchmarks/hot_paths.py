@@ -0,0 +1,299 @@
+"""
+Micro-benchmarks for the CPU-bound part of an analysis, run offline against the pages in benchmarks/corpus.
+
+Each benchmark runs on every corpus page:
+
+    extract           PageCollector over the raw bytes in fetch-sized chunks: the asset scan,
+                      decoding and the inventory parser (what analyze() does while the page streams in)
+    inventory         the inventory parser alone (html_inventory.build_inventory)
+    asset_scan        the single-pass byte scan for plugin/theme paths, ?ver= versions and markers alone
+    report_ids        delayed_js_ids + delayed_css_ids over the inventory
+    check_exclusions  check_exclusions for the page's plugins and themes (matcher, categorize_script, ...)
+    categorize_script categorize_script over every (script, plugin/theme) pair
+    flatten           flatten_recommendations over the page's recommendations
+
+and reports the median time per call, pages/s, MB/s, peak traced memory and the number of memory blocks
+the result keeps alive. Results can be saved as JSON and compared with an earlier run:
+
+    cd backend
+    python benchmarks/hot_paths.py --output before.json
+    python benchmarks/hot_paths.py --compare before.json     # exits 1 when something got slower
+
+--rules-scale N checks against an exclusion list N times the size of the live one, to see how the
+matching stages grow with the rules.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS_DIR = os.path.join(BACKEND_DIR, 'benchmarks', 'corpus')
+
+os.chdir(BACKEND_DIR)  # The rules file and log paths are relative to the backend directory
+sys.path.insert(0, BACKEND_DIR)
+logging.disable(logging.CRITICAL)  # The stages log at INFO; don't measure the log handlers
+
+from analysis_handler import check_exclusions, categorize_script, flatten_recommendations  # noqa: E402
+from exclusion_rules import compile_rules, RULES_FILE  # noqa: E402
+from html_inventory import build_inventory, delayed_js_ids, delayed_css_ids  # noqa: E402
+from page_fetcher import PageCollector, FETCH_CHUNK_SIZE  # noqa: E402
+
+
+def load_corpus(names=None):
+    """{name: raw bytes} for the corpus pages, smallest first."""
+    pages = {}
+    for filename in sorted(os.listdir(CORPUS_DIR)):
+        if not filename.endswith('.html.gz'):
+            continue
+        name = filename[:-len('.html.gz')]
+        if names and name not in names:
+            continue
+        with gzip.open(os.path.join(CORPUS_DIR, filename)) as f:
+            pages[name] = f.read()
+    return dict(sorted(pages.items(), key=lambda item: len(item[1])))
+
+
+def load_rules(path, scale):
+    """The rules snapshot to benchmark against; scale > 1 adds renamed copies of every key and pattern."""
+    with open(path) as f:
+        source = f.read()
+    rules = compile_rules(source, os.path.basename(path))
+    if scale <= 1:
+        return rules
+    exclusion_list = dict(rules.exclusion_list)
+    for copy in range(1, scale):
+        for key, patterns in rules.exclusion_list.items():
+            exclusion_list[f"{key}-copy{copy}"] = [f"{pattern}-copy{copy}" for pattern in patterns]
+    return compile_rules(f"exclusion_list = {exclusion_list!r}\n", os.path.basename(path))
+
+
+def collect(raw):
+    collector = PageCollector('text/html; charset=UTF-8')
+    for start in range(0, len(raw), FETCH_CHUNK_SIZE):
+        collector.feed_bytes(raw[start:start + FETCH_CHUNK_SIZE])
+    collector.close()
+    return collector
+
+
+def scan_assets(raw):
+    collector = PageCollector()
+    collector._scan(raw, final=True)
+    return collector.plugins, collector.themes, collector.markers, collector.asset_versions()
+
+
+def categorize_all(matches, targets):
+    return [categorize_script(script_matches, plugin_or_theme, key)
+            for script_matches in matches for plugin_or_theme, key in targets]
+
+
+def prepare(raw, rules):
+    """Per-page inputs for the later stages, computed once outside the timed calls."""
+    collector = collect(raw)
+    inventory = collector.inventory()
+    plugins, themes = sorted(collector.plugins), sorted(collector.themes)
+    targets = [(slug, f"{kind}/{slug.lower()}") for kind, slugs in (('plugins', plugins), ('themes', themes))
+               for slug in slugs if f"{kind}/{slug.lower()}" in rules.exclusion_list]
+    target_keys = {key for _, key in targets}
+    matches = [rules.matcher.first_matches(script.src.lower(), script.id.lower(), target_keys) for script in inventory.scripts]
+    recommendations = check_exclusions(inventory, plugins, themes, rules)
+    return dict(text=raw.decode('utf-8'), inventory=inventory, plugins=plugins, themes=themes,
+                targets=targets, matches=matches, recommendations=recommendations)
+
+
+# The benchmarks that go through the page source; MB/s is only meaningful for these
+BYTE_BENCHMARKS = ('extract', 'inventory', 'asset_scan')
+
+
+def benchmarks(raw, inputs, rules):
+    """{name: zero-argument callable} for one page."""
+    return {
+        'extract': lambda: collect(raw),
+        'inventory': lambda: build_inventory(inputs['text']),
+        'asset_scan': lambda: scan_assets(raw),
+        'report_ids': lambda: (delayed_js_ids(inputs['inventory']), delayed_css_ids(inputs['inventory'])),
+        'check_exclusions': lambda: check_exclusions(inputs['inventory'], inputs['plugins'], inputs['themes'], rules),
+        'categorize_script': lambda: categorize_all(inputs['matches'], inputs['targets']),
+        'flatten': lambda: flatten_recommendations(inputs['recommendations']),
+    }
+
+
+def measure(function, min_time, repeat):
+    """Median and best seconds per call over `repeat` rounds, each long enough to time reliably."""
+    # Calibrate (and warm up) first; the calibration rounds are not counted
+    iterations = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            function()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time or iterations >= 1_000_000:
+            break
+        iterations *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+
+    rounds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            function()
+        rounds.append((time.perf_counter() - started) / iterations)
+    return statistics.median(rounds), min(rounds), iterations
+
+
+def allocations(function):
+    """Peak traced memory during one call, and the blocks its result keeps alive."""
+    tracemalloc.start()
+    try:
+        result = function()
+        peak = tracemalloc.get_traced_memory()[1]
+        retained = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    finally:
+        tracemalloc.stop()
+    del result
+    return round(peak / 1024, 1), retained
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def corpus_digests(pages):
+    return {name: hashlib.sha256(raw).hexdigest()[:12] for name, raw in pages.items()}
+
+
+def run(args):
+    pages = load_corpus(args.pages.split(',') if args.pages else None)
+    rules = load_rules(args.rules, args.rules_scale)
+    selected = args.benchmarks.split(',') if args.benchmarks else None
+    results = []
+    for page_name, raw in pages.items():
+        inputs = prepare(raw, rules)
+        for name, function in benchmarks(raw, inputs, rules).items():
+            if selected and name not in selected:
+                continue
+            median, best, iterations = measure(function, args.min_time, args.repeat)
+            peak_kib, blocks = allocations(function)
+            results.append({
+                'benchmark': name,
+                'page': page_name,
+                'bytes': len(raw),
+                'iterations': iterations,
+                'median_seconds': median,
+                'best_seconds': best,
+                'pages_per_second': round(1 / median, 1) if median else None,
+                'mb_per_second': round(len(raw) / median / 1e6, 1) if median and name in BYTE_BENCHMARKS else None,
+                'alloc_peak_kib': peak_kib,
+                'alloc_blocks': blocks,
+            })
+            if not args.json:
+                print_row(results[-1])
+
+    return {
+        'meta': {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'corpus': corpus_digests(pages),
+            'rules_version': rules.version,
+            'rules_keys': len(rules.exclusion_list),
+            'rules_scale': args.rules_scale,
+            'min_time': args.min_time,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+
+
+def print_header():
+    print(f"{'benchmark':<18}{'page':<22}{'KiB':>7}{'median':>11}{'pages/s':>12}{'MB/s':>8}{'peak KiB':>10}{'blocks':>8}")
+
+
+def print_row(row):
+    print(f"{row['benchmark']:<18}{row['page']:<22}{row['bytes'] / 1024:>7.0f}{format_seconds(row['median_seconds']):>11}"
+          f"{row['pages_per_second']:>12}{row['mb_per_second'] or '-':>8}{row['alloc_peak_kib']:>10}{row['alloc_blocks']:>8}")
+
+
+def format_seconds(seconds):
+    if seconds >= 1:
+        return f"{seconds:.2f} s"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f} ms"
+    return f"{seconds * 1e6:.1f} us"
+
+
+def compare(current, baseline, tolerance):
+    """Prints the change against a saved run; returns the regressions beyond tolerance (a fraction)."""
+    baseline_corpus = baseline['meta'].get('corpus', {})
+    changed = [name for name, digest in current['meta']['corpus'].items() if baseline_corpus.get(name, digest) != digest]
+    if changed:
+        print(f"warning: the baseline was measured on different versions of {', '.join(changed)}")
+    if current['meta']['rules_version'] != baseline['meta'].get('rules_version') or \
+            current['meta']['rules_scale'] != baseline['meta'].get('rules_scale'):
+        print("warning: the baseline was measured against different rules")
+
+    previous = {(row['benchmark'], row['page']): row for row in baseline['results']}
+    regressions = []
+    print(f"\n{'benchmark':<18}{'page':<22}{'baseline':>11}{'current':>11}{'change':>9}")
+    for row in current['results']:
+        before = previous.get((row['benchmark'], row['page']))
+        if before is None:
+            continue
+        change = row['median_seconds'] / before['median_seconds'] - 1
+        best_change = row['best_seconds'] / before['best_seconds'] - 1
+        flag = ''
+        # Both the median and the best round must be slower, which filters out a noisy round or two
+        if change > tolerance and best_change > tolerance:
+            flag = '  REGRESSION'
+            regressions.append((row['benchmark'], row['page'], change))
+        print(f"{row['benchmark']:<18}{row['page']:<22}{format_seconds(before['median_seconds']):>11}"
+              f"{format_seconds(row['median_seconds']):>11}{change:>+9.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--benchmarks', help='comma-separated subset of the benchmarks to run')
+    parser.add_argument('--pages', help='comma-separated subset of the corpus pages')
+    parser.add_argument('--rules', default=RULES_FILE, help='exclusion rules file to check against')
+    parser.add_argument('--rules-scale', type=int, default=1, help='multiply the exclusion list N times')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per timing round')
+    parser.add_argument('--repeat', type=int, default=5, help='timing rounds per benchmark and page')
+    parser.add_argument('--output', help='save the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='slowdown (fraction) flagged as a regression')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON instead of a table')
+    args = parser.parse_args()
+
+    if not args.json:
+        print_header()
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) slower than the baseline by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+"""
+Regenerates the HTML corpus used by benchmarks/hot_paths.py.
+
+The pages are anonymized stand-ins for the WordPress sites we analyze, built from the markup patterns of
+real snapshots: Astra and GeneratePress blogs, an Elementor/JetMenu landing page, a Divi home page and a
+WooCommerce shop archive. Everything is generated from a fixed seed, so rerunning this script reproduces
+the checked-in files byte for byte; bump CORPUS_VERSION when the generator changes on purpose.
+
+    cd backend
+    python benchmarks/make_corpus.py
+"""
+import gzip
+import os
+import random
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+CORPUS_VERSION = 1
+SITE = 'https://example-site.com'
+
+LOREM = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore '
+         'et dolore magna aliqua ut enim ad minim veniam quis nostrud exercitation ullamco laboris').split()
+
+
+class Page:
+    def __init__(self, seed, theme, delay_ratio):
+        self.rng = random.Random(seed)
+        self.theme = theme
+        self.delay_ratio = delay_ratio
+        self.head = []
+        self.body = []
+        self.footer = []
+
+    def words(self, count):
+        return ' '.join(self.rng.choice(LOREM) for _ in range(count))
+
+    def version(self):
+        return f"{self.rng.randint(1, 9)}.{self.rng.randint(0, 20)}.{self.rng.randint(0, 9)}"
+
+    def delayed(self):
+        return self.rng.random() < self.delay_ratio
+
+    def stylesheet(self, handle, path, delayable=True):
+        attributes = ' data-pmdelayedstyle=""' if delayable and self.delayed() else ''
+        self.head.append(f"<link rel='stylesheet' id='{handle}-css' href='{SITE}{path}?ver={self.version()}'"
+                         f" media='all'{attributes} />")
+
+    def script(self, handle, path, where='footer', extra=None):
+        target = self.head if where == 'head' else self.footer
+        delayed = self.delayed()
+        script_type = " type='pmdelayedscript' data-cfasync='false' data-no-optimize='1' data-no-defer='1' data-no-minify='1'" if delayed else ''
+        if extra is not None:
+            target.append(f"<script{script_type} id='{handle}-js-extra'>\nvar {extra[0]} = {extra[1]};\n</script>")
+        target.append(f"<script{script_type} src='{SITE}{path}?ver={self.version()}' id='{handle}-js'></script>")
+
+    def inline(self, handle, code, where='footer'):
+        target = self.head if where == 'head' else self.footer
+        script_type = " type='pmdelayedscript'" if self.delayed() else ''
+        target.append(f"<script{script_type} id='{handle}'>\n{code}\n</script>")
+
+    def config(self, size):
+        pairs = ', '.join(f'"{self.rng.choice(LOREM)}_{index}":"{self.words(3)}"' for index in range(size))
+        return '{' + pairs + '}'
+
+    def render(self, title):
+        return '\n'.join([
+            '<!DOCTYPE html>',
+            '<html lang="en-US">',
+            '<head>',
+            '<meta charset="UTF-8">',
+            '<meta name="viewport" content="width=device-width, initial-scale=1">',
+            f'<title>{title}</title>',
+            "<meta name='robots' content='index, follow, max-image-preview:large' />",
+            '<script type="application/ld+json" class="yoast-schema-graph">'
+            + '{"@context":"https://schema.org","@graph":[' + ','.join(
+                '{"@type":"WebPage","@id":"%s/#%d","name":"%s"}' % (SITE, index, self.words(6)) for index in range(12))
+            + ']}</script>',
+            "<script>window._wpemojiSettings = {\"baseUrl\":\"https:\\/\\/s.w.org\\/images\\/core\\/emoji\\/15.0.3\\/72x72\\/\"};"
+            "!function(i,n){var o,s,e;function c(e){try{var t={supportTests:e,timestamp:(new Date).valueOf()};"
+            "sessionStorage.setItem(o,JSON.stringify(t))}catch(e){}}}(window,document);</script>",
+            *self.head,
+            f'<style id="{self.theme}-inline-css">' + ''.join(
+                f'.{self.theme}-c{index}{{color:#{self.rng.randrange(0xffffff):06x};margin:{index % 40}px}}' for index in range(150))
+            + '</style>',
+            '</head>',
+            f'<body class="home page-template-default page {self.theme}-theme wp-custom-logo">',
+            '<a class="skip-link screen-reader-text" href="#content">Skip to content</a>',
+            *self.body,
+            *self.footer,
+            "<script type='pmdelayedscript' id='perfmatters-delayed-scripts-js'>const pmDelayClick=true;"
+            "const pmDelayTimer=setTimeout(pmTriggerDOMListener,10*1000);</script>",
+            f"<script src='{SITE}/wp-content/plugins/perfmatters/js/lazyload.min.js?ver=2.3.1' id='perfmatters-lazy-load-js'></script>",
+            '</body>',
+            '</html>',
+        ])
+
+
+def wordpress_core(page, jquery=True):
+    page.stylesheet('wp-block-library', '/wp-includes/css/dist/block-library/style.min.css')
+    page.stylesheet('global-styles', '/wp-includes/css/global-styles.min.css', delayable=False)
+    if jquery:
+        page.script('jquery-core', '/wp-includes/js/jquery/jquery.min.js', where='head')
+        page.script('jquery-migrate', '/wp-includes/js/jquery/jquery-migrate.min.js', where='head')
+
+
+def post_content(page, paragraphs, images=True):
+    page.body.append('<main id="main" class="site-main"><article class="post type-post status-publish format-standard hentry">')
+    page.body.append(f'<h1 class="entry-title">{page.words(8).title()}</h1><div class="entry-content">')
+    for index in range(paragraphs):
+        page.body.append(f'<p>{page.words(page.rng.randint(40, 120))} <a href="{SITE}/{page.words(1)}-{index}/">{page.words(3)}</a></p>')
+        if images and index % 4 == 0:
+            page.body.append(
+                f'<figure class="wp-block-image size-large"><img decoding="async" width="1024" height="683" '
+                f'src="data:image/svg+xml,%3Csvg%20xmlns=\'http://www.w3.org/2000/svg\'%3E%3C/svg%3E" '
+                f'data-src="{SITE}/wp-content/uploads/2024/0{index % 9 + 1}/image-{index}.jpg" class="perfmatters-lazy" '
+                f'alt="{page.words(4)}" /></figure>')
+    page.body.append('</div></article></main>')
+
+
+def astra_blog():
+    page = Page(1, 'astra', delay_ratio=0.4)
+    wordpress_core(page)
+    page.stylesheet('astra-theme', '/wp-content/themes/astra/assets/css/minified/main.min.css', delayable=False)
+    page.stylesheet('contact-form-7', '/wp-content/plugins/contact-form-7/includes/css/styles.css')
+    page.body.append('<header class="site-header ast-primary-header-bar"><nav class="main-navigation"><ul id="primary-menu" class="main-header-menu">'
+                     + ''.join(f'<li class="menu-item"><a href="{SITE}/{word}/" class="menu-link">{word}</a></li>' for word in LOREM[:6])
+                     + '</ul></nav></header>')
+    post_content(page, 14)
+    page.script('astra-theme-js', '/wp-content/themes/astra/assets/js/minified/frontend.min.js',
+                extra=('astra', '{"break_point":"921","isRtl":"","is_scroll_to_id":"","is_scroll_to_top":""}'))
+    page.script('contact-form-7', '/wp-content/plugins/contact-form-7/includes/js/index.js',
+                extra=('wpcf7', '{"api":{"root":"https:\\/\\/example-site.com\\/wp-json\\/","namespace":"contact-form-7\\/v1"}}'))
+    page.script('complianz', '/wp-content/plugins/complianz-gdpr/cookiebanner/js/complianz.min.js',
+                extra=('complianz', page.config(20)))
+    return page.render('Astra blog post')
+
+
+def generatepress_post():
+    page = Page(2, 'generatepress', delay_ratio=0.6)
+    wordpress_core(page)
+    page.stylesheet('generate-style', '/wp-content/themes/generatepress/assets/css/main.min.css', delayable=False)
+    page.stylesheet('wpdiscuz-frontend', '/wp-content/plugins/wpdiscuz/themes/default/style.css')
+    page.stylesheet('wprm-public', '/wp-content/plugins/wp-recipe-maker/dist/public-modern.css')
+    post_content(page, 30)
+    page.body.append('<div class="wprm-recipe-container">' + ''.join(
+        f'<li class="wprm-recipe-ingredient">{page.words(5)}</li>' for _ in range(40)) + '</div>')
+    page.body.append('<div id="comments" class="wpdiscuz_top_clearing">' + ''.join(
+        f'<div class="wpd-comment" id="wpd-comm-{index}"><div class="wpd-comment-text"><p>{page.words(30)}</p></div></div>'
+        for index in range(60)) + '</div>')
+    page.script('generate-menu', '/wp-content/themes/generatepress/assets/js/menu.min.js',
+                extra=('generatepressMenu', '{"toggleOpenedSubMenus":true,"openSubMenuLabel":"Open Sub-Menu"}'))
+    page.script('wpdiscuz-combo', '/wp-content/plugins/wpdiscuz/assets/js/wpdiscuz-combo.min.js', extra=('wpdiscuzAjaxObj', page.config(80)))
+    page.script('wprm-public', '/wp-content/plugins/wp-recipe-maker/dist/public-modern.js', extra=('wprm_public', page.config(40)))
+    page.script('adthrive', '/wp-content/plugins/adthrive-ads/js/adthrive.min.js')
+    page.inline('adthrive-config', 'window.adthrive = window.adthrive || {}; adthrive.cmd = adthrive.cmd || []; '
+                + ' '.join(f'adthrive.cmd.push({index});' for index in range(50)))
+    return page.render('GeneratePress recipe post')
+
+
+def elementor_sections(page, sections, widgets):
+    for section in range(sections):
+        page.body.append(f'<div class="elementor-section elementor-top-section elementor-element elementor-element-{section:07x}" '
+                         f'data-id="{section:07x}" data-element_type="section" '
+                         f'data-settings="{{&quot;background_background&quot;:&quot;classic&quot;,&quot;animation&quot;:&quot;fadeInUp&quot;}}">'
+                         '<div class="elementor-container elementor-column-gap-default">')
+        for widget in range(widgets):
+            page.body.append(
+                f'<div class="elementor-column elementor-col-33 elementor-element" data-element_type="column">'
+                f'<div class="elementor-widget-wrap elementor-element-populated"><div class="elementor-element elementor-widget elementor-widget-text-editor" '
+                f'data-widget_type="text-editor.default"><div class="elementor-widget-container"><p>{page.words(25)}</p>'
+                f'<svg aria-hidden="true" class="e-font-icon-svg" viewBox="0 0 512 512"><path d="M{widget} {section}L256 {page.rng.randint(0, 512)}z"></path></svg>'
+                '</div></div></div></div>')
+        page.body.append('</div></div>')
+
+
+def elementor_landing():
+    page = Page(3, 'hello-elementor', delay_ratio=0.7)
+    wordpress_core(page)
+    page.stylesheet('hello-elementor', '/wp-content/themes/hello-elementor/style.min.css', delayable=False)
+    for handle in ('elementor-frontend', 'elementor-pro', 'jet-menu-public', 'jet-elements', 'swiper'):
+        page.stylesheet(handle, f'/wp-content/plugins/{handle.split("-")[0]}/assets/css/{handle}.min.css')
+    page.stylesheet('elementor-post-12', '/wp-content/uploads/elementor/css/post-12.css')
+    elementor_sections(page, 40, 3)
+    page.script('jet-menu-public', '/wp-content/plugins/jet-menu/assets/public/js/jet-menu-public-scripts.js',
+                extra=('jetMenuPublicSettings', page.config(30)))
+    page.script('jet-elements', '/wp-content/plugins/jet-elements/assets/js/jet-elements.min.js', extra=('jetElements', page.config(60)))
+    page.script('elementor-webpack-runtime', '/wp-content/plugins/elementor/assets/js/webpack.runtime.min.js')
+    page.script('elementor-frontend-modules', '/wp-content/plugins/elementor/assets/js/frontend-modules.min.js')
+    page.script('elementor-pro-webpack-runtime', '/wp-content/plugins/elementor-pro/assets/js/webpack-pro.runtime.min.js')
+    page.script('elementor-frontend', '/wp-content/plugins/elementor/assets/js/frontend.min.js',
+                extra=('elementorFrontendConfig', page.config(200)))
+    page.script('pro-elements-handlers', '/wp-content/plugins/elementor-pro/assets/js/elements-handlers.min.js',
+                extra=('ElementorProFrontendConfig', page.config(120)))
+    page.script('smartmenus', '/wp-content/plugins/elementor-pro/assets/lib/smartmenus/jquery.smartmenus.min.js')
+    page.script('imagesloaded', '/wp-includes/js/imagesloaded.min.js')
+    page.script('cookie-law-info', '/wp-content/plugins/cookie-law-info/legacy/public/js/cookie-law-info-public.js',
+                where='head', extra=('Cli_Data', page.config(15)))
+    page.inline('gtag', "window.dataLayer = window.dataLayer || []; function gtag(){dataLayer.push(arguments);} "
+                "gtag('js', new Date()); gtag('config', 'G-XXXXXXX'); // googletagmanager.com/gtag/js", where='head')
+    return page.render('Elementor landing page')
+
+
+def divi_home():
+    page = Page(4, 'divi', delay_ratio=0.5)
+    wordpress_core(page)
+    page.stylesheet('divi-style', '/wp-content/themes/Divi/style-static.min.css', delayable=False)
+    page.stylesheet('et-builder-googlefonts', '/wp-content/et-cache/fonts.css')
+    page.stylesheet('divi-pixel', '/wp-content/plugins/divi-pixel/styles/style.min.css')
+    for section in range(60):
+        page.body.append(f'<div class="et_pb_section et_pb_section_{section} et_section_regular"><div class="et_pb_row et_pb_row_{section}">')
+        for module in range(5):
+            page.body.append(f'<div class="et_pb_column et_pb_column_1_3 et_pb_column_{section}_{module}">'
+                             f'<div class="et_pb_module et_pb_text et_pb_text_{section}_{module} et_pb_text_align_left et_pb_bg_layout_light">'
+                             f'<div class="et_pb_text_inner"><p>{page.words(35)}</p></div></div></div>')
+        page.body.append('</div></div>')
+        page.body.append(f'<style id="et-builder-module-design-{section}">' + ''.join(
+            f'.et_pb_text_{section}_{module}{{padding:{module}px;font-size:{14 + module}px}}' for module in range(30)) + '</style>')
+    page.inline('et-animation', 'var et_animation_data = ' + page.config(150) + ';')
+    page.script('divi-custom-script', '/wp-content/themes/Divi/js/scripts.min.js', extra=('DIVI', page.config(100)))
+    page.script('et-builder-modules-script-motion', '/wp-content/themes/Divi/includes/builder/feature/dynamic-assets/assets/js/motion-effects.js')
+    page.script('magnific-popup', '/wp-content/themes/Divi/includes/builder/feature/dynamic-assets/assets/js/magnific-popup.js')
+    page.script('easypiechart', '/wp-content/themes/Divi/includes/builder/feature/dynamic-assets/assets/js/easypiechart.js')
+    page.script('dipi_preloader', '/wp-content/plugins/divi-pixel/dist/public/js/preloader.min.js',
+                extra=('dipi_preloader_config', '{".dipi_preloader_wrapper_outer":"fade"}'))
+    page.script('et-core-common', '/wp-content/themes/Divi/core/admin/js/common.js')
+    page.script('gform_gravityforms', '/wp-content/plugins/gravityforms/js/gravityforms.min.js', extra=('gform_i18n', page.config(40)))
+    page.script('gform_conditional_logic', '/wp-content/plugins/gravityforms/js/conditional_logic.min.js')
+    page.inline('et_pb_custom', 'var et_pb_custom = ' + page.config(80) + ';', where='head')
+    return page.render('Divi home page')
+
+
+def woocommerce_shop():
+    page = Page(5, 'oceanwp', delay_ratio=0.55)
+    wordpress_core(page)
+    page.stylesheet('oceanwp-style', '/wp-content/themes/oceanwp/assets/css/style.min.css', delayable=False)
+    for handle in ('woocommerce-layout', 'woocommerce-smallscreen', 'woocommerce-general', 'elementor-frontend', 'revslider-settings'):
+        plugin = 'revslider' if handle.startswith('revslider') else 'elementor' if handle.startswith('elementor') else 'woocommerce'
+        page.stylesheet(handle, f'/wp-content/plugins/{plugin}/assets/css/{handle}.css')
+    elementor_sections(page, 20, 3)
+    page.body.append('<ul class="products columns-4">')
+    for product in range(1200):
+        page.body.append(
+            f'<li class="product type-product post-{product} status-publish instock product_cat-{page.rng.choice(LOREM)} has-post-thumbnail shipping-taxable purchasable product-type-simple">'
+            f'<a href="{SITE}/product/{page.rng.choice(LOREM)}-{product}/" class="woocommerce-LoopProduct-link woocommerce-loop-product__link">'
+            f'<img loading="lazy" width="300" height="300" src="{SITE}/wp-content/uploads/2024/05/product-{product}-300x300.jpg" '
+            f'class="attachment-woocommerce_thumbnail size-woocommerce_thumbnail" alt="" />'
+            f'<h2 class="woocommerce-loop-product__title">{page.words(4).title()}</h2>'
+            f'<span class="price"><span class="woocommerce-Price-amount amount"><bdi><span class="woocommerce-Price-currencySymbol">&#36;</span>{page.rng.randint(5, 500)}.00</bdi></span></span></a>'
+            f'<a href="?add-to-cart={product}" data-quantity="1" class="button product_type_simple add_to_cart_button ajax_add_to_cart" '
+            f'data-product_id="{product}" data-product_sku="SKU-{product:05d}" rel="nofollow">Add to cart</a></li>')
+    page.body.append('</ul>')
+    page.script('wc-add-to-cart', '/wp-content/plugins/woocommerce/assets/js/frontend/add-to-cart.min.js',
+                extra=('wc_add_to_cart_params', page.config(10)))
+    page.script('woocommerce', '/wp-content/plugins/woocommerce/assets/js/frontend/woocommerce.min.js',
+                extra=('woocommerce_params', page.config(8)))
+    page.script('wc-cart-fragments', '/wp-content/plugins/woocommerce/assets/js/frontend/cart-fragments.min.js',
+                extra=('wc_cart_fragments_params', page.config(8)))
+    page.script('oceanwp-main', '/wp-content/themes/oceanwp/assets/js/theme.min.js', extra=('oceanwpLocalize', page.config(40)))
+    page.script('drop-down-mobile-menu', '/wp-content/themes/oceanwp/assets/js/drop-down-mobile-menu.min.js')
+    page.script('tp-tools', '/wp-content/plugins/revslider/public/assets/js/rbtools.min.js')
+    page.script('revmin', '/wp-content/plugins/revslider/public/assets/js/rs6.min.js')
+    page.inline('revslider-start-size', 'function setREVStartSize(e){window.RSIW=window.RSIW===undefined?window.innerWidth:window.RSIW;}'
+                ' window.RS_MODULES = window.RS_MODULES || {};', where='head')
+    page.script('elementor-frontend', '/wp-content/plugins/elementor/assets/js/frontend.min.js',
+                extra=('elementorFrontendConfig', page.config(200)))
+    page.script('borlabs-cookie', '/wp-content/plugins/borlabs-cookie/assets/javascript/borlabs-cookie.min.js',
+                where='head', extra=('borlabsCookieConfig', page.config(60)))
+    page.inline('wc-product-schema', '<!-- ' + page.words(20) + ' -->' + page.config(600))
+    return page.render('WooCommerce shop archive')
+
+
+PAGES = {
+    'astra-blog': astra_blog,
+    'generatepress-recipe': generatepress_post,
+    'elementor-landing': elementor_landing,
+    'divi-home': divi_home,
+    'woocommerce-shop': woocommerce_shop,
+}
+
+
+def main():
+    os.makedirs(CORPUS_DIR, exist_ok=True)
+    for name, build in PAGES.items():
+        html = build().encode('utf-8')
+        path = os.path.join(CORPUS_DIR, f"{name}.html.gz")
+        # mtime=0 keeps the gzip header, and so the checked-in file, identical across runs
+        with open(path, 'wb') as f, gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0, compresslevel=9) as gz:
+            gz.write(html)
+        print(f"{name:<22}{len(html) / 1024:>9.0f} KiB  ->  {os.path.getsize(path) / 1024:.0f} KiB gzipped")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Checks that every HTML parser backend extracts the same inventory: each corpus page (plus any extra .html
+files given) and a set of malformed snippets are parsed whole and in small chunks by every backend, and
+the scripts, stylesheets and delayed inline scripts are compared with html.parser's. Offsets are
+compared too for the backends that report them. Prints the parse time per backend and exits 1 on any
+difference, so it can gate a change to a parser:
+
+    cd backend
+    python benchmarks/parser_equivalence.py
+    python benchmarks/parser_equivalence.py --backends tokenizer saved-page.html
+
+Backends whose package is not installed (lxml) are skipped with a note.
+"""
+import argparse
+import os
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.join(BACKEND_DIR, 'benchmarks'))
+
+from hot_paths import load_corpus  # noqa: E402
+from html_inventory import PARSER_BACKENDS, create_parser  # noqa: E402
+
+REFERENCE = 'html.parser'
+CHUNK_SIZES = (7, 4096)  # Tiny chunks split every construct somewhere; 4 KiB is closer to the fetcher
+
+# Markup the tolerant parsers have to agree on: comments, raw text, odd quoting and cut-off constructs
+SNIPPETS = {
+    'comments': '<!-- <script src="/hidden.js"></script> --><script src="/a.js?ver=1"></script><!--x--  >',
+    'conditional': '<!--[if lt IE 9]><script src="/ie.js"></script><![endif]--><![if !IE]><link rel="stylesheet" href="/x.css"><![endif]>',
+    'raw_text': '<script>document.write("<script src=\'/b.js\'></scr" + "ipt>")</script><style>a:after{content:"<link rel=stylesheet href=/s.css>"}</style>',
+    'end_tag_spacing': '<script type="pmdelayedscript" id="late">x()</script  ><SCRIPT SRC="/UPPER.js"></SCRIPT>',
+    'attributes': '<script src=/a.js?x=1 id="one" id=two data-a=\'1&amp;2\' async defer class="b  a"></script>'
+                  '<link rel="preload stylesheet" href="/p.css" id=p data-pmdelayedstyle>',
+    'self_closing': '<script src="/s.js" /><link rel=stylesheet href=/l.css /><script type=pmdelayedscript id=e/>',
+    'attribute_markup': '<div data-html="<script src=/no.js></script>"></div><img alt=\'<link rel=stylesheet href=/no.css>\'>',
+    'malformed_tags': '<div class="a" <script src="/m.js"></script>< script src="/n.js"></script><a b="c"d>',
+    'declarations': '<!DOCTYPE html><?xml version="1.0"?><!bogus <script>><script src="/after.js"></script></ div>',
+    'unterminated_script': '<p>text<script type="pmdelayedscript" id="open">never closed <link rel=stylesheet href=/x.css>',
+    'unterminated_style': '<style>body{} <script src="/swallowed.js"></script>',
+    'unterminated_tag': '<script src="/ok.js"></script><link rel="stylesheet" href="/cut',
+    'unterminated_comment': '<script src="/ok.js"></script><!-- open comment <link rel=stylesheet href=/c.css> tail',
+    'trailing_lt': '<script src="/x.js"></script><',
+}
+
+# Snippets where a backend is known to read the markup differently from html.parser; reported, not failed
+KNOWN_DIFFERENCES = {
+    'lxml': {
+        'snippet:attributes': 'libxml2 keeps the first of duplicate attributes, html.parser the last',
+        'snippet:unterminated_script': 'libxml2 keeps the body of a <script> that never ends',
+    },
+}
+
+
+def parse(backend, text, chunk_size=None):
+    parser = create_parser(backend)
+    if chunk_size:
+        for start in range(0, len(text), chunk_size):
+            parser.feed(text[start:start + chunk_size])
+    else:
+        parser.feed(text)
+    parser.close()
+    return parser.inventory()
+
+
+def facts(inventory, offsets):
+    """The inventory as plain tuples; offsets are dropped for backends that don't report them."""
+    scripts = [tuple(script) if offsets else tuple(script)[:5] for script in inventory.scripts]
+    stylesheets = [tuple(link) if offsets else tuple(link)[:3] for link in inventory.stylesheets]
+    return {'scripts': scripts, 'stylesheets': stylesheets, 'delayed_inline': list(inventory.delayed_inline)}
+
+
+def differences(expected, actual):
+    """One line per fact that differs, naming the first differing entry."""
+    lines = []
+    for field, values in expected.items():
+        if values == actual[field]:
+            continue
+        index = next((i for i, (a, b) in enumerate(zip(values, actual[field])) if a != b), min(len(values), len(actual[field])))
+        lines.append(f"{field}: {len(values)} vs {len(actual[field])} entries, first difference at {index}: "
+                     f"{values[index] if index < len(values) else None!r} vs "
+                     f"{actual[field][index] if index < len(actual[field]) else None!r}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help='extra HTML files to check')
+    parser.add_argument('--backends', nargs='+', default=[name for name in PARSER_BACKENDS if name != REFERENCE],
+                        help='backends to check against html.parser')
+    args = parser.parse_args()
+
+    backends = []
+    for backend in args.backends:
+        try:
+            create_parser(backend)
+        except ImportError as e:
+            print(f"skipping {backend}: {e}")
+            continue
+        backends.append(backend)
+
+    documents = {name: raw.decode('utf-8') for name, raw in load_corpus().items()}
+    for path in args.files:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            documents[os.path.basename(path)] = f.read()
+    documents.update((f"snippet:{name}", text) for name, text in SNIPPETS.items())
+
+    timings = {backend: 0.0 for backend in [REFERENCE] + backends}
+    failures = 0
+    for name, text in documents.items():
+        started = time.perf_counter()
+        reference = parse(REFERENCE, text)
+        timings[REFERENCE] += time.perf_counter() - started
+        for backend in backends:
+            offsets = parse(backend, '<script></script>').scripts[0].start is not None
+            expected = facts(reference, offsets)
+            started = time.perf_counter()
+            inventory = parse(backend, text)
+            timings[backend] += time.perf_counter() - started
+            runs = [('whole', inventory)] + [(f"{size}-char chunks", parse(backend, text, size)) for size in CHUNK_SIZES]
+            for mode, result in runs:
+                lines = differences(expected, facts(result, offsets))
+                known = KNOWN_DIFFERENCES.get(backend, {}).get(name)
+                if lines and known:
+                    print(f"known difference, {backend} on {name} ({mode}): {known}")
+                elif lines:
+                    failures += 1
+                    print(f"MISMATCH {backend} on {name} ({mode}):")
+                    for line in lines:
+                        print(f"    {line}")
+
+    corpus_size = sum(len(text) for name, text in documents.items() if not name.startswith('snippet:'))
+    print(f"{len(documents)} documents, {corpus_size / 1024:.0f} KiB of pages")
+    for backend, seconds in timings.items():
+        print(f"{backend:<12}{seconds * 1000:>10.1f} ms{timings[REFERENCE] / seconds:>8.1f}x")
+    if failures:
+        print(f"{failures} mismatches")
+        sys.exit(1)
+    print("all backends agree")
+
+
+if __name__ == '__main__':
+    main()
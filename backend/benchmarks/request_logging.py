@@ -0,0 +1,116 @@
+"""
+Request logging overhead: reports built per second with the request log off, with the queued JSONL writer,
+and with the previous one-file-per-request write, plus the cost of the exclusion checks with DEBUG
+tracing off and on.
+
+    cd backend
+    python benchmarks/request_logging.py --page elementor-landing --seconds 3
+
+Everything is written to a temporary directory.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+import urllib.parse
+from datetime import datetime
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix='request-log-bench-')
+os.environ['REQUEST_LOG_DIR'] = os.path.join(WORK_DIR, 'requests')
+os.environ['METRICS_DIR'] = os.path.join(WORK_DIR, 'metrics')
+
+os.chdir(BACKEND_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.join(BACKEND_DIR, 'benchmarks'))
+
+import analysis_handler  # noqa: E402
+import utils  # noqa: E402
+from hot_paths import load_corpus, collect  # noqa: E402
+from request_log import request_log  # noqa: E402
+
+URL = 'https://example-site.com/'
+
+
+def legacy_log_request(url, **fields):
+    """The previous utils.log_request: one new file per analysis, written on the request thread."""
+    parsed_url = urllib.parse.urlparse(url)
+    cleaned_url = re.sub(r'\W+', '_', parsed_url.netloc + parsed_url.path)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    log_dir = os.path.join(WORK_DIR, 'legacy')
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    with open(os.path.join(log_dir, f"{cleaned_url}_{timestamp}.log"), 'w') as f:
+        f.write(f"URL: {url}\n\n")
+        f.write(f"Data:\n{fields}\n")
+
+
+def throughput(function, seconds):
+    """Calls per second over roughly `seconds`."""
+    function()  # Warm up
+    calls = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        function()
+        calls += 1
+    return calls / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--page', default='elementor-landing', help='corpus page to build reports for')
+    parser.add_argument('--seconds', type=float, default=2.0, help='seconds per measurement')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    # Real logger calls, but nothing emitted below WARNING: the production setup (hot_paths disables logging)
+    logging.disable(logging.NOTSET)
+    logging.basicConfig(level=logging.WARNING, handlers=[logging.NullHandler()], force=True)
+    raw = load_corpus([args.page])[args.page]
+    page = collect(raw).result(URL, 200, {})
+
+    def build():
+        analysis_handler.build_report(URL, page)
+
+    results = {}
+    utils.REQUEST_LOG_ENABLED = False
+    results['reports_per_second_log_off'] = throughput(build, args.seconds)
+    utils.REQUEST_LOG_ENABLED = True
+    results['reports_per_second_queued'] = throughput(build, args.seconds)
+    analysis_handler.log_request = legacy_log_request
+    results['reports_per_second_file_per_request'] = throughput(build, args.seconds)
+    analysis_handler.log_request = utils.log_request
+
+    # How fast the background writer drains a burst of records
+    started = time.perf_counter()
+    for _ in range(10000):
+        utils.log_request(URL, cache_status='CF-CACHE: HIT', plugins=['elementor'], recommendations=3)
+    request_log.close()
+    results['writer_records_per_second'] = 10000 / (time.perf_counter() - started)
+    results['records_dropped'] = request_log.dropped
+
+    inventory, plugins, themes = page.inventory, sorted(page.plugins), sorted(page.themes)
+    rules = analysis_handler.exclusion_rules.snapshot()
+
+    def check():
+        analysis_handler.check_exclusions(inventory, plugins, themes, rules)
+
+    results['check_exclusions_per_second_debug_off'] = throughput(check, args.seconds)
+    logging.getLogger(analysis_handler.__name__).setLevel(logging.DEBUG)
+    results['check_exclusions_per_second_debug_on'] = throughput(check, args.seconds)
+
+    results = {key: round(value, 1) if isinstance(value, float) else value for key, value in results.items()}
+    if args.json:
+        print(json.dumps(dict(page=args.page, **results), indent=2))
+        return
+    print(f"page: {args.page} ({len(raw) / 1024:.0f} KiB), logs in {WORK_DIR}")
+    for key, value in results.items():
+        print(f"{key:<42}{value:>12}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+/api/analyze response size and serialization time, before and after response shaping. For every corpus
+page the report is built offline and encoded as:
+
+    flask-json        Flask's default provider (json, sorted keys, ASCII escapes): the previous response
+    ujson             UJSONProvider, the full report
+    ujson-hashed      UJSONProvider with "include_inline": false (inline scripts as hashes and sizes)
+    +gzip / +br       the ujson bodies compressed as compress_body() would for that Accept-Encoding
+
+and the median encode time and the bytes on the wire are printed per page and variant:
+
+    cd backend
+    python benchmarks/response_size.py
+    python benchmarks/response_size.py --json
+
+Inline script bodies are stored in a temporary database, not the live cache.
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix='response-size-bench-')
+os.environ['RESULT_CACHE_DB'] = os.path.join(WORK_DIR, 'results.sqlite3')
+os.environ['METRICS_DIR'] = os.path.join(WORK_DIR, 'metrics')
+os.environ['REQUEST_LOG_ENABLED'] = 'false'
+
+os.chdir(BACKEND_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.join(BACKEND_DIR, 'benchmarks'))
+
+from flask import Flask  # noqa: E402
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+
+import response_shaping  # noqa: E402
+from analysis_handler import build_report  # noqa: E402
+from hot_paths import load_corpus, collect  # noqa: E402
+
+URL = 'https://example-site.com/'
+
+
+def median_seconds(function, repeat):
+    function()  # Warm up
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def measure_page(raw, repeat):
+    """{variant: (bytes, seconds)} for one corpus page."""
+    report, _ = build_report(URL, collect(raw).result(URL, 200, {}))
+    report = dict(report, result_cache={'outcome': 'miss', 'age_seconds': 0.0})
+    app = Flask(__name__)
+    default, fast = DefaultJSONProvider(app), response_shaping.UJSONProvider(app)
+    compact = {'separators': (',', ':')}  # What DefaultJSONProvider.response passes outside debug mode
+
+    results = {}
+    results['flask-json'] = (len(default.dumps(report, **compact).encode('utf-8')),
+                             median_seconds(lambda: default.dumps(report, **compact).encode('utf-8'), repeat))
+    variants = {
+        'ujson': lambda: fast.dumps(report).encode('utf-8'),
+        'ujson-hashed': lambda: fast.dumps(response_shaping.shape_report(report, include_inline=False)).encode('utf-8'),
+    }
+    for name, encode in variants.items():
+        body = encode()
+        results[name] = (len(body), median_seconds(encode, repeat))
+        for encoding in ('gzip', 'br') if response_shaping.brotli is not None else ('gzip',):
+            compressed, _ = response_shaping.compress_body(body, encoding)
+            # Timed as encode plus compress: what the request pays for the compressed body
+            results[f"{name}+{encoding}"] = (len(compressed), median_seconds(
+                lambda: response_shaping.compress_body(encode(), encoding), repeat))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pages', nargs='*', help='corpus pages to measure (default: all)')
+    parser.add_argument('--repeat', type=int, default=50, help='timed encodes per variant')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    results = {name: measure_page(raw, args.repeat) for name, raw in load_corpus(args.pages or None).items()}
+    if args.json:
+        print(json.dumps({page: {variant: {'bytes': size, 'ms': round(seconds * 1000, 3)}
+                                 for variant, (size, seconds) in variants.items()} for page, variants in results.items()}, indent=2))
+        return
+    for page, variants in results.items():
+        before = variants['flask-json']
+        print(page)
+        for variant, (size, seconds) in variants.items():
+            print(f"    {variant:<20}{size / 1024:>9.1f} KiB{size / before[0]:>7.0%}{seconds * 1000:>10.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import logging
+import math
+import os
+import statistics
+import time
+from array import array
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import http_client
+from page_fetcher import DEFAULT_HEADERS, FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT
+from utils import get_cwv_color, get_hit_ratio_color
+
+# Cache-warmth probe: fetches a URL N times (spaced and with bounded concurrency) and reports how often the
+# CDN and BigScoots caches answered with a HIT and how TTFB is distributed, instead of the single sample
+# one analysis gives. Only the response headers are waited for; the body is never downloaded. Samples
+# live in typed arrays (8 bytes per timing, 1 byte per cache status), so even a large probe stays small.
+# Samples are paid for with the client's rate limit tokens (probe_tokens), on top of the analysis's own.
+
+PROBE_MAX_SAMPLES = int(os.getenv('PROBE_MAX_SAMPLES', 100))
+PROBE_MAX_CONCURRENCY = int(os.getenv('PROBE_MAX_CONCURRENCY', 4))  # Samples in flight per probe
+PROBE_MIN_CONCURRENT_INTERVAL_MS = int(os.getenv('PROBE_MIN_CONCURRENT_INTERVAL_MS', 100))  # Spacing floor once samples overlap
+PROBE_SAMPLES_PER_TOKEN = int(os.getenv('PROBE_SAMPLES_PER_TOKEN', 20))  # Samples one rate limit token pays for
+PROBE_WORKERS = int(os.getenv('PROBE_WORKERS', 16))  # Sample threads shared by all probes of the worker
+PROBE_TIME_BUDGET = float(os.getenv('PROBE_TIME_BUDGET', 60))  # Samples not started by then are skipped
+PROBE_RUNNERS = int(os.getenv('PROBE_RUNNERS', 4))  # Probes scheduling samples at once per worker
+PROBE_DEFAULT_SAMPLES = 10
+PROBE_DEFAULT_INTERVAL_MS = 250
+
+CACHE_HEADERS = {'cf': 'cf-cache-status', 'bigscoots': 'X-Bigscoots-Cache-Status'}
+PERCENTILES = (50, 90, 99)
+
+probe_executor = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix='probe')
+# Schedulers get their own threads so a waiting probe never holds a sample thread
+probe_runner = ThreadPoolExecutor(max_workers=PROBE_RUNNERS, thread_name_prefix='probe-run')
+
+
+class ProbeSamples:
+    """
+    The samples of one probe, in sample order. Timings are float64 arrays (NaN for failed samples); cache
+    statuses are interned per probe and stored as one-byte codes, 0 meaning the header was absent.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.ttfb = array('d', [float('nan')]) * count  # Request start to first response byte, connection setup included
+        self.wait = array('d', [float('nan')]) * count  # Request sent to first byte: the origin's (or CDN's) think time
+        self.status = array('H', [0]) * count
+        self.cache = {name: array('B', [0]) * count for name in CACHE_HEADERS}
+        self.values = {name: [None] for name in CACHE_HEADERS}  # Code -> header value
+        self.errors = 0
+
+    def record(self, index, status, headers, timing):
+        final = timing['hops'][-1]
+        self.ttfb[index] = (final['headers'] - timing['started']) * 1000
+        self.wait[index] = timing['wait'] * 1000
+        self.status[index] = status
+        for name, header in CACHE_HEADERS.items():
+            value = headers.get(header)
+            if value is not None:
+                values = self.values[name]
+                value = value.upper()
+                if value not in values:
+                    values.append(value)
+                self.cache[name][index] = values.index(value)
+
+    def counts(self, name):
+        """{header value: samples} for one cache header, over the samples that got a response."""
+        counts = Counter(self.cache[name][index] for index in range(self.count) if self.status[index])
+        return {self.values[name][code] or 'Not Found': count for code, count in counts.most_common()}
+
+    def hit_ratio(self, name, start=0):
+        """Share of the answered samples from `start` on that were a HIT; None when the header never came."""
+        answered = [index for index in range(start, self.count) if self.status[index]]
+        if not answered or len(self.values[name]) == 1:
+            return None
+        hit = self.values[name].index('HIT') if 'HIT' in self.values[name] else -1
+        return round(sum(1 for index in answered if self.cache[name][index] == hit) / len(answered), 3)
+
+
+def percentiles(values):
+    """min/mean/max and the PERCENTILES of the non-NaN values, in one sort; None when there are none."""
+    values = [value for value in values if value == value]
+    if not values:
+        return None
+    if len(values) == 1:
+        cuts = values * 99
+    else:
+        cuts = statistics.quantiles(values, n=100, method='inclusive')
+    summary = {f"p{percentile}": round(cuts[percentile - 1], 2) for percentile in PERCENTILES}
+    summary.update(min=round(min(values), 2), mean=round(statistics.fmean(values), 2), max=round(max(values), 2))
+    return summary
+
+
+def take_sample(url):
+    """One GET of url, timed up to the response headers; returns (status code, headers, timing)."""
+    with http_client.record_timing() as timing:
+        response = http_client.get(url, headers=DEFAULT_HEADERS, stream=True, allow_redirects=True,
+                                   timeout=(FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT))
+    # Closing without reading drops the connection rather than download a body the probe doesn't need
+    response.close()
+    final = timing.hop
+    wait_seconds = final['headers'] - final['started'] - (final['connect'] or 0.0) - (final['tls'] or 0.0)
+    return response.status_code, response.headers, {'started': timing.started, 'hops': timing.hops, 'wait': wait_seconds}
+
+
+def run_probe(url, samples=PROBE_DEFAULT_SAMPLES, interval_ms=PROBE_DEFAULT_INTERVAL_MS, concurrency=1):
+    """
+    Takes `samples` samples of url, starting one every interval_ms (and never more than `concurrency` at
+    once), and returns the probe report: per-header status counts and hit ratios, TTFB percentiles, and
+    their grades.
+    """
+    samples = max(1, min(int(samples), PROBE_MAX_SAMPLES))
+    concurrency = max(1, min(int(concurrency), PROBE_MAX_CONCURRENCY))
+    interval = max(PROBE_MIN_CONCURRENT_INTERVAL_MS if concurrency > 1 else 0.0, float(interval_ms)) / 1000
+    probe = ProbeSamples(samples)
+    started = time.monotonic()
+    running = {}
+    taken = 0
+
+    def collect(done):
+        for future in done:
+            index = running.pop(future)
+            try:
+                probe.record(index, *future.result())
+            except Exception as e:
+                probe.errors += 1
+                logging.debug(f"Probe sample {index} of {url} failed: {e}")
+
+    while taken < samples and time.monotonic() - started < PROBE_TIME_BUDGET:
+        delay = started + taken * interval - time.monotonic()
+        if delay > 0:
+            collect(wait(running, timeout=delay, return_when=FIRST_COMPLETED)[0] if running else ())
+            if not running:
+                time.sleep(max(0.0, started + taken * interval - time.monotonic()))
+            continue
+        if len(running) >= concurrency:
+            collect(wait(running, return_when=FIRST_COMPLETED)[0])
+            continue
+        running[probe_executor.submit(take_sample, url)] = taken
+        taken += 1
+    collect(wait(running)[0])
+
+    ttfb = percentiles(probe.ttfb[:taken])
+    cache = {}
+    grades = {}
+    for name in CACHE_HEADERS:
+        hit_ratio = probe.hit_ratio(name)
+        cache[name] = {
+            'statuses': probe.counts(name),
+            'hit_ratio': hit_ratio,
+            # The first request is the one most likely to warm the cache; how often the rest hit
+            'warm_hit_ratio': probe.hit_ratio(name, start=1),
+        }
+        grades[f"{name}_hit_ratio"] = get_hit_ratio_color(hit_ratio)
+    if ttfb is not None:
+        grades.update({f"ttfb_{key}": get_cwv_color('TTFB', ttfb[key] / 1000) for key in ('p50', 'p90', 'p99')})
+    logging.info(f"Probed {url} {taken} times: CF hit ratio {cache['cf']['hit_ratio']}, TTFB p50 {ttfb and ttfb['p50']} ms")
+    return {
+        'samples': taken,
+        'skipped': samples - taken,
+        'errors': probe.errors,
+        'interval_ms': round(interval * 1000),
+        'concurrency': concurrency,
+        'cache': cache,
+        'ttfb_ms': ttfb,
+        'wait_ms': percentiles(probe.wait[:taken]),
+        'grades': grades,
+        'elapsed_ms': round((time.monotonic() - started) * 1000),
+    }
+
+
+def probe_settings(options):
+    """
+    Validates the "probe" object of a request ({samples, interval_ms, concurrency}, all optional) and
+    returns it with the defaults filled in; raises ValueError naming the bad field. Overlapping samples
+    (concurrency above 1) must be at least PROBE_MIN_CONCURRENT_INTERVAL_MS apart.
+    """
+    if options is True:
+        options = {}
+    if not isinstance(options, dict):
+        raise ValueError("probe must be an object with samples, interval_ms and concurrency")
+    settings = {}
+    limits = {'samples': (PROBE_DEFAULT_SAMPLES, 1, PROBE_MAX_SAMPLES),
+              'interval_ms': (PROBE_DEFAULT_INTERVAL_MS, 0, 60000),
+              'concurrency': (1, 1, PROBE_MAX_CONCURRENCY)}
+    for field, (default, low, high) in limits.items():
+        value = options.get(field, default)
+        if isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+            raise ValueError(f"probe.{field} must be a whole number from {low} to {high}")
+        settings[field] = value
+    if settings['concurrency'] > 1 and settings['interval_ms'] < PROBE_MIN_CONCURRENT_INTERVAL_MS:
+        raise ValueError(f"probe.interval_ms must be at least {PROBE_MIN_CONCURRENT_INTERVAL_MS} when probe.concurrency is above 1")
+    return settings
+
+
+def probe_tokens(settings):
+    """Rate limit tokens a probe costs: one per PROBE_SAMPLES_PER_TOKEN samples, started or not."""
+    return math.ceil(settings['samples'] / PROBE_SAMPLES_PER_TOKEN)
+
+
+def start_probe(url, settings):
+    """Starts run_probe in the background (so it overlaps the analysis) and returns its future."""
+    return probe_runner.submit(run_probe, url, **settings)
@@ -1,60 +1,184 @@
-import requests
+import aiohttp
+import asyncio
 import logging
+import os
+from concurrent.futures import wait
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
 
-def get_field_data(url, api_key):
-    platforms = ['mobile', 'desktop']
-    field_data_results = {}
+import ujson
+
+from background_loop import submit
+from http_client import get_async_session, HTTP_POOL_PER_HOST
+from result_cache import ResultCache, result_key
+from metrics import timed, inc
+
+CRUX_API_URL = "https://chromeuxreport.googleapis.com/v1/records:queryRecord"
+CRUX_METRICS = [
+    "largest_contentful_paint",
+    "first_contentful_paint",
+    "cumulative_layout_shift",
+    "experimental_time_to_first_byte"
+]
+FORM_FACTORS = {'mobile': 'PHONE', 'desktop': 'DESKTOP'}
+NOT_PRESENT = "Field Data Not Present"
+
+CRUX_UPDATE_HOUR_UTC = int(os.getenv('CRUX_UPDATE_HOUR_UTC', 4))  # CrUX API data is refreshed daily around this hour
+# Simultaneous CrUX queries per batch; every query goes to one host, so HTTP_POOL_PER_HOST caps this too
+CRUX_BATCH_CONCURRENCY = int(os.getenv('CRUX_BATCH_CONCURRENCY', HTTP_POOL_PER_HOST))
+CRUX_RETRIES = 2  # Retries after a 429 (per-minute quota) or 5xx
+CRUX_MAX_RETRY_WAIT = float(os.getenv('CRUX_MAX_RETRY_WAIT', 10))  # Longest a retry waits, whatever Retry-After asks for
+CRUX_TIMEOUT = float(os.getenv('CRUX_TIMEOUT', 60))  # Seconds a sync caller waits for one site's field data
+CRUX_BATCH_TIMEOUT = float(os.getenv('CRUX_BATCH_TIMEOUT', 90))  # Seconds a batch gets; origins not done by then come back as None
+
+# Field data per (origin or URL, form factor), shared by the workers; an entry is valid until the next daily update
+crux_cache = ResultCache(ttl=86400, lru_size=1024, max_age=2 * 86400, table='crux_results')
+
+
+def last_crux_update(now=None):
+    """The most recent daily CrUX update boundary at or before now (a UTC datetime)."""
+    now = now or datetime.now(timezone.utc)
+    boundary = now.replace(hour=CRUX_UPDATE_HOUR_UTC, minute=0, second=0, microsecond=0)
+    return boundary if boundary <= now else boundary - timedelta(days=1)
 
-    for platform in platforms:
-        crux_api_url = f"https://chromeuxreport.googleapis.com/v1/records:queryRecord?key={api_key}"
-        form_factor = "PHONE" if platform == 'mobile' else "DESKTOP"
-        
-        crux_payload = {
-            "origin": url,
-            "formFactor": form_factor,
-            "metrics": [
-                "largest_contentful_paint",
-                "first_contentful_paint",
-                "cumulative_layout_shift",
-                "experimental_time_to_first_byte"
-            ]
+
+def origin_of(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def parse_field_data(crux_data, url, platform):
+    if 'record' in crux_data and 'metrics' in crux_data['record']:
+        field_data_metrics = crux_data['record']['metrics']
+
+        def get_metric_value(metric_key):
+            value = field_data_metrics.get(metric_key, {}).get('percentiles', {}).get('p75', 'N/A')
+            try:
+                return float(value) / 1000 if isinstance(value, (int, float)) else value
+            except (ValueError, TypeError):
+                return value
+
+        field_data = {
+            'FCP': get_metric_value('first_contentful_paint'),
+            'LCP': get_metric_value('largest_contentful_paint'),
+            'CLS': field_data_metrics.get('cumulative_layout_shift', {}).get('percentiles', {}).get('p75', 'N/A'),
+            'TTFB': get_metric_value('experimental_time_to_first_byte')
         }
 
+        logging.info(f"Field Data for {url} ({platform}): FCP = {field_data['FCP']}s, LCP = {field_data['LCP']}s, CLS = {field_data['CLS']}, TTFB = {field_data['TTFB']}s")
+        return field_data
+
+    logging.info(f"Field Data not available for {url} ({platform}).")
+    return NOT_PRESENT
+
+
+async def query_crux_record(target, level, platform, api_key):
+    """
+    Queries one CrUX record; level is 'origin' or 'url'. Returns the field data dict, NOT_PRESENT when CrUX has
+    no record, or None on failure. Answers are cached until the next daily CrUX update.
+    """
+    key = result_key(target, f"{level}-{platform}")
+    cached, age = await asyncio.to_thread(crux_cache.peek, key)
+    if cached is not None:
+        stored_at = datetime.now(timezone.utc) - timedelta(seconds=age)
+        if stored_at >= last_crux_update():
+            inc('crux_cache_total', outcome='hit')
+            return cached['field_data']
+    inc('crux_cache_total', outcome='miss')
+
+    crux_payload = {level: target, "formFactor": FORM_FACTORS[platform], "metrics": CRUX_METRICS}
+    session = get_async_session()
+    for attempt in range(CRUX_RETRIES + 1):
         try:
-            crux_response = requests.post(crux_api_url, json=crux_payload)
-            if crux_response.status_code == 404:
-                logging.info(f"Field Data not available for {url} ({platform}).")
-                field_data_results[platform] = "Field Data Not Present"
-            else:
-                crux_response.raise_for_status()
-                crux_data = crux_response.json()
-
-                if 'record' in crux_data and 'metrics' in crux_data['record']:
-                    field_data_metrics = crux_data['record']['metrics']
-
-                    def get_metric_value(metric_key):
-                        value = field_data_metrics.get(metric_key, {}).get('percentiles', {}).get('p75', 'N/A')
-                        try:
-                            return float(value) / 1000 if isinstance(value, (int, float)) else value
-                        except (ValueError, TypeError):
-                            return value
-
-                    field_data = {
-                        'FCP': get_metric_value('first_contentful_paint'),
-                        'LCP': get_metric_value('largest_contentful_paint'),
-                        'CLS': field_data_metrics.get('cumulative_layout_shift', {}).get('percentiles', {}).get('p75', 'N/A'),
-                        'TTFB': get_metric_value('experimental_time_to_first_byte')
-                    }
-
-                    logging.info(f"Field Data for {url} ({platform}): FCP = {field_data['FCP']}s, LCP = {field_data['LCP']}s, CLS = {field_data['CLS']}, TTFB = {field_data['TTFB']}s")
-                    field_data_results[platform] = field_data
+            async with session.post(CRUX_API_URL, params={'key': api_key}, json=crux_payload) as crux_response:
+                if crux_response.status == 404:
+                    field_data = parse_field_data({}, target, platform)
+                elif (crux_response.status == 429 or crux_response.status >= 500) and attempt < CRUX_RETRIES:
+                    retry_after = crux_response.headers.get('Retry-After', '')
+                    wait_time = min(float(retry_after) if retry_after.isdigit() else 2 ** attempt, CRUX_MAX_RETRY_WAIT)
+                    logging.info(f"CrUX returned {crux_response.status} for {target} ({platform}), retrying in {wait_time}s")
+                    await asyncio.sleep(wait_time)
+                    continue
                 else:
-                    logging.info(f"Field Data not available for {url} ({platform}).")
-                    field_data_results[platform] = "Field Data Not Present"
+                    crux_response.raise_for_status()
+                    field_data = parse_field_data(await crux_response.json(loads=ujson.loads), target, platform)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Error fetching Field Data for {target} ({platform}): {e}")
+            inc('stage_errors_total', stage='crux')
+            return None
+
+        await asyncio.to_thread(crux_cache.put, key, {'field_data': field_data})
+        return field_data
+
 
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Error fetching Field Data for {url} ({platform}): {e}")
-            field_data_results[platform] = None
+async def get_field_data_async(url, api_key, include_url=False):
+    """
+    Origin-level field data for both form factors, queried concurrently: {'mobile': ..., 'desktop': ...}.
+    With include_url the URL-level records are fetched in the same round and returned under 'url_level'.
+    """
+    origin = origin_of(url)
+    queries = [(origin, 'origin', platform) for platform in FORM_FACTORS]
+    if include_url:
+        queries += [(url, 'url', platform) for platform in FORM_FACTORS]
+    with timed('crux'):
+        results = await asyncio.gather(*(query_crux_record(target, level, platform, api_key) for target, level, platform in queries))
 
+    field_data_results = {}
+    for (_, level, platform), field_data in zip(queries, results):
+        if level == 'origin':
+            field_data_results[platform] = field_data
+        else:
+            field_data_results.setdefault('url_level', {})[platform] = field_data
     return field_data_results
 
+
+async def get_field_data_batch_async(origins, api_key, concurrency=CRUX_BATCH_CONCURRENCY, timeout=None):
+    """
+    Field data for many origins, at most `concurrency` CrUX queries in flight. Returns {origin: field data}.
+    Queries not finished within timeout seconds are cancelled and count as failed (None), so the origins
+    already answered are still returned.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded_query(origin, platform):
+        async with semaphore:
+            return await query_crux_record(origin, 'origin', platform, api_key)
+
+    origins = list(dict.fromkeys(origin_of(url) for url in origins))
+    tasks = [asyncio.ensure_future(bounded_query(origin, platform)) for origin in origins for platform in FORM_FACTORS]
+    pending = ()
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logging.error(f"Field Data batch: {len(pending)} of {len(tasks)} queries did not finish within {timeout}s")
+        inc('stage_errors_total', len(pending), stage='crux')
+    pairs = iter(None if task in pending else task.result() for task in tasks)
+    return {origin: {platform: next(pairs) for platform in FORM_FACTORS} for origin in origins}
+
+
+def collect_field_data(future, timeout=CRUX_TIMEOUT):
+    """
+    The field data of a get_field_data_async future, waiting at most timeout seconds. A lookup still running
+    then is cancelled and counts as failed (None per form factor), like a query that errored.
+    """
+    wait([future], timeout=max(timeout, 0))
+    if future.done():
+        return future.result()
+    future.cancel()
+    logging.error(f"Field Data lookup did not finish within {timeout}s")
+    inc('stage_errors_total', stage='crux')
+    return {platform: None for platform in FORM_FACTORS}
+
+
+def get_field_data(url, api_key, include_url=False):
+    """Blocking wrapper for sync callers; runs on the worker's background event loop, for at most CRUX_TIMEOUT."""
+    return collect_field_data(submit(get_field_data_async(url, api_key, include_url)))
+
+
+def get_field_data_batch(origins, api_key, concurrency=CRUX_BATCH_CONCURRENCY, timeout=CRUX_BATCH_TIMEOUT):
+    """Blocking wrapper for sync callers; the batch stops waiting on CrUX after timeout seconds."""
+    future = submit(get_field_data_batch_async(origins, api_key, concurrency, timeout))
+    # The coroutine enforces the timeout itself; the margin only covers handing the result back
+    return future.result(timeout + 5)
@@ -0,0 +1,90 @@
+from collections import deque
+
+
+class ExclusionMatcher:
+    """
+    Aho-Corasick automaton over every pattern in the exclusion list.
+
+    Patterns are lowercased and deduplicated once at load time, and a reverse index maps each pattern
+    to the (key, position) pairs that own it, so a single scan of a script's src and id yields every
+    plugin/theme hit regardless of how many keys share a pattern such as 'jquery.min.js'.
+    """
+
+    def __init__(self, exclusion_list):
+        self.patterns = []  # Unique lowercased patterns, indexed by pattern id
+        self.owners = []  # Pattern id -> list of (exclusion_list key, position in that key's list)
+        self._goto = [{}]  # State -> {char: next state}
+        self._fail = [0]
+        self._output = [()]  # State -> pattern ids that end in this state (including via fail links)
+        self._empty = ()  # Pattern ids of empty patterns, which match any text
+
+        pattern_ids = {}
+        for key, js_list in exclusion_list.items():
+            for position, js_item in enumerate(js_list):
+                pattern = js_item.lower()
+                if pattern not in pattern_ids:
+                    pattern_ids[pattern] = len(self.patterns)
+                    self.patterns.append(pattern)
+                    self.owners.append([])
+                self.owners[pattern_ids[pattern]].append((key, position))
+
+        for pattern_id, pattern in enumerate(self.patterns):
+            if not pattern:
+                self._empty += (pattern_id,)
+                continue
+            self._add(pattern, pattern_id)
+        self._link()
+
+    def _add(self, pattern, pattern_id):
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+                self._goto[state][char] = next_state
+            state = next_state
+        self._output[state] += (pattern_id,)
+
+    def _link(self):
+        """Computes failure links breadth-first and folds each state's fail outputs into its own."""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                self._output[next_state] += self._output[self._fail[next_state]]
+
+    def scan(self, text, hits=None):
+        """Returns the set of pattern ids found anywhere in the (already lowercased) text."""
+        if hits is None:
+            hits = set(self._empty)
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                hits.update(output[state])
+        return hits
+
+    def first_matches(self, script_src, script_id, keys):
+        """
+        Scans a script's lowercased src and id once and returns {key: matched pattern} for each key in keys,
+        where the matched pattern is the earliest entry of that key's list found in either string.
+        """
+        hits = self.scan(script_id, self.scan(script_src))
+        best = {}
+        for pattern_id in hits:
+            for key, position in self.owners[pattern_id]:
+                if key in keys and (key not in best or position < best[key][0]):
+                    best[key] = (position, self.patterns[pattern_id])
+        return {key: pattern for key, (position, pattern) in best.items()}
@@ -0,0 +1,165 @@
+import ast
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from exclusion_matcher import ExclusionMatcher
+
+# The live exclusion rules. They are read from RULES_FILE as data (the `exclusion_list = {...}` literal,
+# never executed), saved atomically by the /pm_exclusions/ editor, and picked up by every worker without a
+# restart: each request stats the file and a changed file is recompiled on a background thread while
+# requests keep using the previous rules.
+
+RULES_FILE = os.getenv('RULES_FILE', 'pm_exclusions.py')
+RULES_HISTORY_DIR = os.getenv('RULES_HISTORY_DIR', 'rules_history')  # Every saved version is kept here
+RULES_HISTORY_KEEP = int(os.getenv('RULES_HISTORY_KEEP', 50))
+RULES_VARIABLE = 'exclusion_list'
+
+# One compiled generation of the rules; version is a content hash, so every worker agrees on it
+RulesSnapshot = namedtuple('RulesSnapshot', ['version', 'exclusion_list', 'matcher', 'loaded_at'])
+
+
+class RulesError(Exception):
+    """Raised when rules source is not valid Python or not an exclusion list; the message is shown in the editor."""
+
+
+def rules_version(source):
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()[:12]
+
+
+def parse_rules(source, filename=RULES_FILE):
+    """
+    Validates rules source in memory and returns the exclusion list it defines.
+    The source must compile, and its `exclusion_list` must be a literal dict of str -> list of str.
+    """
+    try:
+        tree = compile(source, filename, 'exec', ast.PyCF_ONLY_AST)
+    except SyntaxError as e:
+        raise RulesError(f"{e.msg} ({filename}, line {e.lineno})") from e
+
+    value = None
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == RULES_VARIABLE for target in node.targets):
+            value = node.value
+    if value is None:
+        raise RulesError(f"{filename} does not define {RULES_VARIABLE}")
+    try:
+        exclusion_list = ast.literal_eval(value)
+    except ValueError as e:
+        raise RulesError(f"{RULES_VARIABLE} must be a literal dict of lists of strings, with no names or calls (line {value.lineno})") from e
+
+    if not isinstance(exclusion_list, dict):
+        raise RulesError(f"{RULES_VARIABLE} must be a dict")
+    for key, js_list in exclusion_list.items():
+        if not isinstance(key, str) or not isinstance(js_list, list) or not all(isinstance(item, str) for item in js_list):
+            raise RulesError(f"{RULES_VARIABLE}[{key!r}] must map a string to a list of strings")
+    return exclusion_list
+
+
+def compile_rules(source, filename=RULES_FILE):
+    exclusion_list = parse_rules(source, filename)
+    return RulesSnapshot(rules_version(source), exclusion_list, ExclusionMatcher(exclusion_list), time.time())
+
+
+def file_identity(path):
+    """What changes when the file is replaced or rewritten; a stat call, no read."""
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def save_rules(source, path=RULES_FILE):
+    """
+    Validates source and atomically replaces the rules file with it (temp file, fsync, rename), keeping a
+    copy in RULES_HISTORY_DIR. Readers see either the old file or the new one, never a partial write.
+    Returns the new version.
+    """
+    parse_rules(source, os.path.basename(path))
+    version = rules_version(source)
+    directory = os.path.dirname(os.path.abspath(path))
+
+    with open(os.path.join(directory, '.rules.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # Serialize saves from different workers
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.rules-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(source)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        archive_rules(source, version, path)
+
+    logging.info(f"Saved exclusion rules version {version} to {path}")
+    return version
+
+
+def archive_rules(source, version, path):
+    os.makedirs(RULES_HISTORY_DIR, exist_ok=True)
+    stem, extension = os.path.splitext(os.path.basename(path))
+    with open(os.path.join(RULES_HISTORY_DIR, f"{stem}.{time.strftime('%Y%m%d_%H%M%S')}.{version}{extension}"), 'w') as f:
+        f.write(source)
+    archived = sorted(name for name in os.listdir(RULES_HISTORY_DIR) if name.startswith(stem + '.'))
+    for name in archived[:-RULES_HISTORY_KEEP]:
+        os.remove(os.path.join(RULES_HISTORY_DIR, name))
+
+
+class ExclusionRules:
+    """A worker's view of the rules file: the current snapshot plus a background reload when the file changes."""
+
+    def __init__(self, path=RULES_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._reloading = False
+        self._identity = file_identity(path)
+        with open(path) as f:
+            self._current = compile_rules(f.read(), os.path.basename(path))
+        logging.info(f"Loaded exclusion rules version {self._current.version} ({len(self._current.exclusion_list)} keys)")
+
+    @property
+    def version(self):
+        return self._current.version
+
+    def snapshot(self):
+        """The rules to use for this request. Costs one stat; a changed file is recompiled in the background."""
+        try:
+            identity = file_identity(self.path)
+        except OSError:
+            return self._current  # Mid-replace or removed; keep serving what we have
+        if identity != self._identity:
+            with self._lock:
+                if identity != self._identity and not self._reloading:
+                    self._reloading = True
+                    threading.Thread(target=self._reload, args=(identity,), name='rules-reload', daemon=True).start()
+        return self._current
+
+    def _reload(self, identity):
+        try:
+            with open(self.path) as f:
+                snapshot = compile_rules(f.read(), os.path.basename(self.path))
+            self._current = snapshot
+            logging.info(f"Reloaded exclusion rules version {snapshot.version} ({len(snapshot.exclusion_list)} keys)")
+        except (OSError, RulesError) as e:
+            # A hand-edited file that doesn't parse: keep the last good rules, don't retry until it changes again
+            logging.error(f"Keeping exclusion rules version {self._current.version}; reload failed: {e}")
+        finally:
+            with self._lock:
+                self._identity = identity
+                self._reloading = False
+
+    def wait_for_reload(self, timeout=5):
+        """Blocks until a pending reload has finished (after a save in this worker)."""
+        deadline = time.monotonic() + timeout
+        self.snapshot()
+        while self._reloading and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self._current
+
+
+exclusion_rules = ExclusionRules()
@@ -0,0 +1,233 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import urlsplit
+
+# Analysis history: every new analysis of a URL (and any PSI/CrUX numbers that came with it) is kept in a
+# SQLite file shared by the workers, so /api/history can show how a site changed over time. Requests only
+# enqueue the run; a writer thread per worker inserts them in batches. Timelines read a small summary
+# column through the (domain, analyzed_at) index and full runs are compressed, so both stay fast with
+# millions of rows.
+
+HISTORY_ENABLED = os.getenv('HISTORY_ENABLED', 'true').lower() in ('true', '1')
+HISTORY_DB = os.getenv('HISTORY_DB', os.path.join('data', 'history.sqlite3'))
+HISTORY_MAX_AGE_DAYS = float(os.getenv('HISTORY_MAX_AGE_DAYS', 365))  # Older runs are pruned by the writer
+HISTORY_QUEUE_SIZE = int(os.getenv('HISTORY_QUEUE_SIZE', 10000))
+HISTORY_BATCH = 200
+HISTORY_FLUSH_INTERVAL = 1.0  # Seconds a run may wait for its batch
+HISTORY_PRUNE_INTERVAL = 3600
+HISTORY_PAGE_MAX = 500
+
+# Report fields compared as sets between two runs, and as single values
+SET_FIELDS = ('plugins', 'themes', 'performance_plugins', 'js_ids', 'css_ids', 'recommendations')
+VALUE_FIELDS = ('cache_status', 'bigscoots_cache_status', 'cache_plan', 'performance_tools', 'rules_version', 'truncated')
+
+
+def domain_of(url):
+    """The host a run is filed under; www. is dropped so both spellings share a timeline."""
+    host = (urlsplit(url).hostname or '').lower()
+    return host[4:] if host.startswith('www.') else host
+
+
+def run_payload(response_data):
+    """What is kept of a report: everything but the inline script bodies, which are reduced to a count."""
+    payload = {field: value for field, value in response_data.items() if field not in ('inline_scripts', 'result_cache')}
+    payload['inline_scripts'] = len(response_data.get('inline_scripts') or [])
+    return payload
+
+
+def run_summary(payload):
+    """The timeline row: counts and headline numbers only."""
+    summary = {field: payload.get(field) for field in ('cache_status', 'performance_tools', 'rules_version')}
+    summary.update({f"{field}_count": len(payload.get(field) or []) for field in SET_FIELDS})
+    scores = payload.get('cwv_scores') or {}
+    summary['psi_scores'] = {platform: values.get('overall_score') for platform, values in scores.items()}
+    probe = payload.get('probe') or {}
+    if probe.get('ttfb_ms'):
+        summary['probe'] = {'samples': probe['samples'], 'cf_hit_ratio': probe['cache']['cf']['hit_ratio'],
+                            'ttfb_p50_ms': probe['ttfb_ms']['p50']}
+    return summary
+
+
+def diff_runs(before, after):
+    """Field-by-field changes from run `before` to run `after` (both full payloads)."""
+    changes = {}
+    for field in SET_FIELDS:
+        old, new = set(before.get(field) or []), set(after.get(field) or [])
+        if old != new:
+            changes[field] = {'added': sorted(new - old), 'removed': sorted(old - new)}
+    for field in VALUE_FIELDS:
+        if before.get(field) != after.get(field):
+            changes[field] = {'from': before.get(field), 'to': after.get(field)}
+    for section in ('plugin_versions', 'theme_versions', 'cwv_scores', 'field_data'):
+        old, new = before.get(section) or {}, after.get(section) or {}
+        section_changes = {}
+        for platform in sorted(set(old) | set(new)):
+            old_values, new_values = old.get(platform), new.get(platform)
+            if old_values == new_values:
+                continue
+            if isinstance(old_values, dict) and isinstance(new_values, dict):
+                section_changes[platform] = {metric: {'from': old_values.get(metric), 'to': new_values.get(metric)}
+                                             for metric in sorted(set(old_values) | set(new_values))
+                                             if old_values.get(metric) != new_values.get(metric)}
+            else:
+                section_changes[platform] = {'from': old_values, 'to': new_values}
+        if section_changes:
+            changes[section] = section_changes
+    return changes
+
+
+class HistoryStore:
+    def __init__(self, db_path=HISTORY_DB, queue_size=HISTORY_QUEUE_SIZE):
+        self.db_path = db_path
+        self.queue_size = queue_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._queue = None
+        self._writer = None
+        self._pid = None
+        self.dropped = 0
+        self._init_db()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _init_db(self):
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS runs ('
+            'id INTEGER PRIMARY KEY, domain TEXT NOT NULL, url TEXT NOT NULL, option TEXT NOT NULL, '
+            'analyzed_at REAL NOT NULL, summary TEXT NOT NULL, payload BLOB NOT NULL)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS runs_domain_time ON runs (domain, analyzed_at)')
+        connection.execute('CREATE INDEX IF NOT EXISTS runs_time ON runs (analyzed_at)')
+
+    # Writing
+
+    def record_analysis(self, url, option, response_data):
+        """Files a response when it is a new analysis or carries PSI/CrUX/probe numbers; plain result cache repeats are skipped."""
+        outcome = (response_data.get('result_cache') or {}).get('outcome')
+        fresh = response_data.get('cwv_scores') or response_data.get('field_data') or response_data.get('probe')
+        if HISTORY_ENABLED and (outcome not in ('hit', 'coalesced') or fresh):
+            self.record(url, option, response_data)
+
+    def record(self, url, option, response_data, analyzed_at=None):
+        """Queues a run for the writer. Never blocks; when the writer has fallen behind the run is dropped."""
+        if self._pid != os.getpid():
+            self._start()
+        payload = run_payload(response_data)
+        row = (domain_of(url), url, option or 'default', analyzed_at or time.time(),
+               json.dumps(run_summary(payload), separators=(',', ':')),
+               zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8')))
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._local = threading.local()  # Connections don't survive a fork
+            self._queue = queue.Queue(self.queue_size)
+            self._writer = threading.Thread(target=self._run, name='history-writer', daemon=True)
+            self._pid = os.getpid()
+            self._writer.start()
+
+    def _run(self):
+        last_prune = float('-inf')
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+            while len(batch) < HISTORY_BATCH:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            stop = None in batch
+            rows = [row for row in batch if row is not None]
+            try:
+                self._insert(rows)
+                if time.monotonic() - last_prune > HISTORY_PRUNE_INTERVAL:
+                    last_prune = time.monotonic()
+                    self._connection().execute('DELETE FROM runs WHERE analyzed_at < ?',
+                                               (time.time() - HISTORY_MAX_AGE_DAYS * 86400,))
+            except sqlite3.Error as e:
+                logging.error(f"Could not store {len(rows)} history runs: {e}")
+            if stop:
+                return
+
+    def _insert(self, rows):
+        if not rows:
+            return
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany(
+                'INSERT INTO runs (domain, url, option, analyzed_at, summary, payload) VALUES (?, ?, ?, ?, ?, ?)', rows
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def close(self, timeout=5):
+        """Stores what is queued and stops the writer (at exit)."""
+        if self._pid != os.getpid() or not self._writer.is_alive():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._writer.join(timeout)
+
+    # Reading
+
+    def timeline(self, domain, limit=50, before=None, option=None, before_id=None):
+        """
+        Newest first: [{id, url, option, analyzed_at, **summary}]. Page back with before=<oldest analyzed_at> and
+        before_id=<its id>; runs recorded at the same instant are told apart by id, so none is skipped.
+        """
+        query = 'SELECT id, url, option, analyzed_at, summary FROM runs WHERE domain = ? AND (analyzed_at, id) < (?, ?)'
+        params = [domain_of(f"//{domain}"), before if before is not None else float('inf'),
+                  before_id if before is not None and before_id is not None else 0]
+        if option:
+            query += ' AND option = ?'
+            params.append(option)
+        query += ' ORDER BY analyzed_at DESC, id DESC LIMIT ?'
+        params.append(max(1, min(limit, HISTORY_PAGE_MAX)))
+        return [dict(json.loads(summary), id=run_id, url=url, option=run_option, analyzed_at=analyzed_at)
+                for run_id, url, run_option, analyzed_at, summary in self._connection().execute(query, params)]
+
+    def run(self, run_id):
+        """The full stored run, or None."""
+        row = self._connection().execute(
+            'SELECT id, domain, url, option, analyzed_at, payload FROM runs WHERE id = ?', (run_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        run_id, domain, url, option, analyzed_at, payload = row
+        return dict(id=run_id, domain=domain, url=url, option=option, analyzed_at=analyzed_at,
+                    report=json.loads(zlib.decompress(payload)))
+
+    def latest_ids(self, domain, count=2, option=None):
+        return [run['id'] for run in self.timeline(domain, limit=count, option=option)]
+
+
+history_store = HistoryStore()
+atexit.register(history_store.close)
@@ -0,0 +1,430 @@
+import os
+import re
+import time
+from collections import namedtuple
+from html import unescape
+from html.parser import HTMLParser
+from urllib.parse import urlparse
+
+# Parser backend building the inventory: 'html.parser' (the reference), 'lxml' (needs the lxml package) or
+# 'tokenizer' (a regex tokenizer that only looks closely at <script>, <link> and <style>). All three
+# extract the same facts; benchmarks/parser_equivalence.py checks them against each other.
+HTML_PARSER = os.getenv('HTML_PARSER', 'html.parser')
+
+# One entry per <script> tag. src is the path with the query string stripped, start/body_start/body_end
+# are character offsets into the page source (None from lxml, which does not report them), delayed
+# mirrors Perfmatters' type="pmdelayedscript" exactly (js_ids, inline scripts) and delayed_any_case ignores the
+# type's case, as the exclusion recommendations always have.
+ScriptTag = namedtuple('ScriptTag', ['src', 'id', 'type', 'delayed', 'delayed_any_case', 'inline', 'start',
+                                     'body_start', 'body_end'])
+
+# One entry per <link rel="stylesheet">. id is None when the tag has no id attribute at all.
+StyleTag = namedtuple('StyleTag', ['href', 'id', 'delayed', 'start'])
+
+# Everything the analysis stages need from a page, extracted in a single pass.
+# delayed_inline holds the serialized markup of delayed inline scripts, in page order.
+PageInventory = namedtuple('PageInventory', ['scripts', 'stylesheets', 'delayed_inline'])
+
+# Attributes BeautifulSoup treats as whitespace-separated lists when serializing
+MULTI_VALUED_ATTRIBUTES = {'class', 'accesskey', 'dropzone'}
+
+
+def strip_query_params(url):
+    """Helper function to remove query parameters from a URL."""
+    parsed_url = urlparse(url)
+    return parsed_url.path  # Return only the path without query parameters
+
+
+def normalize_attrs(attrs):
+    """Turns HTMLParser's attribute pairs into a dict, valueless attributes becoming empty strings."""
+    return {key: '' if value is None else value for key, value in attrs}
+
+
+def quote_attribute_value(value):
+    """Quotes an attribute value the same way BeautifulSoup's minimal formatter does."""
+    value = value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    if '"' in value:
+        if "'" in value:
+            return '"%s"' % value.replace('"', '&quot;')
+        return "'%s'" % value
+    return '"%s"' % value
+
+
+def serialize_script(attrs, body):
+    """Rebuilds a <script> tag as str(bs4_tag) would, so inline script output stays unchanged."""
+    parts = ['<script']
+    for key, value in sorted(attrs.items()):
+        if key in MULTI_VALUED_ATTRIBUTES:
+            value = ' '.join(value.split())
+        parts.append(f' {key}={quote_attribute_value(value)}')
+    parts.append('>')
+    parts.append(body)
+    parts.append('</script>')
+    return ''.join(parts)
+
+
+def script_tag(attrs, start, body_start, body_end):
+    script_type = attrs.get('type') or ''
+    return ScriptTag(
+        src=strip_query_params(attrs.get('src') or ''),
+        id=attrs.get('id') or '',
+        type=script_type,
+        delayed=script_type == 'pmdelayedscript',
+        delayed_any_case=script_type.lower() == 'pmdelayedscript',
+        inline='src' not in attrs,
+        start=start,
+        body_start=body_start,
+        body_end=body_end,
+    )
+
+
+def style_tag(attrs, start):
+    """The StyleTag of a <link>, or None when it is not a stylesheet."""
+    rel = attrs.get('rel') or ''
+    if 'stylesheet' not in rel.split():
+        return None
+    return StyleTag(
+        href=strip_query_params(attrs.get('href') or ''),
+        id=attrs.get('id'),
+        delayed='data-pmdelayedstyle' in attrs,
+        start=start,
+    )
+
+
+class InventoryParser(HTMLParser):
+    """
+    Event-driven parser that records <script> and <link rel="stylesheet"> facts as the markup streams past.
+    Only the bodies of delayed inline scripts are retained; everything else is reduced to offsets.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.scripts = []
+        self.stylesheets = []
+        self.delayed_inline = []
+        self._fed = 0  # Total number of characters fed so far
+        self._base = 0  # Absolute offset of rawdata[0] for the current feed
+        self._cursor = 0  # Absolute offset of the construct currently being handled
+        self._open_script = None  # (attrs, start, body_start) of the <script> we are inside
+        self._script_body = []
+
+    def feed(self, data):
+        self._base = self._fed - len(self.rawdata)
+        self._cursor = self._base
+        self._fed += len(data)
+        super().feed(data)
+
+    def close(self):
+        self._base = self._fed - len(self.rawdata)
+        self._cursor = self._base
+        super().close()
+        if self._open_script is not None:  # Unterminated <script> at end of document
+            self._finish_script(self._fed)
+
+    def updatepos(self, i, j):
+        # Called by HTMLParser every time it advances past a construct; track the absolute position
+        self._cursor = self._base + j
+        return super().updatepos(i, j)
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'script':
+            attrs = normalize_attrs(attrs)
+            start = self._cursor
+            self._open_script = (attrs, start, start + len(self.get_starttag_text()))
+            self._script_body = []
+        elif tag == 'link':
+            self._record_link(normalize_attrs(attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        if tag == 'script':
+            self.handle_starttag(tag, attrs)
+            self._finish_script(self._open_script[2])
+        elif tag == 'link':
+            self._record_link(normalize_attrs(attrs))
+
+    def handle_endtag(self, tag):
+        if tag == 'script' and self._open_script is not None:
+            self._finish_script(self._cursor)
+
+    def handle_data(self, data):
+        if self._open_script is not None:
+            self._script_body.append(data)
+
+    def _record_link(self, attrs):
+        stylesheet = style_tag(attrs, self._cursor)
+        if stylesheet is not None:
+            self.stylesheets.append(stylesheet)
+
+    def _finish_script(self, body_end):
+        attrs, start, body_start = self._open_script
+        script = script_tag(attrs, start, body_start, max(body_start, body_end))
+        self.scripts.append(script)
+        if script.delayed and script.inline:
+            self.delayed_inline.append(serialize_script(attrs, ''.join(self._script_body)))
+        self._open_script = None
+        self._script_body = []
+
+    def inventory(self):
+        """Freezes what has been collected so far into an immutable PageInventory."""
+        return PageInventory(tuple(self.scripts), tuple(self.stylesheets), tuple(self.delayed_inline))
+
+
+class LxmlInventoryParser:
+    """
+    The inventory from lxml's HTML pull parser (libxml2), for hosts that have lxml installed. It takes the
+    same feed/close/inventory calls as InventoryParser. Elements are emptied as soon as they end, so
+    memory stays flat on large pages. libxml2 does not report source offsets, so those are None.
+    """
+
+    def __init__(self):
+        from lxml import etree
+        self._parser = etree.HTMLPullParser(events=('end',), recover=True)
+        self.scripts = []
+        self.stylesheets = []
+        self.delayed_inline = []
+
+    def feed(self, data):
+        self._parser.feed(data)
+        self._drain()
+
+    def close(self):
+        self._parser.close()
+        self._drain()
+
+    def _drain(self):
+        for _, element in self._parser.read_events():
+            if element.tag not in ('script', 'link'):
+                element.clear(keep_tail=True)
+                continue
+            attrs = {key.lower(): value for key, value in element.attrib.items()}
+            if element.tag == 'script':
+                script = script_tag(attrs, None, None, None)
+                self.scripts.append(script)
+                if script.delayed and script.inline:
+                    self.delayed_inline.append(serialize_script(attrs, element.text or ''))
+            else:
+                stylesheet = style_tag(attrs, None)
+                if stylesheet is not None:
+                    self.stylesheets.append(stylesheet)
+            element.clear(keep_tail=True)
+
+    def inventory(self):
+        return PageInventory(tuple(self.scripts), tuple(self.stylesheets), tuple(self.delayed_inline))
+
+
+# The tokenizer finds constructs with the same (tolerant) patterns html.parser uses, so it agrees with
+# InventoryParser on where tags start and end, and on their attributes, offsets included.
+MARKUP_PATTERN = re.compile(r'<[a-zA-Z/!?]')
+COMMENT_END_PATTERN = re.compile(r'--\s*>')
+START_TAG_PATTERN = re.compile(r"""
+  <[a-zA-Z][^\t\n\r\f />\x00]*       # tag name
+  (?:[\s/]*                          # optional whitespace before attribute name
+    (?:(?<=['"\s/])[^\s/>][^\s/=>]*  # attribute name
+      (?:\s*=+\s*                    # value indicator
+        (?:'[^']*'                   # LITA-enclosed value
+          |"[^"]*"                   # LIT-enclosed value
+          |(?!['"])[^>\s]*           # bare value
+         )
+        \s*                          # possibly followed by a space
+       )?(?:\s|/(?!>))*
+     )*
+   )?
+  \s*                                # trailing whitespace
+""", re.VERBOSE)
+TAG_NAME_PATTERN = re.compile(r'([a-zA-Z][^\t\n\r\f />\x00]*)(?:\s|/(?!>))*')
+ATTRIBUTE_PATTERN = re.compile(
+    r'((?<=[\'"\s/])[^\s/>][^\s/=>]*)(\s*=+\s*'
+    r'(\'[^\']*\'|"[^"]*"|(?![\'"])[^>\s]*))?(?:\s|/(?!>))*')
+MARKED_SECTION_PATTERN = re.compile(r'<!\[([a-zA-Z][-_.a-zA-Z0-9]*)\s*')
+MARKED_SECTION_ENDS = dict.fromkeys(('temp', 'cdata', 'ignore', 'include', 'rcdata'), re.compile(r']\s*]\s*>'))
+MARKED_SECTION_ENDS.update(dict.fromkeys(('if', 'else', 'endif'), re.compile(r']\s*>')))
+GREATER_THAN_PATTERN = re.compile('>')
+ATTRIBUTE_CONTINUATION = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ=/')
+RAW_TEXT_END_PATTERNS = {
+    'script': re.compile(r'</\s*script\s*>', re.IGNORECASE),
+    'style': re.compile(r'</\s*style\s*>', re.IGNORECASE),
+}
+
+
+class TokenizerInventoryParser:
+    """
+    A tokenizer that skips from tag to tag and only parses the attributes of <script>, <link> and <style>
+    (whose body it jumps over). It finds the same tags and attributes as InventoryParser at a fraction of
+    the cost, since text, comments and all other elements are never handed to Python callbacks.
+    Incomplete constructs at the end of a chunk are kept until the next one arrives.
+    """
+
+    def __init__(self):
+        self.scripts = []
+        self.stylesheets = []
+        self.delayed_inline = []
+        self._buffer = ''
+        self._base = 0  # Absolute offset of _buffer[0]
+        self._done = False  # An unterminated <style> swallows the rest of the page
+
+    def feed(self, data):
+        self._buffer += data
+        self._tokenize(final=False)
+
+    def close(self):
+        self._tokenize(final=True)
+        self._buffer = ''
+
+    def _tokenize(self, final):
+        buffer, pos = self._buffer, 0
+        while not self._done:
+            match = MARKUP_PATTERN.search(buffer, pos)
+            if match is None:
+                pos = len(buffer) - 1 if buffer.endswith('<') and not final else len(buffer)
+                break
+            start = match.start()
+            end = self._construct_end(buffer, start, final)
+            if end is None:
+                if not final:
+                    pos = start  # Wait for the rest of the construct
+                    break
+                end = self._text_end(buffer, start)
+            pos = end
+        if self._done:
+            pos = len(buffer)
+        self._base += pos
+        self._buffer = buffer[pos:]
+
+    def _construct_end(self, buffer, start, final):
+        """Where the construct at `start` ends, recording <script>/<link> tags; None when it is cut off."""
+        kind = buffer[start + 1]
+        if kind == '!':
+            if buffer.startswith('<!--', start):
+                close = COMMENT_END_PATTERN.search(buffer, start + 4)
+                return close.end() if close else None
+            section = MARKED_SECTION_PATTERN.match(buffer, start)
+            if section:
+                close = MARKED_SECTION_ENDS.get(section.group(1).lower(), GREATER_THAN_PATTERN).search(buffer, start + 3)
+                return close.end() if close else None
+        if kind in '!?/':
+            close = buffer.find('>', start + 2)
+            return close + 1 if close >= 0 else None
+
+        tag_end = START_TAG_PATTERN.match(buffer, start).end()
+        after = buffer[tag_end:tag_end + 1]
+        if after == '>':
+            end = tag_end + 1
+        elif after == '/':
+            if not buffer.startswith('/>', tag_end):
+                return None
+            end = tag_end + 2
+        elif not after or after in ATTRIBUTE_CONTINUATION:
+            return None
+        else:
+            return max(tag_end, start + 1)  # Malformed, read as text
+
+        name_match = TAG_NAME_PATTERN.match(buffer, start + 1)
+        tag = name_match.group(1).lower()
+        if tag not in ('script', 'link', 'style'):
+            return end
+        attrs = {}
+        position = name_match.end()
+        while position < end:
+            attribute = ATTRIBUTE_PATTERN.match(buffer, position)
+            if not attribute:
+                break
+            name, rest, value = attribute.group(1, 2, 3)
+            if not rest:
+                value = ''
+            elif value[:1] == value[-1:] and value[:1] in ('"', "'") and len(value) > 1:
+                value = value[1:-1]
+            attrs[name.lower()] = unescape(value) if value else value
+            position = attribute.end()
+        closing = buffer[position:end].strip()
+        if closing not in ('>', '/>'):
+            return end  # Read as text
+
+        if tag == 'link':
+            stylesheet = style_tag(attrs, self._base + start)
+            if stylesheet is not None:
+                self.stylesheets.append(stylesheet)
+            return end
+        if closing == '/>':
+            if tag == 'script':
+                self._add_script(attrs, start, end, end, '')
+            return end
+        raw_end = RAW_TEXT_END_PATTERNS[tag].search(buffer, end)
+        if raw_end is not None:
+            if tag == 'script':
+                self._add_script(attrs, start, end, raw_end.start(), buffer[end:raw_end.start()])
+            return raw_end.end()
+        if not final:
+            return None
+        # The raw text never ends: html.parser drops the rest of the page, closing a <script> empty
+        if tag == 'script':
+            self._add_script(attrs, start, end, len(buffer), '')
+        self._done = True
+        return len(buffer)
+
+    def _add_script(self, attrs, start, body_start, body_end, body):
+        script = script_tag(attrs, self._base + start, self._base + body_start, self._base + body_end)
+        self.scripts.append(script)
+        if script.delayed and script.inline:
+            self.delayed_inline.append(serialize_script(attrs, body))
+
+    @staticmethod
+    def _text_end(buffer, start):
+        """End of a construct cut off by the end of the page, which html.parser reads as text."""
+        close = buffer.find('>', start + 1)
+        if close >= 0:
+            return close + 1
+        following = buffer.find('<', start + 1)
+        return following if following >= 0 else start + 1
+
+    def inventory(self):
+        return PageInventory(tuple(self.scripts), tuple(self.stylesheets), tuple(self.delayed_inline))
+
+
+PARSER_BACKENDS = {
+    'html.parser': InventoryParser,
+    'lxml': LxmlInventoryParser,
+    'tokenizer': TokenizerInventoryParser,
+}
+
+
+def create_parser(backend=None):
+    """A fresh inventory parser of the given backend (HTML_PARSER by default)."""
+    backend = backend or HTML_PARSER
+    if backend not in PARSER_BACKENDS:
+        raise ValueError(f"Unknown HTML parser backend {backend!r}, expected one of {', '.join(PARSER_BACKENDS)}")
+    return PARSER_BACKENDS[backend]()
+
+
+def build_inventory(page_source, backend=None):
+    """Parses the page once and returns its script/stylesheet inventory."""
+    parser = create_parser(backend)
+    parser.feed(page_source)
+    parser.close()
+    return parser.inventory()
+
+
+def parse_page(raw, encoding, backend=None):
+    """
+    Decodes and parses a whole page body; the entry point of the parse process pool. Returns the
+    inventory and the seconds spent, which the caller adds to the page's parse time.
+    """
+    started = time.perf_counter()
+    inventory = build_inventory(raw.decode(encoding, errors='replace'), backend)
+    return inventory, time.perf_counter() - started
+
+
+def delayed_js_ids(inventory):
+    """Script IDs shown in the report, flagged when Perfmatters delays them."""
+    js_ids = set()
+    for script in inventory.scripts:
+        if script.id and "perfmatters" not in script.id and not script.id.endswith('-extra'):
+            if script.delayed:
+                js_ids.add(f"{script.id} --- pmdelayed")
+            else:
+                js_ids.add(script.id)
+    return js_ids
+
+
+def delayed_css_ids(inventory):
+    """Stylesheet IDs that Perfmatters delays."""
+    return {f"{link.id} --- pmdelayedstyle" for link in inventory.stylesheets if link.delayed and link.id is not None}
@@ -0,0 +1,407 @@
+import asyncio
+import http.cookiejar
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import aiohttp
+import requests
+import ujson
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NameResolutionError
+from urllib3.util.connection import allowed_gai_family
+from yarl import URL
+
+# Shared outbound HTTP layer: one pooled requests.Session per worker for blocking calls and one
+# aiohttp.ClientSession per event loop for async calls, both with keep-alive and cached DNS. Neither keeps
+# cookies: the sessions are shared by every analysis, and a cookie one origin set (a cart or login cookie)
+# would make later fetches of that host bypass its page cache.
+
+HTTP_POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', 50))  # Number of per-host pools kept alive
+HTTP_POOL_PER_HOST = int(os.getenv('HTTP_POOL_PER_HOST', 10))  # Keep-alive connections per host
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 10))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30))
+HTTP_ASYNC_LIMIT = int(os.getenv('HTTP_ASYNC_LIMIT', 100))  # Total simultaneous async connections
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', 30))
+DNS_CACHE_TTL = int(os.getenv('DNS_CACHE_TTL', 60))  # Cap on how long a lookup is reused; getaddrinfo gives no record TTL
+DNS_CACHE_MAX_ENTRIES = 4096
+
+DEFAULT_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+_stats_lock = threading.Lock()
+_stats = {
+    'sync_requests': 0,
+    'async_requests': 0,
+    'async_connections_created': 0,
+    'async_connections_reused': 0,
+    'dns_cache_hits': 0,
+    'dns_cache_misses': 0,
+}
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+class RequestTiming:
+    """
+    Where the time of one page fetch went. A hop is opened for every request sent (the original one, then
+    one per redirect followed) and filled in by the hooks below: DNS lookup, TCP connect and TLS handshake
+    when a new connection was opened, and the wait for the response headers. Times are perf_counter
+    seconds; report() turns them into the report's millisecond fields.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.hops = []
+
+    def start_hop(self, url):
+        hop = {'url': str(url), 'status': None, 'started': time.perf_counter(), 'dns': 0.0, 'connect': None,
+               'tls': None, 'headers': None, 'reused': True}
+        self.hops.append(hop)
+        return hop
+
+    @property
+    def hop(self):
+        return self.hops[-1] if self.hops else None
+
+    @staticmethod
+    def _hop_fields(hop):
+        connect, tls = hop['connect'], hop['tls']
+        opened = connect is not None
+        total = (hop['headers'] or time.perf_counter()) - hop['started']
+        return {
+            'dns_ms': _ms(hop['dns']) if opened else 0.0,
+            'connect_ms': _ms(max(0.0, connect - hop['dns'])) if opened else 0.0,
+            'tls_ms': _ms(tls) if opened else 0.0,  # None when aiohttp did the handshake with the connect
+            # Request sent to first response byte: what the origin spent producing the page
+            'ttfb_ms': _ms(max(0.0, total - (connect or 0.0) - (tls or 0.0))),
+            'total_ms': _ms(total),
+            'connection_reused': hop['reused'],
+        }
+
+    def report(self, download_seconds, transfer_bytes, content_bytes, content_encoding):
+        """The report's timing block: the final hop's phases, the body download and every redirect before it."""
+        *redirects, final = self.hops or [self.start_hop('')]
+        timing = self._hop_fields(final)
+        timing.update({
+            'download_ms': _ms(download_seconds),
+            'redirect_ms': _ms(final['started'] - self.started) if redirects else 0.0,
+            'total_ms': _ms(time.perf_counter() - self.started),
+            'redirects': [dict(url=hop['url'], status=hop['status'], **self._hop_fields(hop)) for hop in redirects],
+            'transfer_bytes': transfer_bytes,
+            'content_bytes': content_bytes,
+            'content_encoding': content_encoding,
+        })
+        return timing
+
+
+# The RequestTiming of the blocking fetch running on this thread, if any (see record_timing)
+_timing = threading.local()
+
+
+def _current_hop():
+    timing = getattr(_timing, 'current', None)
+    return timing.hop if timing is not None else None
+
+
+@contextmanager
+def record_timing():
+    """Records the phases of the blocking requests made in the block on this thread; yields the RequestTiming."""
+    timing = RequestTiming()
+    previous = getattr(_timing, 'current', None)
+    _timing.current = timing
+    try:
+        yield timing
+    finally:
+        _timing.current = previous
+
+
+# DNS cache for the connections of the blocking pool only (see _TimedNewConnection); other lookups in the
+# process (SQLite, Redis, PSI through aiohttp) are left to the system resolver
+_dns_cache = {}
+_dns_lock = threading.Lock()
+
+
+def _cached_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    key = (host, port, family, type, proto, flags)
+    now = time.monotonic()
+    with _dns_lock:
+        entry = _dns_cache.get(key)
+    if entry and entry[0] > now:
+        _count('dns_cache_hits')
+        return entry[1]
+    _count('dns_cache_misses')
+    result = socket.getaddrinfo(host, port, family, type, proto, flags)
+    with _dns_lock:
+        if len(_dns_cache) >= DNS_CACHE_MAX_ENTRIES:
+            for expired in [cached for cached, (expires, _) in _dns_cache.items() if expires <= now]:
+                del _dns_cache[expired]
+            if len(_dns_cache) >= DNS_CACHE_MAX_ENTRIES:
+                _dns_cache.clear()
+        _dns_cache[key] = (now + DNS_CACHE_TTL, result)
+    return result
+
+
+_lookup = _cached_getaddrinfo if DNS_CACHE_TTL > 0 else socket.getaddrinfo
+
+
+def _resolve(host, port):
+    """The addresses to try for host, from the pool's DNS cache; the lookup time goes to the current hop."""
+    hop = _current_hop()
+    started = time.perf_counter()
+    try:
+        return [address[4][0] for address in _lookup(host, port, allowed_gai_family(), socket.SOCK_STREAM)]
+    finally:
+        if hop is not None:
+            hop['dns'] += time.perf_counter() - started
+
+
+# Connections that resolve through the DNS cache and note how long opening them took. _new_conn is the
+# TCP connect (DNS included), connect() adds the TLS handshake for HTTPS; reused keep-alive connections
+# skip both. The socket is connected to each cached address in turn; TLS still verifies self.host.
+class _TimedNewConnection:
+    def _new_conn(self):
+        hop = _current_hop()
+        started = time.perf_counter()
+        host = self._dns_host
+        try:
+            addresses = _resolve(host, self.port)
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+        error = None
+        try:
+            for address in addresses:
+                self._dns_host = address
+                try:
+                    sock = super()._new_conn()
+                    break
+                except ConnectTimeoutError as e:  # NewConnectionError too; try the next address
+                    error = e
+            else:
+                raise error or NameResolutionError(self.host, self, socket.gaierror('no addresses'))
+        finally:
+            self._dns_host = host
+        if hop is not None:
+            hop['connect'] = time.perf_counter() - started
+            hop['tls'] = None if isinstance(self, HTTPSConnection) else 0.0  # Plain HTTP has no handshake
+            hop['reused'] = False
+        return sock
+
+
+class TimedHTTPConnection(_TimedNewConnection, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedNewConnection, HTTPSConnection):
+    def connect(self):
+        hop = _current_hop()
+        started = time.perf_counter()
+        super().connect()
+        if hop is not None and hop['connect'] is not None:
+            hop['tls'] = max(0.0, time.perf_counter() - started - hop['connect'])
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimingAdapter(HTTPAdapter):
+    """HTTPAdapter whose requests are timed when made inside record_timing(); one hop per request sent."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+    def send(self, request, *args, **kwargs):
+        timing = getattr(_timing, 'current', None)
+        if timing is None:
+            return super().send(request, *args, **kwargs)
+        hop = timing.start_hop(request.url)
+        response = super().send(request, *args, **kwargs)
+        hop['headers'] = time.perf_counter()
+        hop['status'] = response.status_code
+        return response
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Returns the worker's pooled requests.Session, creating it on first use."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))  # Accept none
+                adapter = TimingAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_PER_HOST)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def request(method, url, **kwargs):
+    """Blocking request through the shared pool, with explicit connect/read timeouts by default."""
+    kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+    _count('sync_requests')
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+async def _on_request_start(session, context, params):
+    _count('async_requests')
+
+
+async def _on_connection_create_end(session, context, params):
+    _count('async_connections_created')
+    timing = context.trace_request_ctx
+    if isinstance(timing, RequestTiming) and timing.hop is not None:
+        # aiohttp reports the TCP connect and TLS handshake as one step
+        timing.hop['connect'] = time.perf_counter() - timing.hop['connect_started']
+        timing.hop['tls'] = 0.0 if timing.hop['url'].startswith('http:') else None
+        timing.hop['reused'] = False
+
+
+async def _on_connection_reuseconn(session, context, params):
+    _count('async_connections_reused')
+
+
+# Phase timing of async requests made with trace_request_ctx=RequestTiming()
+
+async def _on_timed_request_start(session, context, params):
+    timing = context.trace_request_ctx
+    # Depending on the aiohttp version a redirect may or may not send request_start again
+    if isinstance(timing, RequestTiming) and (timing.hop is None or timing.hop['headers'] is not None):
+        timing.start_hop(params.url)
+
+
+async def _on_timed_connection_create_start(session, context, params):
+    timing = context.trace_request_ctx
+    if isinstance(timing, RequestTiming) and timing.hop is not None:
+        timing.hop['connect_started'] = time.perf_counter()
+
+
+async def _on_timed_dns_start(session, context, params):
+    timing = context.trace_request_ctx
+    if isinstance(timing, RequestTiming) and timing.hop is not None:
+        timing.hop['dns_started'] = time.perf_counter()
+
+
+async def _on_timed_dns_end(session, context, params):
+    timing = context.trace_request_ctx
+    if isinstance(timing, RequestTiming) and timing.hop is not None and 'dns_started' in timing.hop:
+        timing.hop['dns'] += time.perf_counter() - timing.hop.pop('dns_started')
+
+
+async def _on_timed_response(session, context, params):
+    timing = context.trace_request_ctx
+    if isinstance(timing, RequestTiming) and timing.hop is not None:
+        timing.hop['headers'] = time.perf_counter()
+        timing.hop['status'] = params.response.status
+
+
+async def _on_timed_redirect(session, context, params):
+    await _on_timed_response(session, context, params)
+    timing = context.trace_request_ctx
+    if isinstance(timing, RequestTiming):
+        timing.start_hop(params.url.join(URL(params.response.headers.get('Location', ''))))
+
+
+_async_sessions = {}  # Event loop -> aiohttp.ClientSession
+
+
+def get_async_session():
+    """Returns the aiohttp session bound to the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(_on_request_start)
+        trace_config.on_request_start.append(_on_timed_request_start)
+        trace_config.on_connection_create_start.append(_on_timed_connection_create_start)
+        trace_config.on_connection_create_end.append(_on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+        trace_config.on_dns_resolvehost_start.append(_on_timed_dns_start)
+        trace_config.on_dns_resolvehost_end.append(_on_timed_dns_end)
+        trace_config.on_request_redirect.append(_on_timed_redirect)
+        trace_config.on_request_end.append(_on_timed_response)
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_ASYNC_LIMIT,
+            limit_per_host=HTTP_POOL_PER_HOST,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            json_serialize=ujson.dumps,
+            timeout=aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT),
+            trace_configs=[trace_config],
+        )
+        _async_sessions[loop] = session
+        # Forget sessions whose loops are gone
+        for stale_loop in [other for other in _async_sessions if other.is_closed()]:
+            del _async_sessions[stale_loop]
+    return session
+
+
+async def close_async_session():
+    """Closes the running loop's session, e.g. before the loop itself is shut down."""
+    session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+def http_counters():
+    """The request counters as metrics samples, for the /metrics endpoint."""
+    with _stats_lock:
+        return {('outbound_http_total', (('event', name),)): value for name, value in _stats.items()}
+
+
+def pool_stats():
+    """Request counters plus a snapshot of the sync connection pools."""
+    with _stats_lock:
+        stats = dict(_stats)
+
+    hosts = []
+    if _session is not None:
+        for adapter in set(_session.adapters.values()):
+            for pool_key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(pool_key)
+                if pool is None:
+                    continue
+                hosts.append({
+                    'host': f"{pool.scheme}://{pool.host}:{pool.port}",
+                    'connections_created': pool.num_connections,
+                    'requests': pool.num_requests,
+                    'idle_connections': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0,
+                })
+    stats['sync_pools'] = hosts
+    stats['async_sessions'] = sum(1 for session in _async_sessions.values() if not session.closed)
+    with _dns_lock:
+        stats['dns_cache_entries'] = len(_dns_cache)
+    return stats
+
@@ -0,0 +1,529 @@
+import heapq
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+from admission import Rejected
+
+# Analysis jobs. POST /api/analyze/jobs queues a job and answers with its id at once; job_worker.py
+# processes take jobs off the queue and run them, and GET /api/analyze/jobs/<id> reports the job's state,
+# progress and result. States follow the lighthouse backend's Bull queue: waiting, active, completed,
+# failed. Higher priorities run first (FIFO within a priority), an identical job that is still waiting
+# or active is reused instead of queued twice, and finished jobs expire after JOB_RESULT_TTL.
+#
+# JOB_BACKEND picks where the queue lives:
+#   sqlite  a file every worker on the host shares (default)
+#   redis   any Redis-compatible server at JOB_REDIS_URL (needs the redis package)
+#   memory  in the web worker itself, which also runs the jobs on threads; for local testing
+
+JOB_BACKEND = os.getenv('JOB_BACKEND', 'sqlite')
+JOB_DB = os.getenv('JOB_DB', os.path.join('data', 'jobs.sqlite3'))
+JOB_REDIS_URL = os.getenv('JOB_REDIS_URL', 'redis://localhost:6379/0')
+JOB_REDIS_PREFIX = os.getenv('JOB_REDIS_PREFIX', 'checkmysite:jobs:')
+JOB_RESULT_TTL = float(os.getenv('JOB_RESULT_TTL', 3600))  # Finished jobs and their results are kept this long
+JOB_LEASE_TIMEOUT = float(os.getenv('JOB_LEASE_TIMEOUT', 300))  # An active job not heard from this long is run again
+JOB_HEARTBEAT_INTERVAL = float(os.getenv('JOB_HEARTBEAT_INTERVAL', JOB_LEASE_TIMEOUT / 5))  # How often a running job renews its lease
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 2))
+JOB_MAX_WAITING = int(os.getenv('JOB_MAX_WAITING', 1000))  # Beyond this, new jobs are refused with a 429
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))  # Worker processes (threads for the memory backend)
+JOB_DEFAULT_PRIORITY = 5
+JOB_MAX_PRIORITY = 9
+JOB_POLL_INTERVAL = 0.5  # Seconds between queue polls of an idle SQLite worker
+JOB_PRUNE_INTERVAL = 60
+
+WAITING, ACTIVE, COMPLETED, FAILED = 'waiting', 'active', 'completed', 'failed'
+
+
+def clamp_priority(priority):
+    return max(0, min(JOB_MAX_PRIORITY, int(priority)))
+
+
+def queue_full(waiting):
+    return Rejected("Too many queued analyses, please retry later", 'jobs_full', 30)
+
+
+def pack(value):
+    return zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+
+
+def unpack(blob):
+    return json.loads(zlib.decompress(blob)) if blob else None
+
+
+def job_view(job, now=None):
+    """The job as GET /api/analyze/jobs/<id> returns it, or None once it has expired."""
+    if job is None:
+        return None
+    if job['finished_at'] and (now or time.time()) - job['finished_at'] > JOB_RESULT_TTL:
+        return None
+    view = {field: job.get(field) for field in ('id', 'status', 'priority', 'progress', 'attempts', 'created_at',
+                                                'started_at', 'finished_at')}
+    if job['status'] == COMPLETED:
+        view['result'] = job.get('result')
+    elif job['status'] == FAILED:
+        view['error'] = job.get('error')
+    return view
+
+
+class MemoryBackend:
+    """Jobs in this process only; JOB_WORKERS threads of the same process run them."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._heap = []  # (-priority, sequence, id)
+        self._dedup = {}  # dedup key -> id of the waiting/active job
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def enqueue(self, payload, priority=JOB_DEFAULT_PRIORITY, dedup_key=None):
+        """Returns (job id, created); created is False when an identical pending job was reused."""
+        now = time.time()
+        with self._condition:
+            existing = self._jobs.get(self._dedup.get(dedup_key))
+            if dedup_key and existing and existing['status'] in (WAITING, ACTIVE):
+                return existing['id'], False
+            if sum(job['status'] == WAITING for job in self._jobs.values()) >= JOB_MAX_WAITING:
+                raise queue_full(JOB_MAX_WAITING)
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = dict(id=job_id, status=WAITING, priority=priority, payload=payload, dedup_key=dedup_key,
+                                      progress=None, attempts=0, created_at=now, started_at=None, updated_at=now,
+                                      finished_at=None)
+            if dedup_key:
+                self._dedup[dedup_key] = job_id
+            heapq.heappush(self._heap, (-priority, next(self._sequence), job_id))
+            self._condition.notify()
+        return job_id, True
+
+    def claim(self, timeout=JOB_POLL_INTERVAL):
+        """The next job to run, marked active, or None when none arrived within timeout."""
+        with self._condition:
+            if not self._heap:
+                self._condition.wait(timeout)
+            while self._heap:
+                _, _, job_id = heapq.heappop(self._heap)
+                job = self._jobs.get(job_id)
+                if job and job['status'] == WAITING:
+                    job.update(status=ACTIVE, attempts=job['attempts'] + 1, started_at=time.time(), updated_at=time.time())
+                    return dict(job)
+        return None
+
+    def _owned(self, job_id, attempt):
+        job = self._jobs.get(job_id)
+        return job is not None and (attempt is None or (job['status'] == ACTIVE and job['attempts'] == attempt))
+
+    def progress(self, job_id, progress, attempt=None):
+        with self._condition:
+            if self._owned(job_id, attempt):
+                self._jobs[job_id].update(progress=progress, updated_at=time.time())
+
+    def heartbeat(self, job_id, attempt):
+        """Renews the lease of a running job; False once that attempt no longer owns it."""
+        with self._condition:
+            if not self._owned(job_id, attempt):
+                return False
+            self._jobs[job_id]['updated_at'] = time.time()
+            return True
+
+    def finish(self, job_id, result=None, error=None, attempt=None):
+        """Stores the outcome; with an attempt, only while that attempt still owns the job. Returns whether it did."""
+        with self._condition:
+            if not self._owned(job_id, attempt):
+                return False
+            job = self._jobs[job_id]
+            job.update(status=FAILED if error else COMPLETED, result=result, error=error, finished_at=time.time())
+            if self._dedup.get(job['dedup_key']) == job_id:
+                del self._dedup[job['dedup_key']]
+            return True
+
+    def get(self, job_id):
+        with self._condition:
+            return job_view(self._jobs.get(job_id))
+
+    def prune(self):
+        now = time.time()
+        with self._condition:
+            for job_id in [job['id'] for job in self._jobs.values()
+                           if job['finished_at'] and now - job['finished_at'] > JOB_RESULT_TTL]:
+                del self._jobs[job_id]
+
+    def stats(self):
+        with self._condition:
+            counts = {status: 0 for status in (WAITING, ACTIVE, COMPLETED, FAILED)}
+            for job in self._jobs.values():
+                counts[job['status']] += 1
+            return counts
+
+
+class SQLiteBackend:
+    """Jobs in a SQLite file shared by the web workers and the job_worker.py processes on the host."""
+
+    def __init__(self, db_path=JOB_DB):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._init_db()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def _init_db(self):
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, status TEXT NOT NULL, priority INTEGER NOT NULL, dedup_key TEXT, payload TEXT NOT NULL, '
+            'progress TEXT, attempts INTEGER NOT NULL DEFAULT 0, result BLOB, error TEXT, created_at REAL NOT NULL, '
+            'started_at REAL, updated_at REAL NOT NULL, finished_at REAL)'
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (priority DESC, created_at) WHERE status = 'waiting'")
+        connection.execute("CREATE INDEX IF NOT EXISTS jobs_pending_key ON jobs (dedup_key) WHERE status IN ('waiting', 'active')")
+        connection.execute('CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_at) WHERE finished_at IS NOT NULL')
+
+    def _transaction(self):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        return connection
+
+    def enqueue(self, payload, priority=JOB_DEFAULT_PRIORITY, dedup_key=None):
+        """Returns (job id, created); created is False when an identical pending job was reused."""
+        now = time.time()
+        connection = self._transaction()
+        try:
+            if dedup_key:
+                row = connection.execute("SELECT id FROM jobs WHERE dedup_key = ? AND status IN ('waiting', 'active')",
+                                         (dedup_key,)).fetchone()
+                if row:
+                    return row[0], False
+            waiting = connection.execute("SELECT COUNT(*) FROM jobs WHERE status = 'waiting'").fetchone()[0]
+            if waiting >= JOB_MAX_WAITING:
+                raise queue_full(waiting)
+            job_id = uuid.uuid4().hex
+            connection.execute(
+                'INSERT INTO jobs (id, status, priority, dedup_key, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job_id, WAITING, priority, dedup_key, json.dumps(payload), now, now)
+            )
+            return job_id, True
+        finally:
+            connection.execute('COMMIT')
+
+    def claim(self, timeout=JOB_POLL_INTERVAL):
+        """The next job to run, marked active, or None when the queue stayed empty for timeout."""
+        deadline = time.monotonic() + timeout
+        while True:
+            connection = self._transaction()
+            try:
+                row = connection.execute(
+                    "SELECT id FROM jobs WHERE status = 'waiting' ORDER BY priority DESC, created_at LIMIT 1"
+                ).fetchone()
+                if row:
+                    now = time.time()
+                    connection.execute(
+                        "UPDATE jobs SET status = 'active', attempts = attempts + 1, started_at = ?, updated_at = ? WHERE id = ?",
+                        (now, now, row[0])
+                    )
+            finally:
+                connection.execute('COMMIT')
+            if row:
+                return self._job(row[0])
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(min(JOB_POLL_INTERVAL, max(0.05, deadline - time.monotonic())))
+
+    @staticmethod
+    def _owner_clause(attempt):
+        """The WHERE condition (and its parameters) limiting an update to the attempt that owns the job."""
+        if attempt is None:
+            return '', ()
+        return " AND status = 'active' AND attempts = ?", (attempt,)
+
+    def progress(self, job_id, progress, attempt=None):
+        owner, params = self._owner_clause(attempt)
+        self._connection().execute('UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?' + owner,
+                                   (json.dumps(progress), time.time(), job_id, *params))
+
+    def heartbeat(self, job_id, attempt):
+        """Renews the lease of a running job; False once that attempt no longer owns it."""
+        owner, params = self._owner_clause(attempt)
+        cursor = self._connection().execute('UPDATE jobs SET updated_at = ? WHERE id = ?' + owner,
+                                            (time.time(), job_id, *params))
+        return cursor.rowcount == 1
+
+    def finish(self, job_id, result=None, error=None, attempt=None):
+        """Stores the outcome; with an attempt, only while that attempt still owns the job. Returns whether it did."""
+        owner, params = self._owner_clause(attempt)
+        cursor = self._connection().execute(
+            'UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, updated_at = ? WHERE id = ?' + owner,
+            (FAILED if error else COMPLETED, pack(result) if result is not None else None, error, time.time(),
+             time.time(), job_id, *params)
+        )
+        return cursor.rowcount == 1
+
+    def _job(self, job_id):
+        cursor = self._connection().execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        job = dict(zip((column[0] for column in cursor.description), row))
+        job.update(payload=json.loads(job['payload']), progress=json.loads(job['progress']) if job['progress'] else None,
+                   result=unpack(job['result']))
+        return job
+
+    def get(self, job_id):
+        return job_view(self._job(job_id))
+
+    def prune(self):
+        """Drops expired jobs and puts active jobs whose worker went quiet back in the queue (or fails them)."""
+        now = time.time()
+        connection = self._transaction()
+        try:
+            connection.execute('DELETE FROM jobs WHERE finished_at < ?', (now - JOB_RESULT_TTL,))
+            connection.execute(
+                "UPDATE jobs SET status = 'failed', error = 'The worker running this job stopped', finished_at = ? "
+                "WHERE status = 'active' AND updated_at < ? AND attempts >= ?", (now, now - JOB_LEASE_TIMEOUT, JOB_MAX_ATTEMPTS)
+            )
+            connection.execute("UPDATE jobs SET status = 'waiting' WHERE status = 'active' AND updated_at < ?",
+                               (now - JOB_LEASE_TIMEOUT,))
+        finally:
+            connection.execute('COMMIT')
+
+    def stats(self):
+        counts = {status: 0 for status in (WAITING, ACTIVE, COMPLETED, FAILED)}
+        counts.update(self._connection().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        return counts
+
+
+class RedisBackend:
+    """
+    Jobs in a Redis-compatible server: a hash per job, a sorted set as the priority queue (popped with
+    BZPOPMIN, so idle workers block instead of polling) and a sorted set of active jobs by last heartbeat.
+    Finished jobs expire through the server's own key TTL.
+    """
+
+    def __init__(self, url=JOB_REDIS_URL, prefix=JOB_REDIS_PREFIX):
+        import redis  # Only needed for this backend
+        self.redis = redis.Redis.from_url(url)
+        self._watch_error = redis.WatchError
+        self.prefix = prefix
+        self._sequence_key = f"{prefix}sequence"
+        self._queue_key = f"{prefix}queue"
+        self._active_key = f"{prefix}active"
+
+    def _job_key(self, job_id):
+        return f"{self.prefix}job:{job_id}"
+
+    def _dedup_key(self, dedup_key):
+        return f"{self.prefix}pending:{dedup_key}"
+
+    def _score(self, priority):
+        # Lower scores pop first: the priority, then the order of arrival
+        return (JOB_MAX_PRIORITY - priority) * 10 ** 12 + self.redis.incr(self._sequence_key)
+
+    def enqueue(self, payload, priority=JOB_DEFAULT_PRIORITY, dedup_key=None):
+        """Returns (job id, created); created is False when an identical pending job was reused."""
+        job_id = uuid.uuid4().hex
+        if dedup_key:
+            pending_key = self._dedup_key(dedup_key)
+            if not self.redis.set(pending_key, job_id, nx=True, ex=int(JOB_LEASE_TIMEOUT * JOB_MAX_ATTEMPTS + JOB_RESULT_TTL)):
+                existing = (self.redis.get(pending_key) or b'').decode()
+                if self.redis.hget(self._job_key(existing), 'status') in (WAITING.encode(), ACTIVE.encode()):
+                    return existing, False
+                self.redis.set(pending_key, job_id)
+        if self.redis.zcard(self._queue_key) >= JOB_MAX_WAITING:
+            raise queue_full(JOB_MAX_WAITING)
+        now = time.time()
+        self.redis.hset(self._job_key(job_id), mapping=dict(
+            id=job_id, status=WAITING, priority=priority, dedup_key=dedup_key or '', payload=json.dumps(payload),
+            attempts=0, created_at=now, updated_at=now,
+        ))
+        self.redis.zadd(self._queue_key, {job_id: self._score(priority)})
+        return job_id, True
+
+    def claim(self, timeout=JOB_POLL_INTERVAL):
+        """The next job to run, marked active, or None when none arrived within timeout."""
+        popped = self.redis.bzpopmin(self._queue_key, timeout=max(1, round(timeout)))
+        if not popped:
+            return None
+        job_id = popped[1].decode()
+        now = time.time()
+        self.redis.hset(self._job_key(job_id), mapping=dict(status=ACTIVE, started_at=now, updated_at=now))
+        self.redis.hincrby(self._job_key(job_id), 'attempts', 1)
+        self.redis.zadd(self._active_key, {job_id: now})
+        return self._job(job_id)
+
+    def _owned(self, job_id, attempt, client=None):
+        if attempt is None:
+            return True
+        status, attempts = (client or self.redis).hmget(self._job_key(job_id), 'status', 'attempts')
+        return status == ACTIVE.encode() and int(attempts or 0) == attempt
+
+    def progress(self, job_id, progress, attempt=None):
+        if not self._owned(job_id, attempt):
+            return
+        now = time.time()
+        self.redis.hset(self._job_key(job_id), mapping=dict(progress=json.dumps(progress), updated_at=now))
+        self.redis.zadd(self._active_key, {job_id: now})
+
+    def heartbeat(self, job_id, attempt):
+        """Renews the lease of a running job; False once that attempt no longer owns it."""
+        if not self._owned(job_id, attempt):
+            return False
+        now = time.time()
+        self.redis.hset(self._job_key(job_id), 'updated_at', now)
+        self.redis.zadd(self._active_key, {job_id: now})
+        return True
+
+    def finish(self, job_id, result=None, error=None, attempt=None):
+        """Stores the outcome; with an attempt, only while that attempt still owns the job. Returns whether it did."""
+        now = time.time()
+        key = self._job_key(job_id)
+        fields = dict(status=FAILED if error else COMPLETED, finished_at=now, updated_at=now)
+        if result is not None:
+            fields['result'] = pack(result)
+        if error:
+            fields['error'] = error
+        # WATCH makes the ownership check and the update one step: a prune in between aborts the write
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if not self._owned(job_id, attempt, pipe):
+                    return False
+                pipe.multi()
+                pipe.hset(key, mapping=fields)
+                pipe.expire(key, int(JOB_RESULT_TTL))
+                pipe.zrem(self._active_key, job_id)
+                pipe.execute()
+            except self._watch_error:
+                return False
+        dedup_key = self.redis.hget(key, 'dedup_key')
+        if dedup_key and self.redis.get(self._dedup_key(dedup_key.decode())) == job_id.encode():
+            self.redis.delete(self._dedup_key(dedup_key.decode()))
+        return True
+
+    def _job(self, job_id):
+        raw = self.redis.hgetall(self._job_key(job_id))
+        if not raw:
+            return None
+        job = {key.decode(): value for key, value in raw.items()}
+        text = {key: value.decode() for key, value in job.items() if key != 'result'}
+        return dict(
+            id=text['id'], status=text['status'], priority=int(text['priority']), dedup_key=text.get('dedup_key') or None,
+            payload=json.loads(text['payload']), progress=json.loads(text['progress']) if 'progress' in text else None,
+            attempts=int(text.get('attempts', 0)), result=unpack(job.get('result')), error=text.get('error'),
+            created_at=float(text['created_at']), started_at=float(text['started_at']) if 'started_at' in text else None,
+            updated_at=float(text['updated_at']), finished_at=float(text['finished_at']) if 'finished_at' in text else None,
+        )
+
+    def get(self, job_id):
+        return job_view(self._job(job_id))
+
+    def prune(self):
+        """Puts active jobs whose worker went quiet back in the queue (or fails them); expiry is the server's."""
+        for raw_id in self.redis.zrangebyscore(self._active_key, '-inf', time.time() - JOB_LEASE_TIMEOUT):
+            job = self._job(raw_id.decode())
+            self.redis.zrem(self._active_key, raw_id)
+            if job is None or job['status'] != ACTIVE:
+                continue
+            if job['attempts'] >= JOB_MAX_ATTEMPTS:
+                self.finish(job['id'], error='The worker running this job stopped', attempt=job['attempts'])
+                continue
+            score = self._score(job['priority'])
+            with self.redis.pipeline() as pipe:
+                try:
+                    pipe.watch(self._job_key(job['id']))
+                    if not self._owned(job['id'], job['attempts'], pipe):
+                        continue  # Finished since it was read
+                    pipe.multi()
+                    pipe.hset(self._job_key(job['id']), 'status', WAITING)
+                    pipe.zadd(self._queue_key, {job['id']: score})
+                    pipe.execute()
+                except self._watch_error:
+                    continue
+
+    def stats(self):
+        return {WAITING: self.redis.zcard(self._queue_key), ACTIVE: self.redis.zcard(self._active_key)}
+
+
+BACKENDS = {'memory': MemoryBackend, 'sqlite': SQLiteBackend, 'redis': RedisBackend}
+
+
+def create_backend(name=JOB_BACKEND):
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown JOB_BACKEND {name!r}, expected one of {', '.join(BACKENDS)}") from None
+
+
+def keep_alive(backend, job, done):
+    """Renews job's lease every JOB_HEARTBEAT_INTERVAL until done is set, so a long stage never looks like a dead worker."""
+    while not done.wait(JOB_HEARTBEAT_INTERVAL):
+        try:
+            if not backend.heartbeat(job['id'], job['attempts']):
+                logging.warning(f"Job {job['id']} attempt {job['attempts']} lost its lease")
+                return
+        except Exception as e:
+            logging.error(f"Could not renew the lease of job {job['id']}: {e}")
+
+
+def work(backend, handler, stop=None):
+    """
+    Runs jobs until stop is set: claims the next one, calls handler(payload, report_progress) and stores
+    what it returns as the result, or its exception as the error. A heartbeat thread keeps the job's lease
+    while the handler runs, and the outcome is only stored while this attempt still owns the job.
+    """
+    last_prune = 0.0
+    while stop is None or not stop.is_set():
+        if time.monotonic() - last_prune > JOB_PRUNE_INTERVAL:
+            last_prune = time.monotonic()
+            try:
+                backend.prune()
+            except Exception as e:
+                logging.error(f"Could not prune the job queue: {e}")
+        job = backend.claim()
+        if job is None:
+            continue
+        logging.info(f"Running job {job['id']} (priority {job['priority']}, attempt {job['attempts']})")
+        done = threading.Event()
+        threading.Thread(target=keep_alive, args=(backend, job, done), name=f"job-heartbeat-{job['id'][:8]}", daemon=True).start()
+        try:
+            result = handler(job['payload'], lambda progress: backend.progress(job['id'], progress, job['attempts']))
+        except Exception as e:
+            logging.error(f"Job {job['id']} failed: {e}", exc_info=not isinstance(e, Rejected))
+            outcome = dict(error=str(e) or type(e).__name__)
+        else:
+            outcome = dict(result=result)
+        finally:
+            done.set()
+        if not backend.finish(job['id'], attempt=job['attempts'], **outcome):
+            logging.warning(f"Job {job['id']} attempt {job['attempts']} no longer owns the job; its outcome was dropped")
+
+
+_local_workers_pid = None
+_local_workers_lock = threading.Lock()
+
+
+def start_local_workers(backend, handler, count=JOB_WORKERS):
+    """Runs the memory backend's jobs on daemon threads of this process (once per process)."""
+    global _local_workers_pid
+    if _local_workers_pid == os.getpid():
+        return
+    with _local_workers_lock:
+        if _local_workers_pid != os.getpid():
+            for index in range(count):
+                threading.Thread(target=work, args=(backend, handler), name=f"job-worker-{index}", daemon=True).start()
+            _local_workers_pid = os.getpid()
+
+
+job_queue = create_backend()
@@ -0,0 +1,126 @@
+"""
+Background worker processes for analysis jobs (POST /api/analyze/jobs). Each process takes jobs off the
+queue configured by JOB_BACKEND, runs them through the same result cache, PSI/CrUX lookups and history as
+/api/analyze, and stores the report as the job's result. The parent process restarts workers that die and
+stops them all on SIGTERM once their current job is done.
+
+    cd backend
+    python job_worker.py --processes 4
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from analysis_handler import analyze_url_stages, REPORT_STAGES
+from crux_handler import get_field_data
+from exclusion_rules import exclusion_rules
+from history_store import history_store
+from job_queue import job_queue, work, JOB_BACKEND, JOB_WORKERS
+from logging_config import configure_logging
+from psi_handler import start_cwv_scores, collect_cwv_scores
+from result_cache import result_cache, result_key
+import metrics
+
+load_dotenv()
+
+API_KEY = os.getenv('API_KEY')
+JOB_PSI_TIMEOUT = float(os.getenv('JOB_PSI_TIMEOUT', 120))  # Jobs have no proxy timeout to beat; PSI may take its time
+JOB_STOP_TIMEOUT = 60  # Seconds a worker gets to finish its current job on shutdown
+
+
+def run_analysis_job(payload, report_progress):
+    """
+    Runs one queued analysis: payload holds the url (option already applied), option, run_psi, run_crux
+    and force_refresh. report_progress({'stage', 'percent'}) is called as each report stage completes.
+    """
+    url, option = payload['url'], payload['option']
+    stages = [stage for stage, _ in REPORT_STAGES]
+    stages += ['psi'] if payload.get('run_psi') else []
+    stages += ['crux'] if payload.get('run_crux') else []
+
+    def progress(stage):
+        report_progress({"stage": stage, "percent": round(100 * (stages.index(stage) + 1) / len(stages))})
+
+    psi_futures = start_cwv_scores(url, API_KEY) if payload.get('run_psi') else None
+    try:
+        def compute(validators):
+            for stage, fields in analyze_url_stages(url):
+                if stage == 'report':
+                    return fields
+                progress(stage)
+
+        response_data, cache_info = result_cache.get_or_compute(
+            result_key(url, option, exclusion_rules.snapshot().version), compute, force_refresh=payload.get('force_refresh', False)
+        )
+        metrics.inc('result_cache_total', outcome=cache_info['outcome'])
+        response_data = dict(response_data, result_cache=cache_info)
+        progress(REPORT_STAGES[-1][0])
+
+        if psi_futures:
+            response_data.update(collect_cwv_scores(psi_futures, JOB_PSI_TIMEOUT))
+            psi_futures = None
+            progress('psi')
+        if payload.get('run_crux'):
+            response_data['field_data'] = get_field_data(url, API_KEY)
+            progress('crux')
+        history_store.record_analysis(url, option, response_data)
+        return response_data
+    finally:
+        for future in (psi_futures or {}).values():
+            future.cancel()
+
+
+def run_worker(index):
+    """Entry point of one worker process; SIGTERM lets the current job finish, then the process exits."""
+    configure_logging()
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent handles Ctrl-C
+    logging.info(f"Job worker {index} (pid {os.getpid()}) taking jobs from the {JOB_BACKEND} queue")
+    work(job_queue, run_analysis_job, stop)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=JOB_WORKERS, help='worker processes to run')
+    args = parser.parse_args()
+    configure_logging()
+    if JOB_BACKEND == 'memory':
+        parser.error("JOB_BACKEND=memory runs jobs inside the web workers; use sqlite or redis with job_worker.py")
+
+    # Fresh interpreters rather than forks, so no SQLite connection or pool is shared with the parent
+    context = multiprocessing.get_context('spawn')
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+    def start(index):
+        process = context.Process(target=run_worker, args=(index,), name=f"job-worker-{index}")
+        process.start()
+        return process
+
+    processes = [start(index) for index in range(max(1, args.processes))]
+    while not stopping.wait(1):
+        for index, process in enumerate(processes):
+            if not process.is_alive():
+                logging.error(f"Job worker {index} exited with code {process.exitcode}, restarting it")
+                processes[index] = start(index)
+
+    logging.info("Stopping job workers")
+    for process in processes:
+        process.terminate()  # SIGTERM: finish the current job, then exit
+    deadline = time.monotonic() + JOB_STOP_TIMEOUT
+    for process in processes:
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            process.kill()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+import atexit
+import contextvars
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Process-local counters and latency histograms, exported in Prometheus text format by /metrics.
+# Every gunicorn worker periodically writes its totals to METRICS_DIR/metrics-<pid>.json; a scrape merges
+# all of those files (counters and histogram buckets add up across workers) and folds the files of workers
+# that have exited into metrics-archive.json so their counts are not lost. Quantiles are estimated from the
+# merged buckets, so p50/p95/p99 describe the whole host rather than one worker. A worker's first flush also
+# archives the file left under its own pid by an earlier process, so a reused pid never inherits its counts.
+
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join('cache', 'metrics'))
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))  # Seconds between worker snapshots
+METRICS_PREFIX = 'checkmysite_'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+QUANTILES = (0.5, 0.95, 0.99)
+
+# name -> (type, help); every metric is declared here so /metrics can describe it
+METRICS = {
+    'stage_duration_seconds': ('histogram', 'Time spent in each analysis stage'),
+    'stage_errors_total': ('counter', 'Stages that raised, by stage'),
+    'fetch_bytes_total': ('counter', 'Page bytes read from origins'),
+    'pages_truncated_total': ('counter', 'Pages cut off at MAX_PAGE_BYTES'),
+    'result_cache_total': ('counter', 'Analyze responses by result cache outcome'),
+    'psi_cache_total': ('counter', 'PSI lookups by cache outcome'),
+    'crux_cache_total': ('counter', 'CrUX record lookups by cache outcome'),
+    'outbound_http_total': ('counter', 'Outbound HTTP client events: requests, connection reuse, DNS cache lookups'),
+    'admission_rejected_total': ('counter', 'Analyze requests answered 429, by reason'),
+    'admission_active': ('gauge', 'Page analyses running on the host'),
+    'admission_queue_depth': ('gauge', 'Page analyses waiting for a slot on the host'),
+    'jobs': ('gauge', 'Analysis jobs by status'),
+    'response_body_bytes_total': ('counter', 'JSON response bytes before compression'),
+    'response_bytes_total': ('counter', 'JSON response bytes sent, by content coding'),
+}
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+_collectors = []  # Callables returning {(name, labels): cumulative value} read at flush time
+_gauges = []  # Callables returning {(name, labels): current host-wide value} read at scrape time
+_flusher_pid = None
+_swept_pid = None  # The process that has archived the files it found at its start
+_sweep_lock = threading.Lock()
+
+# Stage timings of the request being handled, for its Server-Timing header
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+    _ensure_flusher()
+
+
+def observe(name, seconds, **labels):
+    key = (name, _labels(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram[index] += 1
+                break
+        else:
+            histogram[len(LATENCY_BUCKETS)] += 1
+        histogram[-1] += seconds
+    _ensure_flusher()
+
+
+def observe_stage(stage, seconds):
+    """Records a stage duration in the histogram and in the current request's Server-Timing."""
+    observe('stage_duration_seconds', seconds, stage=stage)
+    timings = request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def timed(stage):
+    """Times the block as `stage`; an exception also counts as a stage error."""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        inc('stage_errors_total', stage=stage)
+        raise
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def start_request():
+    """Starts collecting Server-Timing entries for the current request (context)."""
+    timings = []
+    request_timings.set(timings)
+    return timings
+
+
+def server_timing(timings):
+    """The Server-Timing header value for a request's stage timings, in milliseconds."""
+    return ', '.join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings)
+
+
+def register_collector(collector):
+    """collector() returns {(metric name, labels dict items tuple): cumulative value} for this process."""
+    _collectors.append(collector)
+
+
+def register_gauge(gauge):
+    """gauge() returns {(metric name, labels): value} for the whole host; read by the scraping worker only."""
+    _gauges.append(gauge)
+
+
+# Per-process snapshots
+
+def _snapshot():
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: list(values) for key, values in _histograms.items()}
+    for collector in _collectors:
+        for key, value in collector().items():
+            counters[key] = counters.get(key, 0) + value
+    return {
+        'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, list(labels), values] for (name, labels), values in histograms.items()],
+    }
+
+
+def _write(path, snapshot):
+    fd, temp_path = tempfile.mkstemp(dir=METRICS_DIR, prefix='.metrics-', suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(temp_path, path)
+
+
+def flush():
+    """Writes this process's totals for other workers' scrapes to merge."""
+    global _swept_pid
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with _sweep_lock:
+        if _swept_pid != os.getpid():
+            _archive_exited(starting=True)
+            _swept_pid = os.getpid()
+    _write(os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json"), _snapshot())
+
+
+def _flush_forever():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+def _ensure_flusher():
+    global _flusher_pid
+    if _flusher_pid != os.getpid():
+        with _lock:
+            if _flusher_pid != os.getpid():
+                _flusher_pid = os.getpid()
+                threading.Thread(target=_flush_forever, name='metrics-flush', daemon=True).start()
+
+
+def _exit_flush():
+    if _flusher_pid == os.getpid():
+        flush()
+
+
+atexit.register(_exit_flush)
+
+
+# Merging and exposition
+
+def _merge(into, snapshot):
+    for name, labels, value in snapshot.get('counters', []):
+        key = (name, tuple(map(tuple, labels)))
+        into['counters'][key] = into['counters'].get(key, 0) + value
+    for name, labels, values in snapshot.get('histograms', []):
+        key = (name, tuple(map(tuple, labels)))
+        current = into['histograms'].get(key)
+        into['histograms'][key] = values if current is None else [a + b for a, b in zip(current, values)]
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _archive_exited(starting=False):
+    """
+    Folds the files of exited workers into metrics-archive.json and returns (archive, live snapshots). When
+    starting, the file under this process's own pid is an exited one too: an earlier process had the pid.
+    """
+    live = []
+    archive_path = os.path.join(METRICS_DIR, 'metrics-archive.json')
+    with open(os.path.join(METRICS_DIR, '.metrics.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive = {'counters': {}, 'histograms': {}}
+        _merge(archive, _read(archive_path))
+        archived_any = False
+        for name in os.listdir(METRICS_DIR):
+            if not (name.startswith('metrics-') and name.endswith('.json')) or name == 'metrics-archive.json':
+                continue
+            path = os.path.join(METRICS_DIR, name)
+            snapshot = _read(path)
+            pid = int(name[len('metrics-'):-len('.json')])
+            if (starting and pid == os.getpid()) or (pid != os.getpid() and not _alive(pid)):
+                # Exited worker: keep its totals in the archive so counters never go backwards
+                _merge(archive, snapshot)
+                os.remove(path)
+                archived_any = True
+            else:
+                live.append(snapshot)
+        if archived_any:
+            _write(archive_path, {
+                'counters': [[name, list(labels), value] for (name, labels), value in archive['counters'].items()],
+                'histograms': [[name, list(labels), values] for (name, labels), values in archive['histograms'].items()],
+            })
+    return archive, live
+
+
+def collect():
+    """Merged totals of every worker on the host, past and present."""
+    flush()
+    merged = {'counters': {}, 'histograms': {}}
+    archive, live = _archive_exited()
+    for snapshot in live:
+        _merge(merged, snapshot)
+    for kind in ('counters', 'histograms'):
+        for key, value in archive[kind].items():
+            current = merged[kind].get(key)
+            if current is None:
+                merged[kind][key] = value
+            elif kind == 'counters':
+                merged[kind][key] = current + value
+            else:
+                merged[kind][key] = [a + b for a, b in zip(current, value)]
+    return merged
+
+
+def quantile(buckets, q):
+    """Estimates the q-quantile from cumulative-free bucket counts by interpolating inside the bucket."""
+    total = sum(buckets)
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0
+    lower = 0.0
+    for index, count in enumerate(buckets):
+        upper = LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else LATENCY_BUCKETS[-1]
+        if count and seen + count >= rank:
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+        lower = upper
+    return LATENCY_BUCKETS[-1]
+
+
+def _escape(value):
+    """A label value as the text format needs it: backslash, double quote and newline escaped."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def render():
+    """Prometheus text exposition of the merged metrics."""
+    merged = collect()
+    for gauge in _gauges:
+        merged['counters'].update(gauge())
+    lines = []
+    names = sorted({name for name, _ in merged['counters']} | {name for name, _ in merged['histograms']})
+    for name in names:
+        kind, help_text = METRICS.get(name, ('counter', name.replace('_', ' ')))
+        full_name = METRICS_PREFIX + name
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        if kind != 'histogram':
+            for (metric, labels), value in sorted(merged['counters'].items()):
+                if metric == name:
+                    lines.append(f"{full_name}{_format_labels(labels)} {value}")
+            continue
+
+        series = sorted((labels, values) for (metric, labels), values in merged['histograms'].items() if metric == name)
+        for labels, values in series:
+            buckets, total_seconds = values[:-1], values[-1]
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                cumulative += count
+                lines.append(f"{full_name}_bucket{_format_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{full_name}_sum{_format_labels(labels)} {round(total_seconds, 6)}")
+            lines.append(f"{full_name}_count{_format_labels(labels)} {cumulative}")
+        quantile_name = full_name.replace('_seconds', '_quantile_seconds')
+        lines.append(f"# HELP {quantile_name} {help_text}, p50/p95/p99 estimated from the merged buckets")
+        lines.append(f"# TYPE {quantile_name} gauge")
+        for labels, values in series:
+            for q in QUANTILES:
+                lines.append(f"{quantile_name}{_format_labels(labels, quantile=q)} {round(quantile(values[:-1], q), 6)}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,326 @@
+import asyncio
+import codecs
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import http_client
+from requests.exceptions import RequestException
+from requests.utils import get_encoding_from_headers
+
+from html_inventory import create_parser, parse_page, HTML_PARSER
+
+# Upper bound on the (decompressed) page bytes read per analysis; anything beyond is dropped and flagged
+MAX_PAGE_BYTES = int(os.getenv('MAX_PAGE_BYTES', 5 * 1024 * 1024))
+FETCH_CHUNK_SIZE = int(os.getenv('FETCH_CHUNK_SIZE', 64 * 1024))
+FETCH_CONNECT_TIMEOUT = float(os.getenv('FETCH_CONNECT_TIMEOUT', 10))
+FETCH_READ_TIMEOUT = float(os.getenv('FETCH_READ_TIMEOUT', 30))
+
+# Parsing large pages off the request thread: with PARSE_PROCESSES > 0 the body is kept as it streams in
+# and pages of PARSE_OFFLOAD_BYTES or more are parsed in a per-worker process pool, so one huge page does
+# not hold the GIL for the other requests of the worker. Smaller pages are parsed inline, as they would
+# be with the pool off, since shipping them to a process costs more than parsing them.
+PARSE_PROCESSES = int(os.getenv('PARSE_PROCESSES', 0))
+PARSE_OFFLOAD_BYTES = int(os.getenv('PARSE_OFFLOAD_BYTES', 512 * 1024))
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+}
+
+# Performance plugins detected by their asset path (matched case-insensitively), with the name reported
+# for each. Adding a tool here is all it takes for it to be picked up.
+PERFORMANCE_TOOLS = {
+    '/plugins/perfmatters': 'Perfmatters',
+    '/plugins/wp-rocket': 'WP Rocket',
+    '/plugins/litespeed-cache': 'LiteSpeed Cache',
+    '/plugins/flying-press': 'FlyingPress',
+}
+
+# Bytes after an asset path searched for its ?ver= (the rest of the URL, then the query string)
+ASSET_VERSION_LOOKAHEAD = 400
+
+# One pass over the raw bytes finds plugin/theme slugs referenced anywhere in the markup, the ?ver= of
+# the asset URL that follows (when there is one) and the performance-tool markers. The version is
+# matched in a lookahead so the scan resumes right after the slug, and both branches share the leading
+# '/' so the regex engine can still skip ahead to candidate positions.
+ASSET_SCAN_PATTERN = re.compile(
+    rb'/(?:wp-content/(plugins|themes)/([^/]+)'
+    rb'(?:(?=/[^"\'\s?#<>]{0,256}\?(?:[^"\'\s#<>]{0,96}?&(?:amp;|#038;)?)?ver=([\w.\-]{1,32}))|)'
+    rb'|(?i:plugins/(' + b'|'.join(re.escape(marker[len('/plugins/'):].encode()) for marker in PERFORMANCE_TOOLS) + rb')))'
+)
+ASSET_SCAN_CARRY = max(len(b'/wp-content/plugins/'), *map(len, PERFORMANCE_TOOLS)) - 1
+ASSET_SCAN_MAX_DEFER = 4096  # A match starting further back than this is taken as is rather than carried
+
+META_CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset=["\']?([a-zA-Z0-9_-]+)', re.IGNORECASE)
+
+# The facts kept about a fetched page; the page body itself is never retained
+FetchedPage = namedtuple('FetchedPage', [
+    'url', 'status_code', 'headers', 'inventory', 'plugins', 'themes', 'markers', 'versions',
+    'bytes_read', 'truncated', 'parse_ms', 'timing',
+])
+
+
+_parse_pool = None
+_parse_pool_pid = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    """Returns the worker's parse process pool, starting it on first use (and again after a fork)."""
+    global _parse_pool, _parse_pool_pid
+    if _parse_pool is None or _parse_pool_pid != os.getpid():
+        with _parse_pool_lock:
+            if _parse_pool is None or _parse_pool_pid != os.getpid():
+                # Fresh interpreters: a forked child would inherit the worker's threads and sockets
+                _parse_pool = ProcessPoolExecutor(PARSE_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+                _parse_pool_pid = os.getpid()
+    return _parse_pool
+
+
+def _reset_parse_pool(pool):
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is pool:
+            _parse_pool = None
+
+
+class PageCollector:
+    """
+    Consumes the page body chunk by chunk: scans the raw bytes for plugin/theme paths, asset versions and
+    performance-tool markers, then decodes the chunk for the inventory parser. Only a short tail is
+    carried between chunks, so memory depends on the extracted facts rather than on the page size (unless
+    the parse pool is on, which needs the body in one piece).
+    """
+
+    def __init__(self, content_type='', max_bytes=MAX_PAGE_BYTES, backend=None):
+        self.backend = backend or HTML_PARSER
+        self.parser = create_parser(self.backend)
+        self._inventory = None  # Set when the page was parsed in the pool
+        self._body = [] if PARSE_PROCESSES > 0 else None  # Raw chunks kept for the pool
+        self.plugins = set()
+        self.themes = set()
+        self.markers = set()
+        self.versions = {'plugins': {}, 'themes': {}}  # slug -> Counter of the ?ver= values seen
+        self.content_type = content_type
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+        self.truncated = False
+        self.parse_seconds = 0.0
+        self._encoding = None
+        self._decoder = None
+        self._carry = b''  # Unscanned tail that may hold the start of a path split across chunks
+
+    def feed_bytes(self, chunk):
+        """Scans, decodes and parses one raw chunk. Returns False once the byte budget is exhausted."""
+        if self._decoder is None:
+            encoding = detect_encoding(self.content_type, chunk)
+            try:
+                self._decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+                self._encoding = encoding
+            except LookupError:
+                self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+                self._encoding = 'utf-8'
+        if self.bytes_read + len(chunk) > self.max_bytes:
+            chunk = chunk[:self.max_bytes - self.bytes_read]
+            self.truncated = True
+        self.bytes_read += len(chunk)
+        started = time.perf_counter()
+        self._scan(chunk, final=False)
+        if self._body is not None:
+            self._body.append(chunk)
+        else:
+            self.parser.feed(self._decoder.decode(chunk))
+        self.parse_seconds += time.perf_counter() - started
+        return not self.truncated
+
+    def close(self):
+        if self._body is not None and self.bytes_read >= PARSE_OFFLOAD_BYTES:
+            self._parse_in_pool()
+        started = time.perf_counter()
+        if self._inventory is None:
+            if self._body:
+                self.parser.feed(self._decoder.decode(b''.join(self._body)))
+            if self._decoder is not None:
+                self.parser.feed(self._decoder.decode(b'', final=True))
+            self.parser.close()
+        self._scan(b'', final=True)
+        self._body = None
+        self.parse_seconds += time.perf_counter() - started
+
+    def _parse_in_pool(self):
+        """Parses the kept body in the parse pool; on failure the caller parses it inline instead."""
+        pool = get_parse_pool()
+        try:
+            self._inventory, seconds = pool.submit(parse_page, b''.join(self._body), self._encoding, self.backend).result()
+        except BrokenProcessPool as e:
+            logging.error(f"Parse pool failed ({e}), parsing inline")
+            _reset_parse_pool(pool)
+            return
+        self.parse_seconds += seconds
+
+    def inventory(self):
+        return self._inventory if self._inventory is not None else self.parser.inventory()
+
+    def _scan(self, chunk, final):
+        buffer = self._carry + chunk
+        keep_from = max(0, len(buffer) - ASSET_SCAN_CARRY)
+        for match in ASSET_SCAN_PATTERN.finditer(buffer):
+            if (not final and len(buffer) - match.end() < ASSET_VERSION_LOOKAHEAD
+                    and len(buffer) - match.start() <= ASSET_SCAN_MAX_DEFER):
+                # The slug or its version may continue in the next chunk; rescan it once more bytes arrive
+                keep_from = min(keep_from, match.start())
+                break
+            kind, slug, version, marker = match.groups()
+            if marker is not None:
+                self.markers.add(f"/plugins/{marker.decode('ascii').lower()}")
+                continue
+            kind = kind.decode('ascii')
+            slug = slug.decode(self._encoding or 'utf-8', errors='replace')
+            (self.plugins if kind == 'plugins' else self.themes).add(slug)
+            if kind == 'plugins':
+                # The marker text lies inside the asset path, which the asset branch has already consumed
+                path = f"/plugins/{slug.lower()}"
+                self.markers.update(marker for marker in PERFORMANCE_TOOLS if path.startswith(marker))
+            if version is not None:
+                versions = self.versions[kind].setdefault(slug, Counter())
+                versions[version.decode('ascii')] += 1
+        self._carry = b'' if final else buffer[keep_from:]
+
+    def asset_versions(self):
+        """{'plugins': {slug: version}, 'themes': {...}}: the ?ver= most of each slug's assets carry."""
+        return {kind: {slug: counts.most_common(1)[0][0] for slug, counts in sorted(slugs.items())}
+                for kind, slugs in self.versions.items()}
+
+    def result(self, url, status_code, headers, timing=None):
+        """Freezes the collected facts into a FetchedPage; timing is the fetch's http_client timing block."""
+        if self.truncated:
+            logging.warning(f"Page {url} exceeded {self.max_bytes} bytes, analysis truncated")
+        return FetchedPage(
+            url=url,
+            status_code=status_code,
+            headers=headers,
+            inventory=self.inventory(),
+            plugins=self.plugins,
+            themes=self.themes,
+            markers=self.markers,
+            versions=self.asset_versions(),
+            bytes_read=self.bytes_read,
+            truncated=self.truncated,
+            parse_ms=round(self.parse_seconds * 1000, 2),
+            timing=timing,
+        )
+
+
+class CrossOriginRedirect(RequestException):
+    """Raised when a fetch limited to one origin was redirected off it."""
+
+
+def detect_encoding(content_type, first_chunk):
+    """Uses the charset from the Content-Type header, then a <meta charset> in the first chunk, then UTF-8."""
+    if 'charset' in content_type.lower():
+        return get_encoding_from_headers({'content-type': content_type})
+    match = META_CHARSET_PATTERN.search(first_chunk[:4096])
+    if match:
+        return match.group(1).decode('ascii')
+    return 'utf-8'
+
+
+def fetch_page(url, headers=None, max_bytes=MAX_PAGE_BYTES, origin=None):
+    """
+    Streams the page at url into a PageCollector, stopping once max_bytes have been read.
+    Raises requests exceptions for network errors and non-2xx responses, and CrossOriginRedirect
+    (before any of the body is read) when origin is given and the redirects ended somewhere else.
+    """
+    *_, page = iter_page(url, headers, max_bytes, origin)
+    return page
+
+
+def fetch_text(url, headers=None, max_bytes=MAX_PAGE_BYTES):
+    """
+    The body of a small side document (robots.txt) as text, reading at most max_bytes of it.
+    Raises requests exceptions for network errors and non-2xx responses.
+    """
+    response = http_client.get(url, headers=headers or DEFAULT_HEADERS, stream=True,
+                               timeout=(FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT))
+    with response:
+        response.raise_for_status()
+        body = bytearray()
+        for chunk in response.iter_content(chunk_size=FETCH_CHUNK_SIZE):
+            body += chunk[:max_bytes - len(body)]
+            if len(body) >= max_bytes:
+                logging.warning(f"{url} exceeded {max_bytes} bytes, the rest was not read")
+                break
+    return body.decode(response.encoding or 'utf-8', errors='replace')
+
+
+def iter_page(url, headers=None, max_bytes=MAX_PAGE_BYTES, origin=None):
+    """
+    Generator form of fetch_page: yields (status_code, headers) as soon as the response headers arrive,
+    then the FetchedPage once the body has been read and parsed.
+    """
+    with http_client.record_timing() as timing:
+        response = http_client.get(
+            url,
+            headers=headers or DEFAULT_HEADERS,
+            stream=True,
+            timeout=(FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT),
+        )
+    with response:
+        logging.info(f"Response status code: {response.status_code}")
+        response.raise_for_status()
+        if origin is not None:
+            final = urlsplit(response.url)
+            if f"{final.scheme}://{final.netloc}".lower() != origin.lower():
+                raise CrossOriginRedirect(f"Redirected to {response.url}, outside {origin}")
+        yield response.status_code, response.headers
+
+        collector = PageCollector(response.headers.get('content-type', ''), max_bytes)
+        download_started = time.perf_counter()
+        for chunk in response.iter_content(chunk_size=FETCH_CHUNK_SIZE):
+            if chunk and not collector.feed_bytes(chunk):
+                break
+        download = time.perf_counter() - download_started - collector.parse_seconds
+        collector.close()
+        # raw.tell() counts the bytes as they came over the wire, before any content decoding
+        timing = timing.report(download, response.raw.tell(), collector.bytes_read, response.headers.get('content-encoding'))
+
+    yield collector.result(url, response.status_code, response.headers, timing)
+
+
+async def fetch_page_async(url, headers=None, max_bytes=MAX_PAGE_BYTES, executor=None):
+    """
+    Async counterpart of fetch_page over the loop's pooled aiohttp session. Network waits never block
+    the loop; decoding and parsing of each chunk run on executor.
+    Raises aiohttp.ClientError for network errors and non-2xx responses.
+    """
+    loop = asyncio.get_running_loop()
+    timeout = aiohttp.ClientTimeout(sock_connect=FETCH_CONNECT_TIMEOUT, sock_read=FETCH_READ_TIMEOUT)
+    session = http_client.get_async_session()
+    timing = http_client.RequestTiming()
+    async with session.get(url, headers=headers or DEFAULT_HEADERS, timeout=timeout, trace_request_ctx=timing) as response:
+        logging.info(f"Response status code: {response.status}")
+        response.raise_for_status()
+
+        collector = PageCollector(response.headers.get('content-type', ''), max_bytes)
+        download_started = time.perf_counter()
+        async for chunk in response.content.iter_chunked(FETCH_CHUNK_SIZE):
+            if chunk and not await loop.run_in_executor(executor, collector.feed_bytes, chunk):
+                break
+        download = time.perf_counter() - download_started - collector.parse_seconds
+        await loop.run_in_executor(executor, collector.close)
+
+    # aiohttp only hands out the decoded body; the wire size is known from Content-Length, or when unencoded
+    encoding = response.headers.get('content-encoding')
+    length = response.headers.get('content-length')
+    transfer_bytes = int(length) if length and length.isdigit() else None if encoding else collector.bytes_read
+    return collector.result(url, response.status, response.headers,
+                            timing.report(download, transfer_bytes, collector.bytes_read, encoding))
@@ -1,14 +1,33 @@
 import aiohttp
 import asyncio
 import logging
-import aiodns
+import os
 import ujson  # Faster JSON parsing
+from concurrent.futures import wait
 from time import time
 from logging_config import configure_logging  # Import the logging configuration function
+from http_client import get_async_session
+from background_loop import submit
+from result_cache import ResultCache, result_key
+from metrics import timed, inc
 
 # Configure logging
 configure_logging()
 
+PSI_PLATFORMS = ('mobile', 'desktop')
+PSI_BUDGET = float(os.getenv('PSI_BUDGET', 45))  # Seconds /api/analyze waits for PSI before answering without it
+PSI_CACHE_FRESH = float(os.getenv('PSI_CACHE_FRESH', 3600))  # Seconds a score is served without a new PSI run
+PSI_CACHE_STALE = float(os.getenv('PSI_CACHE_STALE', 86400))  # Older scores are still served (and refreshed) up to this age
+PSI_CACHE_LRU_SIZE = int(os.getenv('PSI_CACHE_LRU_SIZE', 512))
+PSI_REQUEST_TIMEOUT = 30  # Seconds per PSI attempt; fetch_psi_data_async makes up to 4, backing off 1, 2 and 4 seconds
+PSI_LEASE_TIMEOUT = float(os.getenv('PSI_LEASE_TIMEOUT', 150))  # Longer than a run's worst case (4 x 30 + 7 = 127s)
+
+# PSI scores per (url, strategy), shared by the workers through the result cache's SQLite file
+psi_cache = ResultCache(ttl=PSI_CACHE_FRESH, lru_size=PSI_CACHE_LRU_SIZE, max_age=PSI_CACHE_STALE, table='psi_results',
+                        lease_timeout=PSI_LEASE_TIMEOUT)
+_psi_refreshes = {}  # Cache key -> asyncio.Task of the one PSI run in progress for it (background loop only)
+_psi_stats = {'fresh': 0, 'stale': 0, 'miss': 0, 'coalesced': 0, 'refreshes': 0}
+
 # Asynchronous function to fetch PSI data
 async def fetch_psi_data_async(url, api_key, platform, retries=3):
     start_time = time()  # Track start time
@@ -16,43 +35,35 @@ async def fetch_psi_data_async(url, api_key, platform, retries=3):
 
     psi_api_url = f"https://www.googleapis.com/pagespeedonline/v5/runPagespeed?url={url}&key={api_key}&strategy={platform}"
 
-    # Use aiodns with aiohttp for asynchronous DNS resolution
-    resolver = aiodns.DNSResolver()  # Initialize the aiodns resolver
-    connector = aiohttp.TCPConnector(
-        resolver=aiohttp.AsyncResolver(),
-        limit=100,  # Limit total simultaneous connections
-        limit_per_host=50,  # Limit per host
-        ttl_dns_cache=300  # Enable DNS caching for 5 minutes
-    )
-
     # Define a timeout for the request
-    timeout = aiohttp.ClientTimeout(total=30)  # Total timeout of 30 seconds
+    timeout = aiohttp.ClientTimeout(total=PSI_REQUEST_TIMEOUT)
 
     try:
-        async with aiohttp.ClientSession(connector=connector, json_serialize=ujson.dumps, timeout=timeout) as session:
-            async with session.get(psi_api_url) as response:
-                response.raise_for_status()  # Raise an error for non-2xx responses
-                psi_data = await response.json(loads=ujson.loads)  # Use ujson for faster JSON parsing
-
-                lighthouse_metrics = psi_data['lighthouseResult']['audits']
-                overall_score = psi_data['lighthouseResult']['categories']['performance']['score'] * 100
-
-                cwv_scores = {
-                    'LCP': lighthouse_metrics['largest-contentful-paint']['numericValue'] / 1000,  # ms to seconds
-                    'CLS': lighthouse_metrics['cumulative-layout-shift']['numericValue'],
-                    'TBT': lighthouse_metrics['total-blocking-time']['numericValue'] / 1000,  # ms to seconds
-                    'overall_score': overall_score
-                }
-
-                end_time = time()  # Track end time
-                total_time = end_time - start_time  # Calculate total time taken
-                logging.info(f"PSI_LOGS: Finished async PSI request for {url} ({platform}) in {total_time:.2f} seconds")
-                logging.info(f"PSI_LOGS: Core Web Vitals for {url} ({platform}): LCP = {cwv_scores['LCP']}s, CLS = {cwv_scores['CLS']}, TBT = {cwv_scores['TBT']}s, Overall Score = {overall_score}")
-
-                # Log performance to file in readable format
-                logging.info(f"PERF_LOG: Site URL: {url} -- Platform: {platform} -- Total Time: {total_time:.2f} seconds\n")
-
-                return platform, cwv_scores
+        # Reuse the worker's pooled session (keep-alive connections and cached DNS for googleapis.com)
+        session = get_async_session()
+        async with session.get(psi_api_url, timeout=timeout) as response:
+            response.raise_for_status()  # Raise an error for non-2xx responses
+            psi_data = await response.json(loads=ujson.loads)  # Use ujson for faster JSON parsing
+
+            lighthouse_metrics = psi_data['lighthouseResult']['audits']
+            overall_score = psi_data['lighthouseResult']['categories']['performance']['score'] * 100
+
+            cwv_scores = {
+                'LCP': lighthouse_metrics['largest-contentful-paint']['numericValue'] / 1000,  # ms to seconds
+                'CLS': lighthouse_metrics['cumulative-layout-shift']['numericValue'],
+                'TBT': lighthouse_metrics['total-blocking-time']['numericValue'] / 1000,  # ms to seconds
+                'overall_score': overall_score
+            }
+
+            end_time = time()  # Track end time
+            total_time = end_time - start_time  # Calculate total time taken
+            logging.info(f"PSI_LOGS: Finished async PSI request for {url} ({platform}) in {total_time:.2f} seconds")
+            logging.info(f"PSI_LOGS: Core Web Vitals for {url} ({platform}): LCP = {cwv_scores['LCP']}s, CLS = {cwv_scores['CLS']}, TBT = {cwv_scores['TBT']}s, Overall Score = {overall_score}")
+
+            # Log performance to file in readable format
+            logging.info(f"PERF_LOG: Site URL: {url} -- Platform: {platform} -- Total Time: {total_time:.2f} seconds\n")
+
+            return platform, cwv_scores
     except aiohttp.ClientError as e:
         # Retry logic in case of failure
         if retries > 0:
@@ -69,14 +80,111 @@ async def fetch_psi_data_async(url, api_key, platform, retries=3):
 
 # Asynchronous function to run PSI tests for mobile and desktop
 async def get_cwv_score(url, api_key):
-    platforms = ['mobile', 'desktop']
+    platforms = PSI_PLATFORMS
     tasks = []
 
     # Launch both requests asynchronously
     for platform in platforms:
-        tasks.append(fetch_psi_data_async(url, api_key, platform))
+        tasks.append(fetch_psi_data_async_cached(url, api_key, platform))
 
     results = await asyncio.gather(*tasks)  # Run tasks concurrently
 
-    return {platform: cwv_scores for platform, cwv_scores in results if cwv_scores is not None}
+    return {platform: cwv_scores for platform, cwv_scores, _ in results if cwv_scores is not None}
+
+# Run PSI for the key and store the scores; failed runs leave the cached scores in place. The run holds
+# psi_cache's cross-worker lease, so while another worker refreshes the key this waits for its scores
+# instead of spending a second PSI run on them. Returns (cwv_scores or None, cache outcome).
+async def refresh_psi_data(key, url, api_key, platform):
+    async def run_psi(validators):
+        _psi_stats['refreshes'] += 1
+        with timed('psi'):
+            _, cwv_scores = await fetch_psi_data_async(url, api_key, platform)
+        if cwv_scores is None:
+            inc('stage_errors_total', stage='psi')
+            raise RuntimeError("PSI returned no scores")  # Nothing is stored, so the old scores stay
+        return cwv_scores, None
 
+    try:
+        cwv_scores, cache_info = await psi_cache.get_or_compute_async(key, run_psi, force_refresh=True)
+        return cwv_scores, cache_info['outcome']
+    except Exception as e:
+        # Nobody may be awaiting a stale-while-revalidate refresh, so report the failure here
+        logging.error(f"PSI_LOGS: Refreshing {platform} scores for {url} failed: {e}")
+        return None, 'error'
+    finally:
+        _psi_refreshes.pop(key, None)
+
+# Cached fetch_psi_data_async: returns (platform, cwv_scores, cache_info). Fresh scores are returned as-is,
+# stale ones immediately while one background run refreshes them, and concurrent misses share one run,
+# within the worker through _psi_refreshes and across workers through psi_cache's lease.
+# Must run on the background loop so every caller sees the same _psi_refreshes.
+async def fetch_psi_data_async_cached(url, api_key, platform):
+    key = result_key(url, platform)
+    cwv_scores, age = await asyncio.to_thread(psi_cache.peek, key)
+    if cwv_scores is not None and age < PSI_CACHE_FRESH:
+        _psi_stats['fresh'] += 1
+        inc('psi_cache_total', outcome='fresh')
+        return platform, cwv_scores, {'status': 'fresh', 'age_seconds': round(age, 1)}
+
+    refresh = _psi_refreshes.get(key)
+    coalesced = refresh is not None
+    if not coalesced:
+        refresh = _psi_refreshes[key] = asyncio.ensure_future(refresh_psi_data(key, url, api_key, platform))
+
+    if cwv_scores is not None:
+        _psi_stats['stale'] += 1
+        inc('psi_cache_total', outcome='stale')
+        logging.info(f"PSI_LOGS: Serving {age:.0f}s old {platform} scores for {url} while they refresh")
+        return platform, cwv_scores, {'status': 'stale', 'age_seconds': round(age, 1)}
+
+    _psi_stats['coalesced' if coalesced else 'miss'] += 1
+    inc('psi_cache_total', outcome='coalesced' if coalesced else 'miss')
+    # Shielded: a caller that gives up (PSI budget) must not cancel the run other callers share
+    cwv_scores, outcome = await asyncio.shield(refresh)
+    # 'coalesced' also when the run was another worker's
+    coalesced = coalesced or outcome == 'coalesced'
+    return platform, cwv_scores, {'status': 'coalesced' if coalesced else 'miss', 'age_seconds': 0.0}
+
+def psi_cache_stats():
+    return dict(_psi_stats, refreshing=len(_psi_refreshes))
+
+
+# Start the mobile and desktop PSI lookups on the worker's background loop; returns {platform: Future}
+def start_cwv_scores(url, api_key):
+    return {platform: submit(fetch_psi_data_async_cached(url, api_key, platform)) for platform in PSI_PLATFORMS}
+
+# Collect whatever PSI lookups finished within timeout seconds. Callers still waiting are cancelled, but
+# the PSI runs themselves finish in the background and land in the cache for the next request.
+def collect_cwv_scores(futures, timeout):
+    wait(futures.values(), timeout=max(timeout, 0))
+    cwv_scores = {}
+    psi_cache_info = {}
+    pending = []
+    for platform, future in futures.items():
+        if not future.done():
+            future.cancel()
+            pending.append(platform)
+            logging.info(f"PSI_LOGS: {platform} run exceeded the {PSI_BUDGET}s budget, returning without it")
+            continue
+        try:
+            _, scores, cache_info = future.result()
+        except Exception as e:
+            logging.error(f"PSI_LOGS: {platform} run failed: {e}")
+            continue
+        if scores is not None:
+            cwv_scores[platform] = scores
+            psi_cache_info[platform] = cache_info
+
+    if len(cwv_scores) == len(futures):
+        psi_status = "complete"
+    elif cwv_scores:
+        psi_status = "partial"
+    else:
+        psi_status = "timeout" if pending else "failed"
+    return {"cwv_scores": cwv_scores, "psi_status": psi_status, "psi_pending": pending, "psi_cache": psi_cache_info}
+
+# Awaitable version of collect_cwv_scores for the ASGI path; waits without blocking the caller's loop
+async def collect_cwv_scores_async(futures, timeout):
+    if timeout > 0:
+        await asyncio.wait([asyncio.wrap_future(future) for future in futures.values()], timeout=timeout)
+    return collect_cwv_scores(futures, 0)
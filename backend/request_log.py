@@ -0,0 +1,113 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from metrics import inc
+
+# Structured request log. The request thread only enqueues a dict; one background thread per worker drains
+# the queue in batches and appends them as JSON lines to size-rotated segment files. Each worker writes its
+# own segments, so the workers never contend for a file, and old segments are pruned by count.
+
+REQUEST_LOG_ENABLED = os.getenv('REQUEST_LOG_ENABLED', 'true').lower() in ('true', '1')
+REQUEST_LOG_DIR = os.getenv('REQUEST_LOG_DIR', os.path.join('logs', 'requests'))
+REQUEST_LOG_SEGMENT_BYTES = int(os.getenv('REQUEST_LOG_SEGMENT_BYTES', 16 * 1024 * 1024))  # Rotate to a new segment past this size
+REQUEST_LOG_KEEP = int(os.getenv('REQUEST_LOG_KEEP', 50))  # Segments kept across all workers
+REQUEST_LOG_QUEUE_SIZE = int(os.getenv('REQUEST_LOG_QUEUE_SIZE', 10000))  # Records beyond this are dropped, never waited on
+REQUEST_LOG_BATCH = 500
+REQUEST_LOG_FLUSH_INTERVAL = 1.0  # Seconds a record may wait for its batch
+
+
+class RequestLog:
+    """Queue plus background writer; a worker forked from a parent that already logged starts its own."""
+
+    def __init__(self, directory=REQUEST_LOG_DIR, segment_bytes=REQUEST_LOG_SEGMENT_BYTES, keep=REQUEST_LOG_KEEP,
+                 queue_size=REQUEST_LOG_QUEUE_SIZE):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.keep = keep
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._queue = None
+        self._writer = None
+        self._pid = None
+        self._segment = None  # Open file of the current segment
+        self.dropped = 0
+
+    def enqueue(self, record):
+        """Hands a record to the writer. Never blocks: when the writer has fallen behind the record is dropped."""
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            inc('request_log_dropped_total')
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.queue_size)
+            self._segment = None
+            self._writer = threading.Thread(target=self._run, name='request-log', daemon=True)
+            self._pid = os.getpid()
+            self._writer.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + REQUEST_LOG_FLUSH_INTERVAL
+            while len(batch) < REQUEST_LOG_BATCH:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            stop = None in batch
+            try:
+                self._write([record for record in batch if record is not None])
+            except (OSError, TypeError, ValueError) as e:
+                logging.error(f"Could not write {len(batch)} request log records: {e}")
+            if stop:
+                return
+
+    def _write(self, records):
+        if not records:
+            return
+        data = ''.join(json.dumps(record, separators=(',', ':'), default=str) + '\n' for record in records)
+        if self._segment is None or self._segment.tell() >= self.segment_bytes:
+            self._rotate()
+        self._segment.write(data)
+        self._segment.flush()
+
+    def _rotate(self):
+        if self._segment is not None:
+            self._segment.close()
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"requests-{time.strftime('%Y%m%d_%H%M%S')}-{os.getpid()}.jsonl"
+        self._segment = open(os.path.join(self.directory, name), 'a')
+        segments = sorted(name for name in os.listdir(self.directory) if name.startswith('requests-'))
+        for old in segments[:-self.keep]:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except FileNotFoundError:
+                pass  # Another worker pruned it first
+
+    def close(self, timeout=5):
+        """Writes out what is queued and stops the writer (at exit)."""
+        if self._pid != os.getpid() or not self._writer.is_alive():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._writer.join(timeout)
+        if self._segment is not None:
+            self._segment.close()
+
+
+request_log = RequestLog()
+atexit.register(request_log.close)
@@ -0,0 +1,169 @@
+import gzip
+import hashlib
+import os
+import time
+
+import ujson
+from flask.json.provider import DefaultJSONProvider
+
+from metrics import inc, observe_stage
+from result_cache import ResultCache, RESULT_CACHE_MAX_AGE
+
+try:
+    import brotli  # Optional: without it responses are only gzip-compressed
+except ImportError:
+    brotli = None
+
+# How analysis reports go over the wire: field selection, inline script bodies replaced by content hashes
+# (fetched separately from /api/inline-scripts/<hash>), weak ETags over the report, ujson encoding and
+# gzip/brotli negotiated from Accept-Encoding. Shared by the Flask routes and the ASGI /api/analyze.
+
+RESPONSE_COMPRESSION = os.getenv('RESPONSE_COMPRESSION', 'true').lower() in ('true', '1')
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv('RESPONSE_COMPRESS_MIN_BYTES', 1024))  # Smaller bodies gain nothing
+RESPONSE_GZIP_LEVEL = int(os.getenv('RESPONSE_GZIP_LEVEL', 6))
+RESPONSE_BROTLI_QUALITY = int(os.getenv('RESPONSE_BROTLI_QUALITY', 5))  # 5 is close to gzip's speed, well below its size
+INLINE_SCRIPT_TTL = float(os.getenv('INLINE_SCRIPT_TTL', RESULT_CACHE_MAX_AGE))  # Seconds a script body stays fetchable
+
+# Script bodies by hash, shared by the workers through the result cache's SQLite file
+inline_script_cache = ResultCache(ttl=INLINE_SCRIPT_TTL, lru_size=2048, max_age=INLINE_SCRIPT_TTL, table='inline_scripts')
+
+
+class UJSONProvider(DefaultJSONProvider):
+    """
+    Flask's JSON provider with ujson doing the encoding. Keys keep the report's order and non-ASCII text
+    is sent as UTF-8 rather than escaped; types ujson can't encode go through Flask's default().
+    """
+    ensure_ascii = False
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        started = time.perf_counter()
+        try:
+            return ujson.dumps(obj, ensure_ascii=self.ensure_ascii, sort_keys=kwargs.get('sort_keys', self.sort_keys),
+                               indent=kwargs.get('indent') or 0, escape_forward_slashes=False, default=self.default)
+        except OverflowError:  # Integers beyond 64 bits
+            return super().dumps(obj, **kwargs)
+        finally:
+            observe_stage('serialize', time.perf_counter() - started)
+
+
+def encode_json(payload):
+    """payload as compact UTF-8 JSON bytes, the way UJSONProvider encodes it."""
+    started = time.perf_counter()
+    body = ujson.dumps(payload, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+    observe_stage('serialize', time.perf_counter() - started)
+    return body
+
+
+# Field selection and inline scripts
+
+def parse_fields(value):
+    """The `fields` of a request, a list or a comma-separated string, as a list; None selects every field."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, list) or not all(isinstance(field, str) for field in value):
+        raise ValueError("fields must be a list of report field names or a comma-separated string")
+    return [field.strip() for field in value if field.strip()]
+
+
+def parse_flag(value, default=True):
+    """A boolean request option given as JSON or as a query-string value ('false', '0', 'no')."""
+    if value is None:
+        return default
+    if isinstance(value, str):
+        return value.strip().lower() not in ('false', '0', 'no', 'off', '')
+    return bool(value)
+
+
+def script_hash(body):
+    """128-bit content hash of a script body, as 32 hex digits."""
+    return hashlib.blake2b(body.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def inline_refs(scripts):
+    """Stores each script body under its hash and returns [{hash, bytes}] in place of the bodies."""
+    refs = []
+    for body in scripts:
+        digest = script_hash(body)
+        if inline_script_cache.peek(digest)[0] is None:
+            inline_script_cache.put(digest, body)
+        refs.append({"hash": digest, "bytes": len(body.encode('utf-8'))})
+    return refs
+
+
+def inline_script(digest):
+    """A stored inline script body by its hash, or None when unknown or expired."""
+    return inline_script_cache.peek(digest.lower())[0]
+
+
+def shape_report(report, fields=None, include_inline=True):
+    """
+    The report as a client asked for it: only `fields` (every field when None), with the inline script
+    bodies replaced by content hashes and sizes unless include_inline.
+    """
+    if fields is not None:
+        report = {field: value for field, value in report.items() if field in fields}
+    if not include_inline and report.get('inline_scripts'):
+        report = dict(report, inline_scripts=inline_refs(report['inline_scripts']))
+    return report
+
+
+def report_etag(report):
+    """
+    Weak ETag over a shaped report. The result_cache block (its age changes on every hit) is left out, so
+    the tag only changes when the report does.
+    """
+    body = ujson.dumps({field: value for field, value in report.items() if field != 'result_cache'},
+                       ensure_ascii=False, sort_keys=True, escape_forward_slashes=False)
+    return f'W/"{hashlib.blake2b(body.encode("utf-8"), digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header names etag; weak comparison, as for a GET."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag.removeprefix('W/') in (tag.removeprefix('W/') for tag in tags)
+
+
+# Compression
+
+def choose_encoding(accept_encoding):
+    """The best content coding the client accepts: br (when brotli is installed), then gzip, else None."""
+    if not RESPONSE_COMPRESSION or not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    for coding in ('br', 'gzip') if brotli is not None else ('gzip',):
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+def compress_body(body, accept_encoding):
+    """Returns (body, content coding or None), compressing when the body is big enough and the client accepts it."""
+    encoding = choose_encoding(accept_encoding) if len(body) >= RESPONSE_COMPRESS_MIN_BYTES else None
+    inc('response_body_bytes_total', len(body))
+    if encoding is None:
+        inc('response_bytes_total', len(body), encoding='identity')
+        return body, None
+    started = time.perf_counter()
+    if encoding == 'br':
+        compressed = brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY)
+    else:
+        compressed = gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0)
+    observe_stage('compress', time.perf_counter() - started)
+    inc('response_bytes_total', len(compressed), encoding=encoding)
+    return compressed, encoding
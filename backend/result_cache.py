@@ -0,0 +1,311 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit
+
+# Tiered cache for /api/analyze results: an in-process LRU in front of a SQLite file that every
+# gunicorn worker on the host shares. The SQLite file also carries the cross-worker in-flight leases
+# used to coalesce identical concurrent analyses.
+
+RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL', 300))  # Seconds a result is served without revalidation
+RESULT_CACHE_MAX_AGE = float(os.getenv('RESULT_CACHE_MAX_AGE', 86400))  # Stale results older than this are dropped
+RESULT_CACHE_LRU_SIZE = int(os.getenv('RESULT_CACHE_LRU_SIZE', 256))
+RESULT_CACHE_DB = os.getenv('RESULT_CACHE_DB', os.path.join('cache', 'results.sqlite3'))
+COALESCE_WAIT_TIMEOUT = float(os.getenv('COALESCE_WAIT_TIMEOUT', 120))  # Longest a caller waits on another's analysis
+COALESCE_POLL_INTERVAL = 0.2
+
+
+def result_key(url, option, rules_version=None):
+    """
+    Normalizes the URL (scheme/host case, default port, fragment, empty path) and appends the option, plus
+    the exclusion rules version when given so a rules change never serves recommendations from the old rules.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and not (scheme == 'https' and parts.port == 443) and not (scheme == 'http' and parts.port == 80):
+        host = f"{host}:{parts.port}"
+    normalized = urlunsplit((scheme, host, parts.path or '/', parts.query, ''))
+    key = f"{normalized}|{option or 'default'}"
+    return f"{key}|{rules_version}" if rules_version else key
+
+
+class _InFlight:
+    """An analysis currently running in this process that other threads can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ResultCache:
+    def __init__(self, db_path=RESULT_CACHE_DB, ttl=RESULT_CACHE_TTL, lru_size=RESULT_CACHE_LRU_SIZE,
+                 max_age=RESULT_CACHE_MAX_AGE, table='results', lease_timeout=COALESCE_WAIT_TIMEOUT):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_age = max_age
+        self.table = table  # Caches sharing the database file keep their entries in separate tables
+        self.lru_size = lru_size
+        self.lease_timeout = lease_timeout  # Must outlast the slowest compute, or a second worker takes the key over
+        self._lru = OrderedDict()  # key -> (stored_at, result, validators)
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> _InFlight
+        self._async_inflight = {}  # key -> asyncio.Future, for the ASGI path
+        self._local = threading.local()
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._stats = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'coalesced': 0, 'revalidated': 0, 'refreshes': 0, 'errors': 0}
+        self._init_db()
+
+    # Shared store
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _init_db(self):
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.table} ('
+            'key TEXT PRIMARY KEY, stored_at REAL NOT NULL, validators TEXT, payload TEXT NOT NULL)'
+        )
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS inflight (key TEXT PRIMARY KEY, owner TEXT NOT NULL, started_at REAL NOT NULL)'
+        )
+
+    def _load_shared(self, key):
+        row = self._connection().execute(
+            f'SELECT stored_at, validators, payload FROM {self.table} WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[2]), json.loads(row[1]) if row[1] else None
+
+    def _store(self, key, stored_at, result, validators):
+        self._remember(key, (stored_at, result, validators))
+        connection = self._connection()
+        connection.execute(
+            f'INSERT OR REPLACE INTO {self.table} (key, stored_at, validators, payload) VALUES (?, ?, ?, ?)',
+            (key, stored_at, json.dumps(validators) if validators else None, json.dumps(result)),
+        )
+        connection.execute(f'DELETE FROM {self.table} WHERE stored_at < ?', (stored_at - self.max_age,))
+
+    def _acquire_lease(self, key):
+        """Claims the cross-worker right to compute key; stale leases from dead workers are taken over."""
+        now = time.time()
+        connection = self._connection()
+        connection.execute('DELETE FROM inflight WHERE key = ? AND started_at < ?', (key, now - self.lease_timeout))
+        cursor = connection.execute(
+            'INSERT OR IGNORE INTO inflight (key, owner, started_at) VALUES (?, ?, ?)', (key, self._owner, now)
+        )
+        return cursor.rowcount == 1
+
+    def _release_lease(self, key):
+        self._connection().execute('DELETE FROM inflight WHERE key = ? AND owner = ?', (key, self._owner))
+
+    # In-process LRU
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._lru[key] = entry
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    def _lookup(self, key):
+        """Returns (entry, tier) from the LRU, falling back to the shared store."""
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                self._lru.move_to_end(key)
+                return entry, 'local'
+        entry = self._load_shared(key)
+        if entry is not None:
+            self._remember(key, entry)
+            return entry, 'shared'
+        return None, None
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _fresh(self, entry):
+        return entry is not None and time.time() - entry[0] < self.ttl
+
+    @staticmethod
+    def _info(outcome, entry):
+        return {'outcome': outcome, 'age_seconds': round(time.time() - entry[0], 1)}
+
+    # Public API
+
+    def peek(self, key):
+        """Returns (result, age_seconds) from either tier without computing anything, or (None, None)."""
+        entry, _ = self._lookup(key)
+        if entry is None:
+            return None, None
+        age = time.time() - entry[0]
+        if age > self.max_age:
+            return None, None
+        return entry[1], age
+
+    def put(self, key, result, validators=None):
+        """Stores result (and the validators for revalidating it) for key in both tiers, dated now."""
+        self._store(key, time.time(), result, validators)
+
+    def get_or_compute(self, key, compute, force_refresh=False):
+        """
+        Returns (result, cache_info). compute(validators) must return (result, validators); returning a None
+        result means the origin confirmed the previous result (conditional request answered 304).
+        """
+        if not force_refresh:
+            entry, tier = self._lookup(key)
+            if self._fresh(entry):
+                self._count('hits' if tier == 'local' else 'shared_hits')
+                return entry[1], self._info('hit', entry)
+
+        # Coalesce with an identical analysis already running in this process
+        with self._lock:
+            inflight = self._inflight.get(key)
+            owner = inflight is None
+            if owner:
+                inflight = self._inflight[key] = _InFlight()
+        if not owner:
+            self._count('coalesced')
+            if not inflight.done.wait(self.lease_timeout):
+                raise TimeoutError(f"Timed out waiting for the in-flight analysis of {key}")
+            if inflight.error is not None:
+                raise inflight.error
+            return inflight.result[0], dict(inflight.result[1], outcome='coalesced')
+
+        try:
+            result, info = self._compute_shared(key, compute, force_refresh)
+            inflight.result = (result, info)
+            return result, info
+        except Exception as error:
+            self._count('errors')
+            inflight.error = error
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            inflight.done.set()
+
+    def _coalesced_entry(self, key, requested_at):
+        """The shared entry written by another worker since requested_at, if there is one yet."""
+        entry = self._load_shared(key)
+        if entry is not None and entry[0] >= requested_at:
+            self._count('coalesced')
+            self._remember(key, entry)
+            return entry
+        return None
+
+    def _stale_entry(self, key, force_refresh):
+        """The expired entry whose validators make the recomputation a conditional request."""
+        return None if force_refresh else self._lookup(key)[0]
+
+    def _finish(self, key, stale, result, new_validators, force_refresh):
+        """Stores a fresh result (or re-dates the stale one after a 304) and returns (result, cache_info)."""
+        now = time.time()
+        if result is None and stale is not None:
+            # The origin confirmed the cached analysis is still current
+            self._count('revalidated')
+            self._store(key, now, stale[1], stale[2])
+            return stale[1], {'outcome': 'revalidated', 'age_seconds': 0.0}
+        self._count('refreshes' if force_refresh else 'misses')
+        if result is not None:  # A 304 with nothing left to re-date leaves no result to cache
+            self._store(key, now, result, new_validators)
+        return result, {'outcome': 'refresh' if force_refresh else 'miss', 'age_seconds': 0.0}
+
+    def _compute_shared(self, key, compute, force_refresh):
+        """Runs compute under the cross-worker lease, or waits for the worker that holds it."""
+        requested_at = time.time()
+        deadline = requested_at + self.lease_timeout
+        while not self._acquire_lease(key):
+            # Another worker is analyzing this key; wait for its result to land in the shared store
+            time.sleep(COALESCE_POLL_INTERVAL)
+            entry = self._coalesced_entry(key, requested_at)
+            if entry is not None:
+                return entry[1], self._info('coalesced', entry)
+            if time.time() > deadline:
+                raise TimeoutError(f"Timed out waiting for another worker's analysis of {key}")
+
+        try:
+            stale = self._stale_entry(key, force_refresh)
+            result, new_validators = compute(stale[2] if stale else None)
+            return self._finish(key, stale, result, new_validators, force_refresh)
+        finally:
+            self._release_lease(key)
+
+    async def get_or_compute_async(self, key, compute, force_refresh=False):
+        """
+        Event-loop version of get_or_compute for the ASGI path: compute(validators) is a coroutine function,
+        store access runs on worker threads and waiting on other analyses never blocks the loop.
+        """
+        if not force_refresh:
+            entry, tier = await asyncio.to_thread(self._lookup, key)
+            if self._fresh(entry):
+                self._count('hits' if tier == 'local' else 'shared_hits')
+                return entry[1], self._info('hit', entry)
+
+        # Coalesce with an identical analysis already running on this loop
+        inflight = self._async_inflight.get(key)
+        if inflight is not None:
+            self._count('coalesced')
+            result, info = await asyncio.wait_for(asyncio.shield(inflight), self.lease_timeout)
+            return result, dict(info, outcome='coalesced')
+
+        inflight = self._async_inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result, info = await self._compute_shared_async(key, compute, force_refresh)
+            inflight.set_result((result, info))
+            return result, info
+        except Exception as error:
+            self._count('errors')
+            inflight.set_exception(error)
+            inflight.exception()  # Mark retrieved so an unawaited failure is not reported at shutdown
+            raise
+        finally:
+            self._async_inflight.pop(key, None)
+
+    async def _compute_shared_async(self, key, compute, force_refresh):
+        requested_at = time.time()
+        deadline = requested_at + self.lease_timeout
+        while not await asyncio.to_thread(self._acquire_lease, key):
+            await asyncio.sleep(COALESCE_POLL_INTERVAL)
+            entry = await asyncio.to_thread(self._coalesced_entry, key, requested_at)
+            if entry is not None:
+                return entry[1], self._info('coalesced', entry)
+            if time.time() > deadline:
+                raise TimeoutError(f"Timed out waiting for another worker's analysis of {key}")
+
+        try:
+            stale = await asyncio.to_thread(self._stale_entry, key, force_refresh)
+            result, new_validators = await compute(stale[2] if stale else None)
+            return await asyncio.to_thread(self._finish, key, stale, result, new_validators, force_refresh)
+        finally:
+            await asyncio.to_thread(self._release_lease, key)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['local_entries'] = len(self._lru)
+            stats['inflight'] = len(self._inflight) + len(self._async_inflight)
+        lookups = stats['hits'] + stats['shared_hits'] + stats['misses'] + stats['coalesced'] + stats['revalidated']
+        stats['hit_ratio'] = round((stats['hits'] + stats['shared_hits'] + stats['coalesced']) / lookups, 3) if lookups else 0.0
+        return stats
+
+
+result_cache = ResultCache()
@@ -0,0 +1,293 @@
+import gzip
+import logging
+import os
+import posixpath
+import random
+import re
+from time import monotonic
+from urllib.parse import urlsplit, urljoin
+from xml.etree.ElementTree import iterparse, ParseError
+
+import requests
+
+import http_client
+from admission import admission, ADMISSION_BATCH_SLOTS
+from analysis_handler import check_exclusions, flatten_recommendations
+from batch_runner import run_batch, BATCH_CONCURRENCY
+from page_fetcher import fetch_page, fetch_text, DEFAULT_HEADERS, FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT
+
+# Site crawl: discovers pages from the sitemaps, samples a few per post type and merges their script
+# inventories and exclusion recommendations into one site-level report.
+
+CRAWL_SAMPLES_PER_TYPE = int(os.getenv('CRAWL_SAMPLES_PER_TYPE', 3))
+CRAWL_MAX_PAGES = int(os.getenv('CRAWL_MAX_PAGES', 500))
+CRAWL_PER_HOST = int(os.getenv('CRAWL_PER_HOST', 4))  # Pages fetched from the site at once (the crawl's cap is BATCH_CONCURRENCY)
+CRAWL_TIME_BUDGET = float(os.getenv('CRAWL_TIME_BUDGET', 90))  # Seconds; pages not analyzed by then are reported as skipped
+CRAWL_MAX_SITEMAPS = int(os.getenv('CRAWL_MAX_SITEMAPS', 50))
+CRAWL_SITEMAPS_PER_TYPE = 2  # Large post types are split over many sitemap files; sample from the first few
+ROBOTS_MAX_BYTES = 500 * 1024  # Google stops reading a robots.txt here too
+
+# WordPress core, Yoast, Rank Math and AIOSEO locations, tried when robots.txt lists no sitemap
+SITEMAP_CANDIDATES = ('/sitemap_index.xml', '/sitemap.xml', '/wp-sitemap.xml')
+CORE_SITEMAP_PATTERN = re.compile(r'wp-sitemap-(?:posts|taxonomies|users)-(.+?)-\d+\.xml(?:\.gz)?')
+PLUGIN_SITEMAP_PATTERN = re.compile(r'(.+?)[-_]sitemap\d*\.xml(?:\.gz)?')
+
+
+def sitemap_post_type(sitemap_url):
+    """post-sitemap.xml -> 'post', wp-sitemap-posts-product-1.xml -> 'product'; anything else -> 'pages'."""
+    name = posixpath.basename(urlsplit(sitemap_url).path).lower()
+    for pattern in (CORE_SITEMAP_PATTERN, PLUGIN_SITEMAP_PATTERN):
+        match = pattern.fullmatch(name)
+        if match:
+            return match.group(1)
+    return 'pages'
+
+
+def same_origin(url, origin):
+    """Whether url is on origin (scheme and host:port, compared case-insensitively)."""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}".lower() == origin.lower()
+
+
+def iter_sitemap(sitemap_url):
+    """
+    Streams a sitemap, yielding ('sitemap', url) for sitemap index entries and ('page', url) for urlset entries.
+    Elements are discarded as soon as they are read, so memory stays flat however large the file is.
+    """
+    response = http_client.get(sitemap_url, headers=DEFAULT_HEADERS, stream=True,
+                               timeout=(FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT))
+    with response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        source = gzip.GzipFile(fileobj=response.raw) if sitemap_url.endswith('.gz') else response.raw
+        kind = None
+        for event, element in iterparse(source, events=('start', 'end')):
+            tag = element.tag.rsplit('}', 1)[-1]
+            if event == 'start':
+                if kind is None:
+                    kind = 'sitemap' if tag == 'sitemapindex' else 'page'
+                continue
+            if tag == 'loc' and element.text:
+                yield kind, element.text.strip()
+            elif tag in ('url', 'sitemap'):
+                element.clear()
+
+
+def discover_sitemaps(origin):
+    """
+    Sitemap URLs from robots.txt, falling back to the usual WordPress locations. Sitemaps robots.txt lists on
+    other hosts are dropped: the crawl only ever requests the origin it was asked for.
+    """
+    try:
+        robots = fetch_text(f"{origin}/robots.txt", max_bytes=ROBOTS_MAX_BYTES)
+        if robots:
+            listed = [line.split(':', 1)[1].strip() for line in robots.splitlines()
+                      if line.lower().startswith('sitemap:')]
+            listed = [sitemap_url for sitemap_url in listed if same_origin(sitemap_url, origin)]
+            if listed:
+                return listed
+    except requests.exceptions.RequestException as e:
+        logging.info(f"robots.txt not available for {origin}: {e}")
+    return [origin + path for path in SITEMAP_CANDIDATES]
+
+
+def sample_pages(origin, samples_per_type, max_pages, deadline=None):
+    """
+    Walks the sitemaps breadth-first and keeps a uniform random sample (reservoir, seeded per site so reruns
+    pick the same pages) of samples_per_type pages per post type. Sitemaps and pages on other origins are
+    ignored, and no sitemap is fetched once the monotonic deadline has passed. Returns ({post type: [urls]},
+    sitemaps read).
+    """
+    rng = random.Random(origin)
+    queue = discover_sitemaps(origin)
+    fallback = queue == [origin + path for path in SITEMAP_CANDIDATES]
+    seen_sitemaps = set()
+    files_per_type = {}
+    samples = {}
+    seen_per_type = {}
+    read = []
+
+    while queue and len(read) < CRAWL_MAX_SITEMAPS:
+        if deadline is not None and monotonic() > deadline:
+            logging.info(f"Time budget spent reading the sitemaps of {origin}, {len(queue)} left unread")
+            break
+        sitemap_url = queue.pop(0)
+        post_type = sitemap_post_type(sitemap_url)
+        if sitemap_url in seen_sitemaps or files_per_type.get(post_type, 0) >= CRAWL_SITEMAPS_PER_TYPE:
+            continue
+        seen_sitemaps.add(sitemap_url)
+        try:
+            entries = list_entries(sitemap_url, origin, post_type, rng, samples, seen_per_type, samples_per_type)
+        except (requests.exceptions.RequestException, ParseError, OSError) as e:
+            logging.info(f"Skipping sitemap {sitemap_url}: {e}")
+            continue
+        read.append(sitemap_url)
+        if entries is not None:
+            queue.extend(child for child in (urljoin(sitemap_url, loc) for loc in entries) if same_origin(child, origin))
+        else:
+            files_per_type[post_type] = files_per_type.get(post_type, 0) + 1
+        if fallback:
+            # The first usual location that answers is the site's sitemap; the others would repeat it
+            queue = [url for url in queue if not url.endswith(SITEMAP_CANDIDATES)]
+
+    pages = {'home': [origin + '/']}
+    home = {origin + '/', origin}
+    for post_type, urls in samples.items():
+        urls = [url for url in dict.fromkeys(urls) if url not in home]
+        if urls:
+            pages[post_type] = urls
+
+    # Trim to max_pages, always from the largest type so every type stays represented
+    total = sum(len(urls) for urls in pages.values())
+    while total > max_pages:
+        longest = max(pages, key=lambda post_type: len(pages[post_type]))
+        pages[longest].pop()
+        total -= 1
+    return pages, read
+
+
+def list_entries(sitemap_url, origin, post_type, rng, samples, seen_per_type, samples_per_type):
+    """
+    Reads one sitemap. Returns the child sitemaps of an index, or None after sampling a urlset's pages;
+    pages on other origins are not sampled.
+    """
+    children = []
+    is_index = False
+    for kind, loc in iter_sitemap(sitemap_url):
+        if kind == 'sitemap':
+            is_index = True
+            children.append(loc)
+            continue
+        loc = urljoin(sitemap_url, loc)
+        if not same_origin(loc, origin):
+            continue
+        seen = seen_per_type[post_type] = seen_per_type.get(post_type, 0) + 1
+        reservoir = samples.setdefault(post_type, [])
+        if len(reservoir) < samples_per_type:
+            reservoir.append(loc)
+        else:
+            slot = rng.randrange(seen)
+            if slot < samples_per_type:
+                reservoir[slot] = loc
+    return children if is_index else None
+
+
+def analyze_page(item, origin=None):
+    """
+    Fetches one page (parsed as it streams in) and checks its exclusions. With an origin, a page that
+    redirects off it fails with CrossOriginRedirect instead of being analyzed.
+    """
+    page = fetch_page(item['url'], origin=origin)
+    recommendations = flatten_recommendations(check_exclusions(page.inventory, sorted(page.plugins), sorted(page.themes)))
+    return page, recommendations
+
+
+class SiteReport:
+    """Merges page results as they arrive; only the aggregate is kept, never the pages themselves."""
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.pages = []
+        self.scripts = {}  # id or src -> {'id', 'src', 'pages': [], 'delayed_pages': []}
+        self.stylesheets = {}
+        self.plugins = {}  # slug -> [pages]
+        self.themes = {}
+        self.recommendations = {}  # recommendation -> [pages]
+        self.markers = set()
+
+    def add_page(self, url, post_type, page, recommendations):
+        self.pages.append({"url": url, "type": post_type, "status_code": page.status_code,
+                           "bytes_read": page.bytes_read, "truncated": page.truncated})
+        for script in page.inventory.scripts:
+            self._add_asset(self.scripts, script.id, script.src, script.delayed, url)
+        for stylesheet in page.inventory.stylesheets:
+            self._add_asset(self.stylesheets, stylesheet.id, stylesheet.href, stylesheet.delayed, url)
+        for slug in page.plugins:
+            self.plugins.setdefault(slug, []).append(url)
+        for slug in page.themes:
+            self.themes.setdefault(slug, []).append(url)
+        for recommendation in dict.fromkeys(recommendations):
+            self.recommendations.setdefault(recommendation, []).append(url)
+        self.markers.update(page.markers)
+
+    def add_failure(self, url, post_type, error):
+        self.pages.append({"url": url, "type": post_type, "error": error})
+
+    @staticmethod
+    def _add_asset(assets, asset_id, src, delayed, url):
+        key = asset_id or src
+        if not key:
+            return  # Inline script without an id: nothing to identify it across pages
+        entry = assets.setdefault(key, {"id": asset_id or '', "src": src, "pages": [], "delayed_pages": []})
+        if not entry['pages'] or entry['pages'][-1] != url:
+            entry['pages'].append(url)
+        if delayed and (not entry['delayed_pages'] or entry['delayed_pages'][-1] != url):
+            entry['delayed_pages'].append(url)
+
+    def as_dict(self, **extra):
+        def by_reach(assets):
+            return sorted(assets.values(), key=lambda entry: (-len(entry['pages']), entry['id'] or entry['src']))
+
+        analyzed = [page for page in self.pages if 'error' not in page]
+        return dict(
+            origin=self.origin,
+            pages_analyzed=len(analyzed),
+            pages_failed=len(self.pages) - len(analyzed),
+            pages=self.pages,
+            scripts=by_reach(self.scripts),
+            stylesheets=by_reach(self.stylesheets),
+            plugins={slug: pages for slug, pages in sorted(self.plugins.items())},
+            themes={slug: pages for slug, pages in sorted(self.themes.items())},
+            recommendations=[{"recommendation": recommendation, "pages": pages}
+                             for recommendation, pages in sorted(self.recommendations.items(), key=lambda item: -len(item[1]))],
+            performance_markers=sorted(self.markers),
+            **extra
+        )
+
+
+def crawl_site(url, samples_per_type=CRAWL_SAMPLES_PER_TYPE, max_pages=CRAWL_MAX_PAGES,
+               concurrency=BATCH_CONCURRENCY, time_budget=CRAWL_TIME_BUDGET, client=None):
+    """
+    Samples pages per post type from the site's sitemaps, analyzes them concurrently (at most `concurrency`
+    in flight, CRAWL_PER_HOST against the site) and returns the merged site report. Pages still pending when
+    time_budget runs out are listed under 'skipped'. Every page spends one of client's rate limit tokens
+    and holds an admission slot while it is fetched, with at most ADMISSION_BATCH_SLOTS of them at once.
+    """
+    started = monotonic()
+    parts = urlsplit(url)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    deadline = started + time_budget
+    pages, sitemaps = sample_pages(origin, max(1, samples_per_type), max(1, min(max_pages, CRAWL_MAX_PAGES)), deadline)
+    items = [{"url": page_url, "type": post_type} for post_type, urls in pages.items() for page_url in urls]
+    logging.info(f"Crawling {len(items)} pages of {origin} from {len(sitemaps)} sitemaps")
+
+    report = SiteReport(origin)
+    finished = set()
+
+    def admitted_page(item):
+        if client is not None:
+            admission.take_token(client)
+        with admission.slot():
+            return analyze_page(item, origin)
+
+    # The deadline bounds the waiting too: a slow page can't hold the report back past the budget
+    results = run_batch(items, admitted_page, min(concurrency, ADMISSION_BATCH_SLOTS), CRAWL_PER_HOST, deadline)
+    try:
+        for index, item, result, error in results:
+            finished.add(index)
+            if error is None:
+                report.add_page(item['url'], item['type'], *result)
+            else:
+                logging.info(f"Crawl of {item['url']} failed: {error}")
+                report.add_failure(item['url'], item['type'], str(error))
+            if monotonic() > deadline:
+                break
+    finally:
+        results.close()
+
+    return report.as_dict(
+        sitemaps=sitemaps,
+        sampled={post_type: len(urls) for post_type, urls in pages.items()},
+        skipped=[item['url'] for index, item in enumerate(items) if index not in finished],
+        elapsed_ms=round((monotonic() - started) * 1000),
+    )
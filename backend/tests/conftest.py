@@ -0,0 +1,17 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The backend modules import each other as top-level modules, the way gunicorn runs them from backend/.
+# Their caches, databases and logs go to a scratch directory instead of the working tree.
+sys.path.insert(0, BACKEND_DIR)
+WORK_DIR = tempfile.mkdtemp(prefix='checkmysite-tests-')
+atexit.register(shutil.rmtree, WORK_DIR, ignore_errors=True)
+os.environ.setdefault('RULES_FILE', os.path.join(BACKEND_DIR, 'pm_exclusions.py'))
+os.environ.setdefault('RULES_HISTORY_DIR', os.path.join(WORK_DIR, 'rules_history'))
+os.environ.setdefault('REQUEST_LOG_ENABLED', 'false')
+os.chdir(WORK_DIR)
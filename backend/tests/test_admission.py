@@ -0,0 +1,14 @@
+import time
+
+import admission as admission_module
+from admission import Admission
+
+
+def test_a_held_slot_outlives_the_slot_ttl(tmp_path, monkeypatch):
+    monkeypatch.setattr(admission_module, 'ADMISSION_SLOT_TTL', 0.3)
+    admission = Admission(db_path=str(tmp_path / 'admission.sqlite3'), max_active=1)
+
+    with admission.slot():
+        time.sleep(0.8)
+        assert admission.stats()['active'] == 1
+    assert admission.stats()['active'] == 0
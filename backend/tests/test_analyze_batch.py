@@ -0,0 +1,25 @@
+import json
+import time
+
+import app as app_module
+from app import app
+
+
+def slow_analysis(url, option, force_refresh):
+    time.sleep(1)
+    raise TimeoutError(url)  # Still running when the test ends; never gets as far as the history store
+
+
+def test_batch_reports_what_its_time_budget_skipped(monkeypatch):
+    monkeypatch.setattr(app_module, 'BATCH_TIME_BUDGET', 0.2)
+    monkeypatch.setattr(app_module, 'cached_analysis', slow_analysis)
+    client = app.test_client()
+    client.environ_base['HTTP_X_REAL_IP'] = '203.0.113.7'
+
+    started = time.monotonic()
+    response = client.post('/api/analyze/batch', json={'urls': ['https://example.com/', 'https://example.org/']})
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert time.monotonic() - started < 1
+    assert [line['skipped'] for line in lines[:-1]] == [True, True]
+    assert lines[-1]['errors'] == 2
@@ -0,0 +1,89 @@
+import itertools
+
+import pytest
+
+from app import app
+
+addresses = itertools.count(1)
+
+
+@pytest.fixture
+def client():
+    # A client address of its own per test, so one test never runs into another's rate limit
+    client = app.test_client()
+    client.environ_base['HTTP_X_REAL_IP'] = f"198.51.100.{next(addresses)}"
+    return client
+
+
+@pytest.mark.parametrize('body', [{}, {'url': None}, {'url': 42}, {'url': 'http://example.com/'}])
+def test_field_data_needs_a_valid_url(client, body):
+    response = client.post('/api/field-data', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+@pytest.mark.parametrize('origins', [[], [42], ['https://example.com/', None], 'ftp://example.com/'])
+def test_field_data_batch_needs_valid_origins(client, origins):
+    response = client.post('/api/field-data/batch', json={'origins': origins})
+    assert response.status_code == 400
+
+
+def test_field_data_batch_over_the_burst_is_refused_without_spending(client):
+    origins = [f"https://site{index}.example/" for index in range(100)]
+    response = client.post('/api/field-data/batch', json={'origins': origins}, headers={'X-Real-IP': '192.0.2.9'})
+    assert response.status_code == 429
+    assert 'split it up' in response.get_json()['error']
+
+
+@pytest.mark.parametrize('body', [{}, {'url': None}, {'url': ['https://example.com/']}])
+def test_stream_needs_a_valid_url(client, body):
+    response = client.post('/api/analyze/stream', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_stream_get_needs_a_url(client):
+    assert client.get('/api/analyze/stream').status_code == 400
+
+
+@pytest.mark.parametrize('body', [
+    {},
+    {'url': None},
+    {'url': 'https://example.com/', 'options': ['default', ['nocache']]},
+    {'url': 'https://example.com/', 'options': ['default', {'option': 'nocache'}]},
+    {'url': 'https://example.com/', 'options': ['default', 1]},
+    {'url': 'https://example.com/', 'options': ['default', 'default']},
+    {'url': 'https://example.com/', 'options': ['default', 'unknown']},
+])
+def test_compare_validates_url_and_options(client, body):
+    response = client.post('/api/analyze/compare', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_compare_refused_part_way_spends_no_tokens(client):
+    from admission import admission, client_id
+    headers = {'X-Real-IP': '192.0.2.23'}
+    bucket = client_id(headers, '127.0.0.1')
+    admission.take_token(bucket, 8)  # Two of the burst of ten left
+    response = client.post('/api/analyze/compare', headers=headers,
+                           json={'url': 'https://example.com/', 'options': ['default', 'nocache', 'perfmattersoff']})
+    assert response.status_code == 429
+    admission.take_token(bucket, 2)  # Still there: the refused compare spent nothing
+
+
+@pytest.mark.parametrize('body', [{}, {'url': None}, {'url': 'https://example.com/', 'priority': 'high'},
+                                  {'url': 'https://example.com/', 'option': ['nocache']}])
+def test_jobs_are_validated_before_queueing(client, body):
+    from job_queue import job_queue
+    before = job_queue.stats()['waiting']
+    response = client.post('/api/analyze/jobs', json=body)
+    assert response.status_code == 400
+    assert job_queue.stats()['waiting'] == before
+
+
+@pytest.mark.parametrize('body', [{}, {'url': None}, {'url': 7}])
+def test_crawl_needs_a_valid_url(client, body):
+    response = client.post('/api/crawl', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
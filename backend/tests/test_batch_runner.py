@@ -0,0 +1,29 @@
+import time
+from time import monotonic
+
+from batch_runner import run_batch
+
+
+def test_results_arrive_per_item_and_errors_stay_per_item():
+    def task(item):
+        if item['url'].endswith('/bad'):
+            raise ValueError('bad page')
+        return item['url']
+
+    items = [{'url': 'https://a.example/'}, {'url': 'https://a.example/bad'}, {'url': 'https://b.example/'}]
+    outcomes = {index: (result, error) for index, _, result, error in run_batch(items, task, concurrency=2)}
+    assert outcomes[0] == ('https://a.example/', None)
+    assert isinstance(outcomes[1][1], ValueError)
+    assert outcomes[2] == ('https://b.example/', None)
+
+
+def test_deadline_stops_waiting_on_a_slow_item():
+    def task(item):
+        time.sleep(item['sleep'])
+        return item['url']
+
+    items = [{'url': 'https://fast.example/', 'sleep': 0.0}, {'url': 'https://slow.example/', 'sleep': 3.0}]
+    started = monotonic()
+    finished = [index for index, *_ in run_batch(items, task, concurrency=2, deadline=started + 0.5)]
+    assert finished == [0]
+    assert monotonic() - started < 2
@@ -0,0 +1,24 @@
+import pytest
+
+from analysis_handler import check_exclusions
+from exclusion_rules import compile_rules
+from html_inventory import PARSER_BACKENDS, build_inventory, delayed_js_ids
+
+RULES = compile_rules("exclusion_list = {'plugins/woocommerce': ['woocommerce-js']}")
+PAGE = ('<script type="PMDelayedScript" id="woocommerce-js" '
+        'src="/wp-content/plugins/woocommerce/assets/js/frontend/woocommerce.min.js"></script>'
+        '<script type="PMDelayedScript" id="inline-mixed">var x = 1;</script>')
+
+
+@pytest.mark.parametrize('backend', sorted(PARSER_BACKENDS))
+def test_mixed_case_type_is_delayed_for_recommendations(backend):
+    inventory = build_inventory(PAGE, backend)
+    recommendations = check_exclusions(inventory, ['woocommerce'], [], RULES)
+    assert recommendations == ["woocommerce: woocommerce-js - Exclude from delay"]
+
+
+@pytest.mark.parametrize('backend', sorted(PARSER_BACKENDS))
+def test_mixed_case_type_is_not_delayed_for_ids_and_inline_scripts(backend):
+    inventory = build_inventory(PAGE, backend)
+    assert delayed_js_ids(inventory) == {"woocommerce-js", "inline-mixed"}
+    assert inventory.delayed_inline == ()
@@ -0,0 +1,21 @@
+import time
+
+from history_store import HistoryStore
+
+
+def test_paging_back_keeps_runs_recorded_at_the_same_instant(tmp_path):
+    store = HistoryStore(db_path=str(tmp_path / 'history.sqlite3'))
+    analyzed_at = time.time()
+    for _ in range(5):
+        store.record('https://example.com/', 'default', {'plugins': []}, analyzed_at=analyzed_at)
+    store.close()
+
+    seen, before, before_id = [], None, None
+    while True:
+        page = store.timeline('example.com', limit=2, before=before, before_id=before_id)
+        seen += [run['id'] for run in page]
+        if len(page) < 2:
+            break
+        before, before_id = page[-1]['analyzed_at'], page[-1]['id']
+
+    assert seen == sorted(seen, reverse=True) and len(set(seen)) == 5
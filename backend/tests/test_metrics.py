@@ -0,0 +1,25 @@
+import json
+import os
+
+import metrics
+
+
+def write_snapshot(directory, pid, value):
+    with open(directory / f"metrics-{pid}.json", 'w') as f:
+        json.dump({'counters': [['jobs', [], value]], 'histograms': []}, f)
+
+
+def test_files_left_by_exited_processes_are_archived_not_overwritten(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    monkeypatch.setattr(metrics, '_swept_pid', None)
+    write_snapshot(tmp_path, os.getpid(), 5)  # An earlier process that had this pid
+    write_snapshot(tmp_path, 2 ** 30, 3)  # A worker that is gone
+
+    merged = metrics.collect()
+
+    assert merged['counters'][('jobs', ())] == 8
+    assert set(os.listdir(tmp_path)) == {'.metrics.lock', 'metrics-archive.json', f"metrics-{os.getpid()}.json"}
+
+
+def test_label_values_are_escaped():
+    assert metrics._format_labels((('url', 'a"b\\c\nd'),)) == '{url="a\\"b\\\\c\\nd"}'
@@ -0,0 +1,25 @@
+import time
+
+from result_cache import ResultCache
+
+
+def test_a_lease_lasts_for_the_cache_lease_timeout(tmp_path):
+    db_path = str(tmp_path / 'cache.sqlite3')
+    running, other = (ResultCache(db_path=db_path, lease_timeout=150, table='psi_results') for _ in range(2))
+    assert running._acquire_lease('key')
+
+    # Past the default 120 s wait, but still inside this cache's lease: nobody else starts the same run
+    running._connection().execute('UPDATE inflight SET started_at = ?', (time.time() - 130,))
+    assert not other._acquire_lease('key')
+
+    running._connection().execute('UPDATE inflight SET started_at = ?', (time.time() - 160,))
+    assert other._acquire_lease('key')
+
+
+def test_a_304_without_a_cached_entry_stores_nothing(tmp_path):
+    cache = ResultCache(db_path=str(tmp_path / 'cache.sqlite3'))
+    result, info = cache.get_or_compute('key', lambda validators: (None, {'etag': '"v1"'}))
+
+    assert result is None and info['outcome'] == 'miss'
+    assert cache.peek('key') == (None, None)
+    assert cache.get_or_compute('key', lambda validators: ({'ok': True}, None))[0] == {'ok': True}
@@ -1,22 +1,12 @@
 import re
-import os
-import logging
-import urllib.parse
-from datetime import datetime
-
-def log_request(url, data):
-    parsed_url = urllib.parse.urlparse(url)
-    cleaned_url = re.sub(r'\W+', '_', parsed_url.netloc + parsed_url.path)
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{cleaned_url}_{timestamp}.log"
-    log_dir = "logs"
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    filepath = os.path.join(log_dir, filename)
-    with open(filepath, 'w') as f:
-        f.write(f"URL: {url}\n\n")
-        f.write(f"Data:\n{data}\n")
-    logging.info(f"Request data logged to {filepath}")
+from datetime import datetime, timezone
+
+from request_log import request_log, REQUEST_LOG_ENABLED
+
+# Queues one structured record per analysis for the request log (see request_log.py); returns immediately
+def log_request(url, **fields):
+    if REQUEST_LOG_ENABLED:
+        request_log.enqueue(dict(time=datetime.now(timezone.utc).isoformat(timespec='milliseconds'), url=url, **fields))
 
 def is_valid_url(url):
     return re.match(r'^https:\/\/[^\s$.?#].[^\s]*$', url)
@@ -49,3 +39,13 @@ def get_score_color(score):
         return "orange"
     return "red"
 
+# Share of cache-probe samples answered with a HIT (0-1); gray when no sample got a response
+def get_hit_ratio_color(ratio):
+    if ratio is None:
+        return "gray"
+    if ratio >= 0.9:
+        return "green"
+    elif ratio >= 0.5:
+        return "orange"
+    return "red"
+
@@ -0,0 +1,94 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import monotonic
+
+from history_store import diff_runs
+
+# Compare mode: the analysis options of one URL (default, ?nocache, ?perfmattersoff) are analyzed side by
+# side. Each variant goes through the usual result cache and admission slot, but they are all submitted at
+# once, so a comparison takes about as long as its slowest variant rather than the sum of them. Every
+# variant is then diffed against the first one (the baseline).
+
+VARIANT_OPTIONS = ('default', 'nocache', 'perfmattersoff')
+COMPARE_WORKERS = int(os.getenv('COMPARE_WORKERS', 12))  # Variant analyses in flight across all comparisons
+
+# Numbers from the report compared between variants, with the difference
+TIMING_FIELDS = ('dns_ms', 'connect_ms', 'tls_ms', 'ttfb_ms', 'download_ms', 'redirect_ms', 'total_ms')
+SIZE_FIELDS = ('bytes_read', 'transfer_bytes', 'content_bytes')
+
+compare_executor = ThreadPoolExecutor(max_workers=COMPARE_WORKERS, thread_name_prefix='compare')
+
+
+def run_variants(options, analyze, timeout=None):
+    """
+    Calls analyze(option) for every option concurrently. Returns ({option: report}, {option: exception})
+    in the order of options; a variant still running after timeout seconds counts as failed.
+    """
+    futures = {option: compare_executor.submit(analyze, option) for option in options}
+    wait(futures.values(), timeout=timeout)
+    reports, errors = {}, {}
+    for option, future in futures.items():
+        if not future.done():
+            future.cancel()
+            errors[option] = TimeoutError(f"The {option} variant did not finish in time")
+        elif future.exception() is not None:
+            errors[option] = future.exception()
+        else:
+            reports[option] = future.result()
+    return reports, errors
+
+
+def delayed_scripts(report):
+    """IDs of the scripts Perfmatters delays in a report (css_ids already lists only delayed stylesheets)."""
+    return {js_id[:-len(' --- pmdelayed')] for js_id in report.get('js_ids') or [] if js_id.endswith(' --- pmdelayed')}
+
+
+def numeric_changes(before, after, fields):
+    """{field: {from, to, delta}} for the fields whose values differ; delta is None unless both are numbers."""
+    changes = {}
+    for field in fields:
+        old, new = before.get(field), after.get(field)
+        if old == new:
+            continue
+        numbers = isinstance(old, (int, float)) and isinstance(new, (int, float))
+        changes[field] = {'from': old, 'to': new, 'delta': round(new - old, 2) if numbers else None}
+    return changes
+
+
+def diff_variants(baseline, variant):
+    """
+    What changes from the baseline report to a variant's: the report fields as the history diff compares
+    them, the scripts whose Perfmatters delay differs, and the fetch timing and sizes.
+    """
+    changes = diff_runs(baseline, variant)
+    old, new = delayed_scripts(baseline), delayed_scripts(variant)
+    if old != new:
+        changes['delayed_scripts'] = {'added': sorted(new - old), 'removed': sorted(old - new)}
+    old_timing, new_timing = baseline.get('timing') or {}, variant.get('timing') or {}
+    timing = numeric_changes(old_timing, new_timing, TIMING_FIELDS)
+    if timing:
+        changes['timing'] = timing
+    size = numeric_changes(dict(baseline, **old_timing), dict(variant, **new_timing), SIZE_FIELDS + ('content_encoding',))
+    if size:
+        changes['size'] = size
+    return changes
+
+
+def compare_variants(options, analyze, timeout=None):
+    """
+    Analyzes the variants concurrently and diffs each against the first. Returns the compare response body:
+    {baseline, variants: {option: report}, diff: {option: changes}, errors: {option: exception}, elapsed_ms}.
+    """
+    started = monotonic()
+    reports, errors = run_variants(options, analyze, timeout)
+    baseline = options[0]
+    diff = {}
+    if baseline in reports:
+        diff = {option: diff_variants(reports[baseline], report) for option, report in reports.items() if option != baseline}
+    return {
+        "baseline": baseline,
+        "variants": reports,
+        "diff": diff,
+        "errors": errors,
+        "elapsed_ms": round((monotonic() - started) * 1000),
+    }
@@ -3,7 +3,16 @@ import { FontAwesomeIcon } from '@fortawesome/react-fontawesome';
 import { faTimes } from '@fortawesome/free-solid-svg-icons';
 import MetricProgressBar from './MetricProgressBar';  // <-- Import the progress bar component
 
-const CoreWebVitalsModal = ({ cwv_scores, onClose }) => {
+// Scores served from the backend's PSI cache carry their age; show it once it is more than a minute old
+const scoreAge = (cacheInfo) => {
+  const age = cacheInfo?.age_seconds;
+  if (!age || age < 60) return null;
+  const minutes = Math.round(age / 60);
+  const label = minutes < 60 ? `${minutes} min` : `${Math.round(minutes / 60)} h`;
+  return <span className="text-sm font-normal text-gray-500 ml-2">(measured {label} ago{cacheInfo.status === 'stale' ? ', refreshing' : ''})</span>;
+};
+
+const CoreWebVitalsModal = ({ cwv_scores, psi_cache, onClose }) => {
   const hasMobileData = cwv_scores?.mobile;
   const hasDesktopData = cwv_scores?.desktop;
 
@@ -21,7 +30,7 @@ const CoreWebVitalsModal = ({ cwv_scores, onClose }) => {
           {/* Mobile Core Web Vitals */}
           {hasMobileData ? (
             <>
-              <h4 className="text-lg font-semibold mb-4">Mobile</h4>
+              <h4 className="text-lg font-semibold mb-4">Mobile{scoreAge(psi_cache?.mobile)}</h4>
               <div className="grid grid-cols-1 sm:grid-cols-2 gap-6">
                 {/* LCP */}
                 <MetricProgressBar
@@ -64,7 +73,7 @@ const CoreWebVitalsModal = ({ cwv_scores, onClose }) => {
           {/* Desktop Core Web Vitals */}
           {hasDesktopData ? (
             <>
-              <h4 className="text-lg font-semibold mb-4 mt-6">Desktop</h4>
+              <h4 className="text-lg font-semibold mb-4 mt-6">Desktop{scoreAge(psi_cache?.desktop)}</h4>
               <div className="grid grid-cols-1 sm:grid-cols-2 gap-6">
                 <MetricProgressBar
                   label="LCP"
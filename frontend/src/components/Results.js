@@ -24,7 +24,7 @@ const getStatusType = (cache_status, bigscoots_cache_status, cache_plan, perform
 
 const Results = ({ results, lighthouseReportUrl, showCoreWebVitals }) => {
   const [isCwvModalOpen, setIsCwvModalOpen] = useState(false);
-  const { js_ids, css_ids, inline_scripts, cache_status, bigscoots_cache_status, cache_plan, performance_tools, plugins, themes, recommendations, cwv_scores } = results;
+  const { js_ids, css_ids, inline_scripts, cache_status, bigscoots_cache_status, cache_plan, performance_tools, plugins, themes, recommendations, cwv_scores, psi_cache } = results;
 
   const statusType = getStatusType(cache_status, bigscoots_cache_status, cache_plan, performance_tools);
 
@@ -91,7 +91,7 @@ const Results = ({ results, lighthouseReportUrl, showCoreWebVitals }) => {
       )}
 
       {/* Core Web Vitals Modal */}
-      {isCwvModalOpen && <CoreWebVitalsModal cwv_scores={cwv_scores} onClose={() => setIsCwvModalOpen(false)} />}
+      {isCwvModalOpen && <CoreWebVitalsModal cwv_scores={cwv_scores} psi_cache={psi_cache} onClose={() => setIsCwvModalOpen(false)} />}
     </div>
   );
 };